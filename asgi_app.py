@@ -0,0 +1,154 @@
+"""
+Asyncio serving mode for the Copilot extension.
+
+/agent is served natively on the event loop: upstream calls share a pooled, kept-alive
+(HTTP/2 when available) httpx client and completion chunks are relayed as they arrive, so one
+process can hold hundreds of concurrent streams. Every other route is handed to the Flask
+application unchanged.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+"""
+import asyncio
+import json
+
+from asgiref.wsgi import WsgiToAsgi
+
+import flask_app
+from utils import agent_functions
+from utils import payload_validation as pv
+from utils import upstream
+from utils import observability
+
+logger = observability.get_logger(__name__)
+
+flask_fallback = WsgiToAsgi(flask_app.app)
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_response(send, status, body=b"", content_type=b"text/plain; charset=utf-8"):
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type)]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def health(scope, receive, send):
+    await send_response(send, 200)
+
+
+async def agent(scope, receive, send):
+    observability.start_trace()
+    headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+    sig = headers.get("github-public-key-signature")
+    api_token = headers.get("x-github-token")
+    integration_id = headers.get("copilot-integration-id")
+
+    body = await read_body(receive)
+
+    with observability.span("verify_signature"):
+        valid = pv.valid_payload(body, sig, flask_app.PUBLIC_KEY)
+    if not valid:
+        observability.REQUESTS.labels("invalid_signature").inc()
+        return await send_response(send, 401, b"Invalid payload signature")
+
+    try:
+        req = json.loads(body)
+    except json.JSONDecodeError:
+        observability.REQUESTS.labels("bad_request").inc()
+        return await send_response(send, 400, b"Invalid JSON in request body")
+
+    if "messages" not in req:
+        observability.REQUESTS.labels("bad_request").inc()
+        return await send_response(send, 400, b"Missing 'messages' field in request body")
+    trace_id = observability.trace_thread(req.get("copilot_thread_id"))
+
+    copilot_headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Authorization": f"Bearer {api_token}",
+        "Copilot-Integration-Id": integration_id
+    }
+    # requests silently drops headers set to None, httpx rejects them.
+    copilot_headers = {key: value for key, value in copilot_headers.items() if value is not None}
+    stream = agent_functions.agent_flow_async(
+        flask_app.AMOUNT_OF_CONTEXT_TO_USE,
+        req["messages"],
+        req.get("copilot_thread_id"),
+        agent_functions.SYSTEM_MESSAGE,
+        flask_app.MODEL_NAME,
+        f"{upstream.COPILOT_API_URL}/chat/completions",
+        copilot_headers,
+        flask_app.ANSWER_CACHE,
+        flask_app.RERANKER,
+        flask_app.PROMPT_PACKER,
+        flask_app.THREAD_MEMORY
+    )
+
+    # Wait for the first chunk before sending the status line, so retrieval or upstream errors
+    # become a 502 instead of a truncated 200 response.
+    try:
+        first_chunk = await anext(stream, b"")
+    except Exception as e:
+        logger.error(f"Error starting agent stream: {e}")
+        observability.REQUESTS.labels("upstream_error").inc()
+        await stream.aclose()
+        return await send_response(send, 502, b"Upstream request failed")
+
+    # Stop reading from upstream as soon as the client goes away.
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"), (b"x-trace-id", trace_id.encode("latin-1"))]})
+        if first_chunk:
+            await send({"type": "http.response.body", "body": first_chunk, "more_body": True})
+        async for chunk in stream:
+            if disconnected.is_set():
+                break
+            # send() only returns once the server has room for more data, which throttles the upstream read.
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+        await stream.aclose()
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await upstream.close_async_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+ROUTES = {
+    ("GET", "/health"): health,
+    ("POST", "/agent"): agent,
+}
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(scope, receive, send)
+
+    handler = ROUTES.get((scope.get("method"), scope.get("path")))
+    if handler is None:
+        return await flask_fallback(scope, receive, send)
+    return await handler(scope, receive, send)
@@ -0,0 +1,124 @@
+"""
+Throughput and chunk size report of the markdown chunkers in vectorstore/chunk_a_learning_path.py.
+
+Compares the token-aware single-pass chunker (vectorstore/markdown_chunker.py) with the previous
+word-count chunker on the Learning Path corpus. Point --content-dir at the content/learning-paths
+directory of a clone of https://github.com/ArmDeveloperEcosystem/arm-learning-paths, or generate
+synthetic pages of the same shape with --synthetic:
+
+    python benchmarks/chunking.py --content-dir ../arm-learning-paths/content/learning-paths
+    python benchmarks/chunking.py --synthetic 2000 --max-tokens 512 --overlap-tokens 64
+
+Besides chunks per second over the corpus, the scaling table chunks single pages made of more and more
+corpus pages, which shows how the cost of each chunker grows with the length of a page.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vectorstore'))
+from chunk_a_learning_path import obtainTextSnippets__Markdown, removeFrontmatter
+from markdown_chunker import chunk_markdown, count_tokens, FENCE
+
+WORDS = ['the', 'vector', 'register', 'load', 'store', 'compiler', 'instruction', 'Neoverse', 'SVE2', 'NEON',
+         'kernel', 'throughput', 'latency', 'cache', 'memory', 'thread', 'build', 'docker', 'image', 'server']
+
+
+def load_corpus(content_dir: str) -> list:
+    """Markdown of every Learning Path page, without front matter, skipping the pages the chunker skips."""
+    pages = []
+    for path in sorted(glob.glob(os.path.join(content_dir, '**', '*.md'), recursive=True)):
+        if any(name in os.path.basename(path) for name in ['_index', '_next-steps', '_demo', '_review']):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            pages.append(removeFrontmatter(f.read()))
+    return pages
+
+
+def synthetic_page(rng) -> str:
+    """A page shaped like a Learning Path step: sections, sub-sections, lists and code blocks with # comments."""
+    sentence = lambda: ' '.join(WORDS[w] for w in rng.integers(0, len(WORDS), rng.integers(8, 25))).capitalize() + '.'
+    paragraph = lambda: ' '.join(sentence() for _ in range(rng.integers(2, 7)))
+    parts = []
+    for section in range(rng.integers(2, 6)):
+        parts.append(f"## Section {section}")
+        for _ in range(rng.integers(1, 4)):
+            parts.append(paragraph())
+            if rng.random() < 0.5:
+                commands = [f"## {sentence()}" if rng.random() < 0.3 else f"sudo apt install -y {WORDS[w]}"
+                            for w in rng.integers(0, len(WORDS), rng.integers(3, 30))]
+                parts.append('```bash\n' + '\n'.join(commands) + '\n```')
+            if rng.random() < 0.3:
+                parts.append('\n'.join(f"- {sentence()}" for _ in range(rng.integers(2, 6))))
+            if rng.random() < 0.4:
+                parts.append(f"### Step {rng.integers(100)}")
+    return '\n\n'.join(parts)
+
+
+def chunkers(args) -> dict:
+    return {
+        'words': obtainTextSnippets__Markdown,
+        'tokens': lambda page: chunk_markdown(page, max_tokens=args.max_tokens, min_tokens=args.min_tokens,
+                                              min_final_tokens=args.min_tokens // 2, overlap_tokens=args.overlap_tokens),
+    }
+
+
+def time_chunker(chunker, pages: list, repeat: int):
+    """Chunk every page repeat times and return the chunks of the last run and the fastest run's time."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = [chunk for page in pages for chunk in chunker(page)]
+        best = min(best, time.perf_counter() - start)
+    return chunks, best
+
+
+def open_fences(chunk: str) -> bool:
+    """Whether a chunk starts or ends inside a code block."""
+    return sum(1 for line in chunk.split('\n') if FENCE.match(line)) % 2 == 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare throughput and chunk sizes of the markdown chunkers.")
+    parser.add_argument("--content-dir", help="content/learning-paths directory of a clone of the arm-learning-paths repository.")
+    parser.add_argument("--synthetic", type=int, default=1000, help="Number of synthetic pages, when --content-dir is not given.")
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--min-tokens", type=int, default=256)
+    parser.add_argument("--overlap-tokens", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per chunker; the fastest is reported.")
+    parser.add_argument("--scaling", type=int, nargs='*', default=[1, 4, 16, 64], help="Numbers of pages concatenated into one page for the scaling table.")
+    args = parser.parse_args()
+
+    if args.content_dir:
+        pages = load_corpus(args.content_dir)
+    else:
+        rng = np.random.default_rng(0)
+        pages = [synthetic_page(rng) for _ in range(args.synthetic)]
+    size = sum(len(page.encode('utf-8')) for page in pages)
+    print(f"Corpus: {len(pages)} pages, {size / 2**20:.1f} MB")
+
+    print(f"{'chunker':>8} {'chunks':>7} {'seconds':>8} {'chunks/s':>9} {'MB/s':>6} {'tok p50':>8} {'tok p95':>8} "
+          f"{'tok max':>8} {'> max':>6} {'open ```':>9}")
+    for name, chunker in chunkers(args).items():
+        chunks, seconds = time_chunker(chunker, pages, args.repeat)
+        tokens = np.array([count_tokens(chunk) for chunk in chunks])
+        print(f"{name:>8} {len(chunks):>7} {seconds:>8.3f} {len(chunks) / seconds:>9.0f} {size / 2**20 / seconds:>6.1f} "
+              f"{np.percentile(tokens, 50):>8.0f} {np.percentile(tokens, 95):>8.0f} {tokens.max():>8} "
+              f"{int((tokens > args.max_tokens).sum()):>6} {sum(map(open_fences, chunks)):>9}")
+
+    print("\nMilliseconds per 100 KB when a page is made of n corpus pages")
+    print(f"{'n':>5} {'KB':>8}" + ''.join(f" {name:>8}" for name in chunkers(args)))
+    for n in args.scaling:
+        page = '\n\n'.join(pages[i % len(pages)] for i in range(n))
+        kb = len(page.encode('utf-8')) / 1024
+        times = [time_chunker(chunker, [page], args.repeat)[1] for chunker in chunkers(args).values()]
+        print(f"{n:>5} {kb:>8.0f}" + ''.join(f" {seconds * 1000 * 100 / kb:>8.2f}" for seconds in times))
+
+
+if __name__ == "__main__":
+    main()
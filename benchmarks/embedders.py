@@ -0,0 +1,97 @@
+"""
+Latency and throughput report for the remote (Copilot API) and local (CPU) embedding backends.
+
+Single-query latency is what a request pays on its critical path; batch throughput is what the
+vectorstore builder gets when embedding the corpus. The remote backend needs a Copilot token in
+GITHUB_TOKEN (or --token) and is skipped without one:
+
+    python benchmarks/embedders.py --metadata vectorstore/chunks/metadata.json
+    python benchmarks/embedders.py --backends local --threads 4 --batch-sizes 1 16 64
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import embedders
+
+SAMPLE_QUERIES = [
+    "How do I enable SVE2 when compiling with GCC?",
+    "What is the difference between Neoverse N1 and V1?",
+    "vld1q_f32",
+    "How can I profile a Python application on an Arm server?",
+    "Which intrinsics load four floats into a NEON register?",
+    "How do I build a multi-architecture Docker image for arm64 and amd64?",
+]
+
+
+def load_texts(metadata_path: str, count: int) -> list:
+    """Chunk texts from the builder's metadata.json, or repeated sample queries when no metadata is given."""
+    if metadata_path:
+        with open(metadata_path, 'r') as f:
+            texts = [item['original_text'] for item in json.load(f)]
+    else:
+        texts = SAMPLE_QUERIES
+    return [texts[i % len(texts)] for i in range(count)]
+
+
+def time_single_queries(embedder, queries: list, headers) -> np.ndarray:
+    """Embed one query per call, as a request does, and return the per-call latencies."""
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        embedder.embed([query], headers)
+        latencies[i] = time.perf_counter() - start
+    return latencies
+
+
+def time_batches(embedder, texts: list, batch_size: int, headers) -> float:
+    """Embed texts batch_size at a time and return the throughput in texts per second."""
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        embedder.embed(texts[i:i + batch_size], headers)
+    return len(texts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare latency and throughput of the remote and local embedding backends.")
+    parser.add_argument("--backends", nargs='+', choices=embedders.BACKENDS, default=embedders.BACKENDS, help="Backends to benchmark.")
+    parser.add_argument("--remote-model", default=embedders.DEFAULT_REMOTE_MODEL, help="Model of the remote backend.")
+    parser.add_argument("--local-model", default=embedders.DEFAULT_LOCAL_MODEL, help="Hugging Face model of the local backend.")
+    parser.add_argument("--no-quantize", action="store_true", help="Run the local model in float32 instead of int8.")
+    parser.add_argument("--threads", type=int, default=embedders.LOCAL_EMBEDDING_THREADS, help="PyTorch threads of the local backend.")
+    parser.add_argument("--token", default=os.getenv("GITHUB_TOKEN"), help="Copilot API token for the remote backend. Defaults to $GITHUB_TOKEN.")
+    parser.add_argument("--metadata", help="metadata.json written by local_vectorstore_creation.py, whose chunk texts are used for the throughput test.")
+    parser.add_argument("--queries", type=int, default=50, help="Number of single-query calls to time.")
+    parser.add_argument("--texts", type=int, default=512, help="Number of texts embedded in the throughput test.")
+    parser.add_argument("--batch-sizes", nargs='+', type=int, default=[1, 16, 64], help="Batch sizes of the throughput test.")
+    args = parser.parse_args()
+
+    headers = {"Authorization": f"Bearer {args.token}", "Copilot-Integration-Id": "vscode-chat"} if args.token else None
+    queries = [SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)] for i in range(args.queries)]
+    texts = load_texts(args.metadata, args.texts)
+
+    print(f"{'backend':<8} {'model':<45} {'dim':>5} {'p50 ms':>8} {'p95 ms':>8} " + ' '.join(f"{f'b={b} txt/s':>11}" for b in args.batch_sizes))
+    for backend in args.backends:
+        if backend == 'remote':
+            if headers is None:
+                print("Skipping the remote backend: set GITHUB_TOKEN or pass --token")
+                continue
+            embedder = embedders.RemoteEmbedder(args.remote_model)
+        else:
+            embedder = embedders.LocalEmbedder(args.local_model, quantize=not args.no_quantize, threads=args.threads)
+
+        # Warm up connections and model weights before timing
+        dimension = embedder.embed(queries[:1], headers).shape[1]
+        latencies = time_single_queries(embedder, queries, headers)
+        throughputs = [time_batches(embedder, texts, batch_size, headers) for batch_size in args.batch_sizes]
+        print(f"{backend:<8} {embedder.model_name:<45} {dimension:>5} {np.percentile(latencies, 50) * 1e3:>8.1f} "
+              f"{np.percentile(latencies, 95) * 1e3:>8.1f} " + ' '.join(f"{t:>11.1f}" for t in throughputs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Recall@k, latency and memory report for the FAISS index types supported by local_vectorstore_creation.py.
+
+Every configuration is compared against an exact flat index built from the same vectors. Use the
+embeddings written by the vectorstore builder, or a synthetic clustered corpus to size a setting
+for a corpus much larger than today's:
+
+    python benchmarks/index_types.py --embeddings vectorstore/chunks/embeddings.emb
+    python benchmarks/index_types.py --synthetic 200000 --dim 1536
+    python benchmarks/index_types.py --synthetic 200000 --types flat sq8 fp16 pq
+
+Configurations with refine_factor > 0 re-rank their candidates with the full-precision vectors of an
+embeddings artifact, as the Flask application does: the --embeddings file itself, or a temporary
+float32 artifact of the synthetic corpus. The memory column is the size of the serialized index,
+which is what a worker holds; the artifact is memory-mapped and only its candidate rows are read.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import index_types
+from utils.embedding_artifact import EmbeddingArtifact, write_embedding_artifact
+from utils.index_manager import RefinedIndex
+
+
+# Search-time settings swept for each index type, without rebuilding the index.
+SWEEPS = {
+    'flat': [{}],
+    'hnsw': [{'efSearch': ef} for ef in (16, 32, 64, 128, 256)],
+    'ivf': [{'nprobe': nprobe} for nprobe in (1, 4, 16, 64)],
+    'ivfpq': [{'nprobe': nprobe, 'refine_factor': 0} for nprobe in (1, 4, 16, 64)] + [{'nprobe': 16, 'refine_factor': 4}],
+    'sq8': [{'refine_factor': factor} for factor in (0, 2)],
+    'fp16': [{'refine_factor': 0}],
+    'pq': [{'refine_factor': factor} for factor in (0, 2, 4, 8)],
+}
+
+
+def synthetic_corpus(num_vectors: int, dimension: int, num_clusters: int = 256, seed: int = 0) -> np.ndarray:
+    """Generate a clustered corpus of unit vectors, which behaves more like text embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((num_clusters, dimension), dtype=np.float32)
+    assignments = rng.integers(0, num_clusters, num_vectors)
+    vectors = centroids[assignments] + rng.standard_normal((num_vectors, dimension), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def make_queries(corpus: np.ndarray, num_queries: int, seed: int = 1) -> np.ndarray:
+    """Perturb random corpus vectors so queries are close to, but not identical with, stored vectors."""
+    rng = np.random.default_rng(seed)
+    queries = corpus[rng.integers(0, len(corpus), num_queries)].copy()
+    queries += 0.1 * rng.standard_normal(queries.shape, dtype=np.float32) / np.sqrt(corpus.shape[1])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(f[f >= 0], t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def time_queries(index, queries: np.ndarray, k: int):
+    """Search one query at a time, as the Flask application does, and return results and per-query latencies."""
+    found = np.empty((len(queries), k), dtype=np.int64)
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, found[i] = index.search(query.reshape(1, -1), k)
+        latencies[i] = time.perf_counter() - start
+    return found, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report recall@k and latency of FAISS index types against the flat baseline.")
+    parser.add_argument("--embeddings", help="Embeddings artifact (embeddings.emb) written by local_vectorstore_creation.py.")
+    parser.add_argument("--synthetic", type=int, default=100000, help="Number of synthetic vectors, used when --embeddings is not given.")
+    parser.add_argument("--dim", type=int, default=1536, help="Dimension of the synthetic vectors.")
+    parser.add_argument("--queries", type=int, default=500, help="Number of queries to time.")
+    parser.add_argument("-k", type=int, default=10, help="Number of neighbours retrieved per query.")
+    parser.add_argument("--types", nargs='+', choices=index_types.INDEX_TYPES, default=index_types.INDEX_TYPES, help="Index types to benchmark.")
+    parser.add_argument("--threads", type=int, default=1, help="FAISS OpenMP threads. Defaults to 1 to match a single request.")
+
+    parser.add_argument("--pq-m", dest="pq_m", type=int, help="Number of PQ sub-quantizers (ivfpq, pq). Must divide the dimension.")
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    if args.embeddings:
+        artifact = EmbeddingArtifact(args.embeddings)
+        corpus = artifact.get(slice(None))
+    else:
+        corpus = synthetic_corpus(args.synthetic, args.dim)
+        artifact_dir = tempfile.TemporaryDirectory()
+        write_embedding_artifact(os.path.join(artifact_dir.name, 'embeddings.emb'), corpus, 'synthetic')
+        artifact = EmbeddingArtifact(os.path.join(artifact_dir.name, 'embeddings.emb'))
+    queries = make_queries(corpus, args.queries)
+    print(f"Corpus: {corpus.shape[0]} vectors of dimension {corpus.shape[1]}, {len(queries)} queries, k={args.k}")
+
+    flat, _ = index_types.build_index(corpus, 'flat')
+    truth, flat_latencies = time_queries(flat, queries, args.k)
+
+    print(f"{'index':<8} {'params':<50} {'build s':>8} {'MB':>8} {'B/vec':>7} {'recall@k':>9} {'mean ms':>8} "
+          f"{'p99 ms':>8} {'QPS':>8} {'speedup':>8}")
+    for index_type in args.types:
+        overrides = {'pq_m': args.pq_m} if args.pq_m and 'pq_m' in index_types.DEFAULT_PARAMS[index_type] else {}
+        start = time.perf_counter()
+        index, config = index_types.build_index(corpus, index_type, **overrides)
+        build_seconds = time.perf_counter() - start
+        index_bytes = faiss.serialize_index(index).nbytes
+        for sweep in SWEEPS[index_type]:
+            config['params'].update(sweep)
+            index_types.apply_search_params(index, config)
+            refine_factor = config['params'].get('refine_factor', 0)
+            searched = RefinedIndex(index, artifact, refine_factor) if refine_factor else index
+            found, latencies = time_queries(searched, queries, args.k)
+            params = ','.join(f"{key}={value}" for key, value in config['params'].items() if value is not None)
+            print(f"{index_type:<8} {params:<50} {build_seconds:>8.2f} {index_bytes / 2**20:>8.1f} "
+                  f"{index_bytes / len(corpus):>7.0f} {recall_at_k(found, truth):>9.3f} "
+                  f"{latencies.mean() * 1e3:>8.3f} {np.percentile(latencies, 99) * 1e3:>8.3f} "
+                  f"{1 / latencies.mean():>8.0f} {flat_latencies.mean() / latencies.mean():>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
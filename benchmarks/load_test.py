@@ -0,0 +1,185 @@
+"""
+Concurrent load driver for the /agent endpoint.
+
+Sends signed /agent requests at several concurrency levels and reports, per level, the p50/p95/p99
+latency of whole answers, the time to first byte, the request rate and the memory of the server
+processes. Run the server against benchmarks/mock_copilot_api.py and a synthetic index from
+benchmarks/synthetic_index.py for reproducible numbers:
+
+    python benchmarks/load_test.py --url http://localhost:8080/agent --signing-key /tmp/bench_key.pem \\
+        --concurrency 1 8 32 --requests 200 --server-pid $(pgrep -o gunicorn)
+
+Use --json to append the results to a file, so runs of different index, serving or caching settings
+can be compared.
+"""
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+QUESTIONS = [
+    "How do I use NEON intrinsics to vectorize a loop?",
+    "What is the difference between SVE and SVE2?",
+    "How do I build a Docker image for Graviton?",
+    "Which compiler flags should I use for Neoverse V2?",
+    "How can I profile cache misses with perf on Arm?",
+    "How do I run Kubernetes on Arm-based instances?",
+    "What is the memory bandwidth of a Graviton4 core?",
+    "How do I port x86 SSE code to Arm?",
+]
+
+
+def process_memory(pid: int) -> dict:
+    """Return the RSS and PSS in bytes of a process and all its descendants, from /proc (Linux only)."""
+    pids = [pid]
+    for parent in pids:
+        for task in os.listdir(f"/proc/{parent}/task"):
+            try:
+                with open(f"/proc/{parent}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+    memory = {'processes': len(pids), 'rss': 0, 'pss': 0}
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/smaps_rollup") as f:
+                for line in f:
+                    name, value = line.split(':', 1)
+                    if name in ('Rss', 'Pss'):
+                        memory[name.lower()] += int(value.split()[0]) * 1024
+        except OSError:
+            pass
+    return memory
+
+
+class Client:
+    """Sends signed /agent requests with a kept-alive connection per thread."""
+
+    def __init__(self, url: str, signing_key, token: str, timeout: float):
+        self.url = url
+        self.signing_key = signing_key
+        self.token = token
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def request(self, question: str) -> dict:
+        """Send one question and return its status, time to first byte, latency and size."""
+        body = json.dumps({
+            'messages': [{'role': 'user', 'content': question}],
+            'copilot_thread_id': uuid.uuid4().hex,
+        }).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Token': self.token,
+            'Copilot-Integration-Id': 'load-test',
+            'Github-Public-Key-Signature': base64.b64encode(self.signing_key.sign(body, ec.ECDSA(hashes.SHA256()))).decode('ascii'),
+        }
+        started = time.perf_counter()
+        ttfb = None
+        size = 0
+        try:
+            with self._session().post(self.url, data=body, headers=headers, stream=True, timeout=self.timeout) as r:
+                for chunk in r.iter_content(chunk_size=None):
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - started
+                    size += len(chunk)
+                status = r.status_code
+        except requests.RequestException:
+            status = None
+        return {'status': status, 'ttfb': ttfb, 'latency': time.perf_counter() - started, 'bytes': size}
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': p50, 'p95': p95, 'p99': p99}
+
+
+def run_level(client: Client, concurrency: int, num_requests: int, questions: list, server_pid: int = None) -> dict:
+    """Send num_requests questions with concurrency requests in flight and summarize them."""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Warm up every thread's connection and the server's caches of the first questions
+        list(executor.map(client.request, questions[:concurrency]))
+        started = time.perf_counter()
+        results = list(executor.map(client.request, [questions[i % len(questions)] for i in range(num_requests)]))
+        elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r['status'] == 200]
+    return {
+        'concurrency': concurrency,
+        'requests': num_requests,
+        'errors': num_requests - len(ok),
+        'rps': len(ok) / elapsed,
+        'latency': percentiles([r['latency'] for r in ok]),
+        'ttfb': percentiles([r['ttfb'] for r in ok if r['ttfb'] is not None]),
+        'bytes': float(np.mean([r['bytes'] for r in ok])) if ok else 0.0,
+        'memory': process_memory(server_pid) if server_pid else None,
+    }
+
+
+def print_report(levels: list):
+    ms = lambda value: f"{value * 1000:8.1f}" if value is not None else f"{'-':>8}"
+    print(f"{'conc':>5} {'reqs':>6} {'errors':>6} {'rps':>8} {'lat p50':>8} {'lat p95':>8} {'lat p99':>8} "
+          f"{'ttfb p50':>8} {'ttfb p95':>8} {'ttfb p99':>8} {'rss MB':>8} {'pss MB':>8}")
+    for level in levels:
+        memory = level['memory'] or {}
+        mb = lambda name: f"{memory[name] / 2**20:8.0f}" if name in memory else f"{'-':>8}"
+        print(f"{level['concurrency']:>5} {level['requests']:>6} {level['errors']:>6} {level['rps']:>8.1f} "
+              f"{ms(level['latency']['p50'])} {ms(level['latency']['p95'])} {ms(level['latency']['p99'])} "
+              f"{ms(level['ttfb']['p50'])} {ms(level['ttfb']['p95'])} {ms(level['ttfb']['p99'])} {mb('rss')} {mb('pss')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive /agent with concurrent signed requests and report latency, TTFB, RPS and memory.")
+    parser.add_argument("--url", default="http://localhost:8080/agent", help="URL of the /agent endpoint.")
+    parser.add_argument("--signing-key", default="bench_signing_key.pem", help="PEM private key written by mock_copilot_api.py.")
+    parser.add_argument("--token", default="benchmark", help="Value of the X-GitHub-Token header, passed through to the Copilot API.")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 8, 32], help="Concurrency levels to run.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level.")
+    parser.add_argument("--questions", help="File with one question per line. Defaults to a few built-in questions.")
+    parser.add_argument("--unique", action="store_true", help="Make every question unique, so no embedding or answer cache hits.")
+    parser.add_argument("--server-pid", type=int, help="PID of the server (the gunicorn master) whose memory, with its workers, is reported.")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout of a single request in seconds.")
+    parser.add_argument("--label", default="", help="Label of this configuration in the --json output.")
+    parser.add_argument("--json", help="Append the results to this JSON lines file.")
+    args = parser.parse_args()
+
+    with open(args.signing_key, 'rb') as f:
+        signing_key = serialization.load_pem_private_key(f.read(), password=None)
+    questions = QUESTIONS
+    if args.questions:
+        with open(args.questions) as f:
+            questions = [line.strip() for line in f if line.strip()]
+    if args.unique:
+        questions = [f"{questions[i % len(questions)]} ({i})" for i in range(args.requests + max(args.concurrency))]
+
+    client = Client(args.url, signing_key, args.token, args.timeout)
+    levels = []
+    for concurrency in args.concurrency:
+        print(f"Running {args.requests} requests at concurrency {concurrency}")
+        levels.append(run_level(client, concurrency, args.requests, questions, args.server_pid))
+    print_report(levels)
+
+    if args.json:
+        with open(args.json, 'a') as f:
+            for level in levels:
+                f.write(json.dumps(dict(level, label=args.label)) + '\n')
+
+
+if __name__ == "__main__":
+    main()
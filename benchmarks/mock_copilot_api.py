@@ -0,0 +1,155 @@
+"""
+Local stand-in for the Copilot API, to benchmark the extension without calling api.githubcopilot.com.
+
+Serves the endpoints the extension calls, with configurable latency and streaming rate:
+
+    POST /embeddings                         embeddings near the clusters of benchmarks/synthetic_index.py
+    POST /chat/completions                   a streamed completion, as server-sent events
+    GET  /meta/public_keys/copilot_api       the public key that requests to /agent are signed with
+
+The private key is written to --signing-key, so benchmarks/load_test.py can sign its requests.
+Start the extension with the API pointed at the mock:
+
+    python benchmarks/mock_copilot_api.py --port 9000 --dim 1536 --signing-key /tmp/bench_key.pem
+    COPILOT_API_URL=http://localhost:9000 \\
+    COPILOT_PUBLIC_KEYS_URL=http://localhost:9000/meta/public_keys/copilot_api \\
+    WEBHOOK_SECRET=benchmark gunicorn -c gunicorn.conf.py flask_app:app
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_index import VOCABULARY, near_centroids, synthetic_centroids
+
+
+def load_signing_key(path: str):
+    """Load the ECDSA signing key from path, generating and saving a new one if it does not exist."""
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return serialization.load_pem_private_key(f.read(), password=None)
+    key = ec.generate_private_key(ec.SECP256R1())
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    print(f"Wrote new signing key to {path}")
+    return key
+
+
+class MockCopilotHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set by main()
+    options = None
+    centroids = None
+    public_keys = None
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+    def send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/meta/public_keys/copilot_api':
+            return self.send_json(self.public_keys)
+        self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        request = self.read_json()
+        if self.path == '/embeddings':
+            return self.embeddings(request)
+        if self.path == '/chat/completions':
+            return self.chat_completions(request)
+        self.send_json({'error': 'not found'}, 404)
+
+    def embeddings(self, request: dict):
+        texts = request.get('input', [])
+        texts = [texts] if isinstance(texts, str) else texts
+        time.sleep((self.options.embedding_latency_ms + self.options.embedding_latency_per_text_ms * len(texts)) / 1000)
+        data = []
+        for i, text in enumerate(texts):
+            # The same text always gets the same embedding, near one of the synthetic index's clusters
+            seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+            vector = near_centroids(self.centroids, np.random.default_rng(seed), 1)[0]
+            data.append({'object': 'embedding', 'index': i, 'embedding': vector.tolist()})
+        self.send_json({'object': 'list', 'data': data, 'model': request.get('model'), 'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def chat_completions(self, request: dict):
+        options = self.options
+        time.sleep(options.first_token_ms / 1000)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        rng = np.random.default_rng()
+        interval = 1.0 / options.tokens_per_second if options.tokens_per_second > 0 else 0.0
+        started = time.perf_counter()
+        for i in range(options.completion_tokens):
+            event = {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': request.get('model'),
+                'choices': [{'index': 0, 'delta': {'content': VOCABULARY[rng.integers(len(VOCABULARY))] + ' '}, 'finish_reason': None}],
+            }
+            self.write_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            # Sleep until the next token is due, so the rate holds regardless of write time
+            delay = started + (i + 1) * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        done = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'model': request.get('model'),
+                'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+        self.write_chunk(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode('utf-8'))
+        self.write_chunk(b"")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Copilot API endpoints used by the extension.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension, as given to synthetic_index.py.")
+    parser.add_argument("--clusters", type=int, default=256, help="Number of clusters, as given to synthetic_index.py.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, as given to synthetic_index.py.")
+    parser.add_argument("--embedding-latency-ms", type=float, default=30, help="Latency of every /embeddings call.")
+    parser.add_argument("--embedding-latency-per-text-ms", type=float, default=0.5, help="Added latency per embedded text.")
+    parser.add_argument("--first-token-ms", type=float, default=300, help="Time before a completion starts streaming.")
+    parser.add_argument("--tokens-per-second", type=float, default=80, help="Streaming rate of completions. 0 streams as fast as possible.")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="Number of tokens in every completion.")
+    parser.add_argument("--signing-key", default="bench_signing_key.pem", help="PEM file holding the key that load_test.py signs requests with. Created if missing.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+
+    public_key = load_signing_key(args.signing_key).public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii')
+    MockCopilotHandler.options = args
+    MockCopilotHandler.centroids = synthetic_centroids(args.clusters, args.dim, args.seed)
+    MockCopilotHandler.public_keys = {'public_keys': [{'key_identifier': 'mock', 'key': public_key, 'is_current': True}]}
+
+    # The default listen backlog of 5 refuses connections under concurrent load
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer((args.host, args.port), MockCopilotHandler)
+    server.daemon_threads = True
+    print(f"Mock Copilot API listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Offline evaluation of the re-ranking stage: context tokens saved against hit rate.
+
+Each question is answered by retrieval alone (the baseline) and by several re-ranking settings. A
+question is a hit when the page it is about is among the chunks sent to the LLM. Questions come from a
+JSONL file with "question" and "url" fields, or are generated from the opening words of sampled chunks:
+
+    python benchmarks/reranking.py --index-dir vectorstore/chunks --eval-set questions.jsonl
+    python benchmarks/reranking.py --index-dir vectorstore/chunks --questions 200 --cross-encoder cross-encoder/ms-marco-MiniLM-L-6-v2
+
+Queries are embedded with the backend recorded in the index config; the remote backend needs a Copilot
+token in GITHUB_TOKEN (or --token).
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.reranking import Reranker
+from utils.tokens import count_tokens
+
+# (label, mmr_lambda, candidates, max_similarity)
+SETTINGS = [
+    ('mmr 0.7', 0.7, 3, None),
+    ('mmr 0.5', 0.5, 3, None),
+    ('mmr 0.3', 0.3, 3, None),
+    ('mmr 0.5 sim<0.90', 0.5, 3, 0.90),
+    ('mmr 0.5 sim<0.85', 0.5, 3, 0.85),
+]
+
+
+def load_eval_set(eval_set_path: str, metadata, num_questions: int, seed: int = 0) -> list:
+    """Return (question, expected URL) pairs from a JSONL file, or generated from random chunks."""
+    if eval_set_path:
+        with open(eval_set_path, 'r') as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        return [(item['question'], item['url']) for item in items]
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(metadata), min(num_questions, len(metadata)), replace=False)
+    return [(' '.join(metadata[int(row)]['original_text'].split()[:30]), metadata[int(row)]['url']) for row in rows]
+
+
+def context_tokens(results: list) -> int:
+    return sum(count_tokens(result['metadata']['original_text']) for result in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report context tokens saved and hit rate of re-ranking settings against plain retrieval.")
+    parser.add_argument("--index-dir", default="vectorstore/chunks", help="Directory holding faiss_index.bin, metadata and embeddings.emb.")
+    parser.add_argument("--eval-set", help="JSONL file of {\"question\": ..., \"url\": ...} lines. Generated from the chunks when not given.")
+    parser.add_argument("--questions", type=int, default=100, help="Number of generated questions.")
+    parser.add_argument("-k", type=int, default=3, help="Number of chunks sent to the LLM (AMOUNT_OF_CONTEXT_TO_USE).")
+    parser.add_argument("--cross-encoder", help="Also evaluate MMR on top of this local cross-encoder model.")
+    parser.add_argument("--token", default=os.getenv("GITHUB_TOKEN"), help="Copilot API token for remote query embeddings. Defaults to $GITHUB_TOKEN.")
+    args = parser.parse_args()
+
+    # The vectorstore module loads the index from the working directory on import
+    os.chdir(args.index_dir)
+    from utils import vectorstore_functions as vs
+
+    headers = {"Authorization": f"Bearer {args.token}", "Copilot-Integration-Id": "vscode-chat"} if args.token else None
+    questions = load_eval_set(args.eval_set, vs.FAISS_METADATA, args.questions)
+    rerankers = [(label, Reranker(mmr_lambda, candidates, max_similarity)) for label, mmr_lambda, candidates, max_similarity in SETTINGS]
+    if args.cross_encoder:
+        rerankers.append(('cross-encoder + mmr 0.5', Reranker(0.5, 3, None, args.cross_encoder)))
+    max_candidates = args.k * max(reranker.candidates for _, reranker in rerankers)
+
+    totals = {label: {'hits': 0, 'chunks': 0, 'tokens': 0} for label in ['baseline'] + [label for label, _ in rerankers]}
+    for question, url in questions:
+        query_embedding, candidates = vs.retrieve(question, max_candidates, headers)
+        embeddings = vs.result_embeddings(candidates) if candidates else None
+        selections = [('baseline', candidates[:args.k])]
+        for label, reranker in rerankers:
+            pool = candidates[:args.k * reranker.candidates]
+            selections.append((label, reranker.rerank(question, query_embedding, pool, embeddings[:len(pool)], args.k) if pool else []))
+        for label, selected in selections:
+            totals[label]['hits'] += any(result['metadata']['url'] == url for result in selected)
+            totals[label]['chunks'] += len(selected)
+            totals[label]['tokens'] += context_tokens(selected)
+
+    baseline_tokens = totals['baseline']['tokens']
+    print(f"{len(questions)} questions, k={args.k}")
+    print(f"{'setting':<26} {'hit rate':>9} {'chunks':>7} {'tokens':>8} {'saved':>7}")
+    for label, total in totals.items():
+        print(f"{label:<26} {total['hits'] / len(questions):>9.3f} {total['chunks'] / len(questions):>7.2f} "
+              f"{total['tokens'] / len(questions):>8.0f} {(1 - total['tokens'] / baseline_tokens if baseline_tokens else 0.0):>6.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+CPU cost and write count of relaying a streamed completion, for several flush policies of utils/stream_manipulation.py.
+
+Streams completions from an in-process benchmarks/mock_copilot_api.py server and relays them the way
+agent_flow does, without a Flask client in between. "bytes" is the previous relay, which read the
+upstream response one byte at a time; the other policies read whatever each socket read returns:
+
+    python benchmarks/streaming.py --completion-tokens 2000 --streams 20
+    python benchmarks/streaming.py --tokens-per-second 80 --completion-tokens 200 --streams 3
+
+CPU is the time spent by the relaying thread only, so the mock server does not count. With
+--tokens-per-second 0 the mock streams as fast as it can, which shows the cost per token; at a real
+token rate, the writes column shows how many writes a coalescing policy saves.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mock_copilot_api import MockCopilotHandler
+from utils.stream_manipulation import SSERelay
+
+
+def policies(args) -> dict:
+    """Name -> function relaying a requests response, returning its writes and the number of events."""
+    def relay(response, **options):
+        relay = SSERelay(**options)
+        return list(relay.relay(response.iter_content(chunk_size=None))), relay.events if relay.sse_framing else None
+
+    return {
+        'bytes': lambda response: ([chunk for chunk in response.iter_content() if chunk], None),
+        'raw': lambda response: relay(response, sse_framing=False),
+        'events': lambda response: relay(response, sse_framing=True),
+        f'{args.flush_bytes}B': lambda response: relay(response, flush_bytes=args.flush_bytes, sse_framing=True),
+        f'{args.flush_ms:g}ms': lambda response: relay(response, flush_ms=args.flush_ms, sse_framing=True),
+    }
+
+
+def start_mock(args) -> str:
+    """Serve the mock Copilot API on a free local port in a background thread and return its URL."""
+    MockCopilotHandler.options = argparse.Namespace(first_token_ms=0, tokens_per_second=args.tokens_per_second,
+                                                    completion_tokens=args.completion_tokens, verbose=False)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockCopilotHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/chat/completions"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU per token and writes per stream of the streaming relay policies.")
+    parser.add_argument("--completion-tokens", type=int, default=2000, help="Tokens in every streamed completion.")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Streaming rate of the mock. 0 streams as fast as possible.")
+    parser.add_argument("--streams", type=int, default=10, help="Completions relayed per policy.")
+    parser.add_argument("--flush-bytes", type=int, default=4096, help="Byte limit of the coalescing policy.")
+    parser.add_argument("--flush-ms", type=float, default=50, help="Time limit of the time-based coalescing policy.")
+    args = parser.parse_args()
+
+    url = start_mock(args)
+    session = requests.Session()
+    print(f"{args.streams} streams of {args.completion_tokens} tokens at "
+          f"{args.tokens_per_second or 'unlimited'} tokens/s")
+    print(f"{'policy':>8} {'CPU us/token':>13} {'writes':>8} {'events':>8} {'bytes/write':>12} {'MB/s':>8}")
+    for name, relay in policies(args).items():
+        cpu, wall, writes, sizes, events = 0.0, 0.0, [], [], []
+        for _ in range(args.streams):
+            response = session.post(url, json={'model': 'mock', 'messages': []}, stream=True)
+            start_cpu, start_wall = time.thread_time(), time.perf_counter()
+            chunks, stream_events = relay(response)
+            cpu += time.thread_time() - start_cpu
+            wall += time.perf_counter() - start_wall
+            writes.append(len(chunks))
+            sizes.append(sum(map(len, chunks)))
+            events.append(stream_events)
+        tokens = args.streams * args.completion_tokens
+        events = f"{np.mean(events):.0f}" if events[0] is not None else "-"
+        print(f"{name:>8} {cpu / tokens * 1e6:>13.2f} {np.mean(writes):>8.0f} {events:>8} "
+              f"{sum(sizes) / sum(writes):>12.0f} {sum(sizes) / 2**20 / wall:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Generate a synthetic vector store in the format written by vectorstore/local_vectorstore_creation.py.
+
+Vectors are drawn around random cluster centroids, like text embeddings, and every chunk gets synthetic
+metadata of realistic size. Vectors and metadata are generated and written in batches, so stores of
+10M vectors are written in constant memory apart from the FAISS index itself:
+
+    python benchmarks/synthetic_index.py --vectors 100000 --out /tmp/bench_index
+    python benchmarks/synthetic_index.py --vectors 10000000 --dim 768 --index-type ivfpq --pq-m 96 --out /tmp/bench_10m
+
+Queries embedded by benchmarks/mock_copilot_api.py with the same --dim, --clusters and --seed land
+near the same centroids, so searches return realistic neighbours.
+"""
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import index_types
+from utils.embedders import DEFAULT_REMOTE_MODEL
+from utils.embedding_artifact import DTYPES, EmbeddingArtifact, write_embedding_artifact
+from utils.lexical_index import build_lexical_index, save_lexical_index
+from utils.metadata_filters import build_filter_bitmaps, save_filter_bitmaps
+from utils.metadata_store import write_metadata_store
+
+BLOCK_SIZE = 10000
+VOCABULARY = [
+    'neon', 'sve', 'sve2', 'graviton', 'neoverse', 'cortex', 'intrinsic', 'vector', 'register', 'cache',
+    'latency', 'throughput', 'compiler', 'gcc', 'llvm', 'kernel', 'linux', 'docker', 'kubernetes', 'python',
+    'memory', 'bandwidth', 'thread', 'core', 'instruction', 'load', 'store', 'branch', 'profile', 'perf',
+    'benchmark', 'optimize', 'build', 'deploy', 'server', 'cloud', 'instance', 'container', 'library', 'function',
+]
+
+
+def synthetic_centroids(num_clusters: int, dimension: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((num_clusters, dimension), dtype=np.float32)
+
+
+def near_centroids(centroids: np.ndarray, rng, count: int) -> np.ndarray:
+    """Draw unit vectors around randomly picked centroids."""
+    vectors = centroids[rng.integers(0, len(centroids), count)] + rng.standard_normal((count, centroids.shape[1]), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+class SyntheticEmbeddings:
+    """
+    A (count, dimension) matrix of clustered unit vectors, generated block by block when sliced.
+
+    Every block of BLOCK_SIZE rows is seeded by its position, so the same rows are generated however
+    the matrix is sliced, without keeping it in memory.
+    """
+
+    def __init__(self, count: int, dimension: int, num_clusters: int = 256, seed: int = 0):
+        self.shape = (count, dimension)
+        self.seed = seed
+        self.centroids = synthetic_centroids(num_clusters, dimension, seed)
+
+    def _block(self, block: int) -> np.ndarray:
+        rng = np.random.default_rng([self.seed, block])
+        return near_centroids(self.centroids, rng, min(BLOCK_SIZE, self.shape[0] - block * BLOCK_SIZE))
+
+    def __getitem__(self, rows: slice) -> np.ndarray:
+        start, stop, _ = rows.indices(self.shape[0])
+        if stop <= start:
+            return np.empty((0, self.shape[1]), dtype=np.float32)
+        blocks = [self._block(block) for block in range(start // BLOCK_SIZE, (stop - 1) // BLOCK_SIZE + 1)]
+        offset = (start // BLOCK_SIZE) * BLOCK_SIZE
+        return np.vstack(blocks)[start - offset:stop - offset]
+
+
+class SyntheticMetadata:
+    """The metadata of count chunks, chunks_per_page to a page, generated one record at a time."""
+
+    def __init__(self, count: int, chunks_per_page: int = 5, words: int = 150, seed: int = 0):
+        self.count = count
+        self.chunks_per_page = chunks_per_page
+        self.words = words
+        self.seed = seed
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        for start in range(0, self.count, BLOCK_SIZE):
+            words = rng.integers(0, len(VOCABULARY), (min(BLOCK_SIZE, self.count - start), self.words))
+            for offset, row in enumerate(words):
+                i = start + offset
+                page = i // self.chunks_per_page
+                yield {
+                    'uuid': f"{i:032x}",
+                    'url': f"https://learn.example.com/learning-paths/category-{page % 8}/page-{page}/",
+                    'original_text': ' '.join(VOCABULARY[w] for w in row),
+                    'title': f"Synthetic page {page}",
+                    'keywords': ', '.join(VOCABULARY[w] for w in row[:3]),
+                    'chunk_number': i,
+                }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic vector store of the given size for benchmarks.")
+    parser.add_argument("--vectors", type=int, default=100000, help="Number of chunks.")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension. 1536 matches text-embedding-ada-002.")
+    parser.add_argument("--clusters", type=int, default=256, help="Number of clusters the vectors are drawn around.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, shared with mock_copilot_api.py.")
+    parser.add_argument("--chunks-per-page", type=int, default=5, help="Number of chunks sharing a page URL.")
+    parser.add_argument("--words", type=int, default=150, help="Words of text per chunk.")
+    parser.add_argument("--index-type", choices=index_types.INDEX_TYPES, default='flat', help="FAISS index type.")
+    parser.add_argument("--nlist", type=int, help="Number of IVF lists (ivf, ivfpq).")
+    parser.add_argument("--M", type=int, help="Number of neighbours per HNSW node (hnsw).")
+    parser.add_argument("--pq-m", dest="pq_m", type=int, help="Number of PQ sub-quantizers (ivfpq, pq).")
+    parser.add_argument("--refine-factor", dest="refine_factor", type=int, help="Candidates re-ranked with embeddings.emb per result (ivfpq, sq8, fp16, pq).")
+    parser.add_argument("--shards", type=int, default=1, help="Number of index shards.")
+    parser.add_argument("--embeddings-dtype", choices=DTYPES, default='float32', help="Storage type of embeddings.emb.")
+    parser.add_argument("--lexical-index", action="store_true", help="Also build lexical_index.npz, which holds every chunk's postings in memory while building.")
+    parser.add_argument("--out", required=True, help="Directory to write the vector store to.")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    path = lambda name: os.path.join(args.out, name)
+    started = time.perf_counter()
+
+    print(f"Writing {args.vectors} synthetic embeddings of dimension {args.dim}")
+    embeddings = SyntheticEmbeddings(args.vectors, args.dim, args.clusters, args.seed)
+    write_embedding_artifact(path('embeddings.emb'), embeddings, DEFAULT_REMOTE_MODEL, args.embeddings_dtype)
+
+    print("Writing metadata store")
+    metadata = SyntheticMetadata(args.vectors, args.chunks_per_page, args.words, args.seed)
+    write_metadata_store(metadata, path('metadata.bin'))
+    np.save(path('chunk_urls.npy'), (np.arange(args.vectors) // args.chunks_per_page).astype(np.int32))
+    print("Writing filter bitmaps")
+    save_filter_bitmaps(build_filter_bitmaps(metadata), path('filter_bitmaps.npz'))
+    if args.lexical_index:
+        print("Building lexical index")
+        save_lexical_index(build_lexical_index(list(metadata)), path('lexical_index.npz'))
+
+    print(f"Building {args.index_type} index")
+    params = {key: value for key, value in {'nlist': args.nlist, 'M': args.M, 'pq_m': args.pq_m, 'refine_factor': args.refine_factor}.items() if value is not None}
+    artifact = EmbeddingArtifact(path('embeddings.emb'))
+    if args.shards > 1:
+        shards, index_config = index_types.build_shards_from_artifact(artifact, args.index_type, args.shards, **params)
+        for shard, entry in zip(shards, index_config['shards']):
+            faiss.write_index(shard, path(entry['file']))
+    else:
+        index, index_config = index_types.build_index_from_artifact(artifact, args.index_type, **params)
+        faiss.write_index(index, path('faiss_index.bin'))
+    index_config['embedding'] = {'backend': 'remote', 'model': DEFAULT_REMOTE_MODEL}
+    index_types.save_index_config(index_config, path('index_config.json'))
+    print(f"Wrote synthetic vector store to {args.out} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
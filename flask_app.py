@@ -7,6 +7,14 @@ from utils import payload_validation as pv
 from pathlib import Path
 import uuid
 from utils import agent_functions
+from utils import upstream
+from utils import observability
+from utils.answer_cache import AnswerCache
+from utils.reranking import Reranker
+from utils.prompt_packing import PromptPacker
+from utils.thread_memory import ThreadMemory
+
+logger = observability.get_logger(__name__)
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -21,42 +29,101 @@ PUBLIC_KEY = pv.fetch_public_key()
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 MODEL_NAME = "gpt-4o"
 
-AMOUNT_OF_CONTEXT_TO_USE = 3
+# Maximum number of chunks retrieved for the prompt. With a token budget, fewer are sent if they do not fit.
+AMOUNT_OF_CONTEXT_TO_USE = int(os.getenv("MAX_CONTEXT_CHUNKS", "3"))
+
+# Prompts are packed into PROMPT_TOKEN_BUDGET tokens, keeping up to HISTORY_TOKEN_BUDGET tokens of earlier
+# messages. Set PROMPT_TOKEN_BUDGET=0 to send all retrieved chunks and the whole conversation.
+PROMPT_PACKER = None
+if int(os.getenv("PROMPT_TOKEN_BUDGET", "8000")) > 0:
+    PROMPT_PACKER = PromptPacker(
+        token_budget=int(os.getenv("PROMPT_TOKEN_BUDGET", "8000")),
+        history_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "2000")),
+    )
+
+# Optional semantic answer cache, enabled by setting ANSWER_CACHE_SIZE to a positive number.
+ANSWER_CACHE = None
+if int(os.getenv("ANSWER_CACHE_SIZE", "0")) > 0:
+    ANSWER_CACHE = AnswerCache(
+        max_entries=int(os.getenv("ANSWER_CACHE_SIZE")),
+        ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+        radius=float(os.getenv("ANSWER_CACHE_RADIUS", "0.05")),
+    )
+
+# Retrieval state of recent conversations, so follow-up questions are searched in context.
+# Enabled by setting THREAD_MEMORY_SIZE to a positive number, THREAD_MEMORY_PATH shares it between workers through SQLite.
+THREAD_MEMORY = None
+if int(os.getenv("THREAD_MEMORY_SIZE", "0")) > 0:
+    THREAD_MEMORY = ThreadMemory(
+        max_threads=int(os.getenv("THREAD_MEMORY_SIZE")),
+        ttl_seconds=float(os.getenv("THREAD_MEMORY_TTL", "3600")),
+        disk_path=os.getenv("THREAD_MEMORY_PATH"),
+        followup_weight=float(os.getenv("FOLLOWUP_QUERY_WEIGHT", "0.6")),
+        reuse_similarity=float(os.getenv("FOLLOWUP_REUSE_SIMILARITY", "0.95")),
+    )
+
+# Optional re-ranking of retrieved chunks, enabled by setting RERANK_MMR_LAMBDA.
+RERANKER = None
+if os.getenv("RERANK_MMR_LAMBDA"):
+    RERANKER = Reranker(
+        mmr_lambda=float(os.getenv("RERANK_MMR_LAMBDA")),
+        candidates=int(os.getenv("RERANK_CANDIDATES", "3")),
+        max_similarity=float(os.getenv("RERANK_MAX_SIMILARITY")) if os.getenv("RERANK_MAX_SIMILARITY") else None,
+        cross_encoder_model=os.getenv("RERANK_CROSS_ENCODER"),
+    )
+
 @app.route('/health')
 def health():
     return Response(status=200)
 
 
+@app.route('/metrics')
+def metrics():
+    response = observability.metrics_response()
+    if response is None:
+        return "prometheus_client is not installed", 501
+    body, content_type = response
+    return Response(body, content_type=content_type)
+
+
 @app.route('/agent', methods=['POST'])
 def agent():
+    observability.start_trace()
+
     # Extract headers
     sig = request.headers.get('Github-Public-Key-Signature')
     api_token = request.headers.get('X-GitHub-Token')
     integration_id = request.headers.get('Copilot-Integration-Id')
-    print(f"Received headers: sig={sig}, api_token={api_token}, integration_id={integration_id}")
+    logger.debug(f"Received /agent request: integration_id={integration_id}, signed={sig is not None}, token={api_token is not None}")
 
     # Read request body
     body = request.get_data()
 
     # Validate payload signature
-    if not pv.valid_payload(body, sig, PUBLIC_KEY):
+    with observability.span('verify_signature'):
+        valid = pv.valid_payload(body, sig, PUBLIC_KEY)
+    if not valid:
+        observability.REQUESTS.labels('invalid_signature').inc()
         return "Invalid payload signature", 401
 
     # Parse request body
     try:
         req = json.loads(body)
-        print(req)
     except json.JSONDecodeError:
+        observability.REQUESTS.labels('bad_request').inc()
         return "Invalid JSON in request body", 400
 
     if 'messages' not in req:
+        observability.REQUESTS.labels('bad_request').inc()
         return "Missing 'messages' field in request body", 400
 
     messages = req['messages']
     thread_id = req['copilot_thread_id']
+    trace_id = observability.trace_thread(thread_id)
+    logger.debug(f"Request has {len(messages)} message(s)")
 
     # Prepare the request to GitHub Copilot API
-    copilot_url = "https://api.githubcopilot.com/chat/completions"
+    copilot_url = f"{upstream.COPILOT_API_URL}/chat/completions"
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
@@ -73,14 +140,19 @@ def agent():
                                 agent_functions.SYSTEM_MESSAGE,
                                 MODEL_NAME,
                                 copilot_url,
-                                headers
+                                headers,
+                                ANSWER_CACHE,
+                                RERANKER,
+                                PROMPT_PACKER,
+                                THREAD_MEMORY
                             ),  
-                            mimetype='application/json')
+                            mimetype='application/json',
+                            headers={'X-Trace-Id': trace_id})
 
 @app.route('/marketplace', methods=['POST'])
 def marketplace():
     payload_body = request.get_data()
-    print(payload_body)
+    logger.debug(f"Received marketplace event of {len(payload_body)} bytes")
 
     # Verify request has JSON content
     if not request.is_json:
@@ -92,10 +164,6 @@ def marketplace():
         # Get JSON payload
         payload = request.get_json()
         
-        # Print the payload
-        print("Received payload:")
-        print(json.dumps(payload, indent=2))
-        
         output_dir = Path('marketplace_events')
         
         # Generate unique filename and save
@@ -105,7 +173,7 @@ def marketplace():
         with open(file_path, 'w') as f:
             json.dump(payload, f, indent=2)
             
-        print(f"Saved payload to {file_path}")
+        logger.info(f"Saved marketplace event to {file_path}")
         
         return jsonify({
             'status': 'success',
@@ -121,20 +189,17 @@ def marketplace():
 
 @app.route("/auth/authorization")
 def authorization():
-    print("Starting authorization process")
+    logger.info("Starting authorization process")
     github = OAuth2Session(CLIENT_ID, redirect_uri="https://copilot.armdevtechapi.com/auth/callback")
     authorization_url, state = github.authorization_url(AUTHORIZATION_BASE_URL)
     session["oauth_state"] = state
-    print(f"Generated authorization URL: {authorization_url}")
-    print(f"State: {state}")
+    logger.debug(f"Generated authorization URL: {authorization_url}")
     return redirect(authorization_url)
 
 
 @app.route("/auth/callback")
 def callback():
-    print("Received callback from GitHub")
-    print(f"Request URL: {request.url}")
-    print(f"Session state: {session.get('oauth_state')}")
+    logger.info("Received callback from GitHub")
 
     if 'oauth_state' not in session:
         return redirect(url_for('authorization'))
@@ -143,10 +208,9 @@ def callback():
 
     try:
         token = github.fetch_token(TOKEN_URL, client_secret=CLIENT_SECRET, authorization_response=request.url)
-        print("Successfully fetched token")
-        print(f"Token: {token}")
+        logger.info("Successfully fetched token")
         session["oauth_token"] = token
         return redirect("https://github.com/arm/copilot-extension/tree/master?tab=readme-ov-file#arm-copilot-extension")
     except Exception as e:
-        print(f"Error fetching token: {str(e)}")
+        logger.error(f"Error fetching token: {str(e)}")
         return f"Authentication failed. Error: {str(e)}"
\ No newline at end of file
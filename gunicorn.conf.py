@@ -0,0 +1,60 @@
+"""
+Production server configuration.
+
+The application, including the FAISS index and metadata, is loaded once in the master process and the
+workers are forked from it, so they share the loaded pages copy-on-write instead of each loading its
+own copy. Run from the directory holding the vector store files:
+
+    gunicorn -c gunicorn.conf.py flask_app:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi_app:app
+
+WEB_CONCURRENCY (workers) and FAISS_OMP_THREADS (search threads per worker) are sized together so
+that workers x threads does not exceed SERVER_CORES; set one and the other is derived. /metrics reports
+the metrics of all workers together.
+"""
+import os
+import sys
+import tempfile
+
+# Workers write their metrics to files in this directory, which /metrics aggregates. It must be set before
+# prometheus_client is imported.
+if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus_")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from utils import observability, serving
+
+
+def optional_int(name: str):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+workers, search_threads = serving.worker_layout(
+    optional_int("SERVER_CORES"), optional_int("WEB_CONCURRENCY"), optional_int("FAISS_OMP_THREADS")
+)
+
+# Read by OpenMP and by utils.embedders when the application is imported, so the master never starts more threads than a worker may use
+os.environ.setdefault("OMP_NUM_THREADS", str(search_threads))
+os.environ.setdefault("LOCAL_EMBEDDING_THREADS", str(search_threads))
+
+bind = os.getenv("BIND", "0.0.0.0:8080")
+preload_app = True
+# Each streamed answer holds a thread of a synchronous worker for its whole duration
+worker_class = os.getenv("SERVER_WORKER_CLASS", "gthread")
+threads = int(os.getenv("SERVER_THREADS", "16"))
+graceful_timeout = 60
+
+
+def when_ready(server):
+    server.log.info(f"Serving with {workers} workers x {search_threads} search threads")
+    serving.freeze_preloaded_objects()
+
+
+def post_fork(server, worker):
+    # Background threads, thread pools and SQLite connections are recreated lazily in each worker on first use
+    serving.set_search_threads(search_threads, int(os.environ["LOCAL_EMBEDDING_THREADS"]))
+
+
+def child_exit(server, worker):
+    observability.mark_process_dead(worker.pid)
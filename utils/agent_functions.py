@@ -1,11 +1,18 @@
+import asyncio
 import os
-import requests
 import json
+import numpy as np
 from utils import stream_manipulation as sm
+from utils import upstream
+from utils import observability
+from utils.prompt_packing import format_context
+from utils.thread_memory import adds_search_terms, blend, merge_queries, unit
 from utils import vectorstore_functions as vs
 
 BUCKET_NAME = os.environ.get("BUCKET_NAME")
 
+logger = observability.get_logger(__name__)
+
 # change this System message to fit your application
 SYSTEM_MESSAGE = """You are a world-class expert in [add your extension field here]. These are your capabilities, which you should share with users verbatim if prompted:
 
@@ -25,25 +32,170 @@ Contexts:\n\n
 """
 
 
-def agent_flow(amount_of_context_to_use, messages, copilot_thread_id, system_message, model_name, llm_client, headers={}):
-    """
-    This is the main RAG agent functionality. It takes in the amount of context to use, the messages from the user, the Copilot thread ID, the system message, the model name, the LLM client, and the headers. It then extracts the session info, rephrases the messages, searches for context, and streams the response from the Copilot API as SSE.
-    """
-    results = vs.embedding_search(messages[-1]['content'], amount_of_context_to_use, headers)
-    results = vs.deduplicate_urls(results)
-    
-    context = ""
-    for i, result in enumerate(results):
-        context += f"CONTEXT {i+1}\nTITLE:{result['metadata']['title']}\nURL:{result['metadata']['url']}\n\n{result['metadata']['original_text']}\n\n"
-        print(f"url: {result['metadata']['url']}")
+def build_prompt_messages(system_message, results, messages):
+    """Prepend a system message holding the numbered retrieved contexts to the conversation messages."""
+    context = "".join(format_context(i + 1, result['metadata']) for i, result in enumerate(results))
+    for result in results:
+        logger.debug(f"url: {result['metadata']['url']}")
 
     system_message = [{
         "role": "system",
         "content": system_message + context
     }]
 
-    full_prompt_messages = system_message + messages
-    print(full_prompt_messages)
+    return system_message + messages
+
+
+def thread_state(thread_memory, copilot_thread_id):
+    """
+    Return the retrieval state of a conversation and the active snapshot its chunk positions were retrieved from,
+    or (None, None) for a new or unknown conversation.
+    """
+    if thread_memory is None or not copilot_thread_id:
+        return None, None
+    snapshot = vs.INDEX_MANAGER.snapshot()
+    return thread_memory.get(copilot_thread_id, snapshot.version), snapshot
+
+
+def search_followup(thread_memory, state, snapshot, query, query_embedding, k):
+    """
+    Search for a follow-up question in the context of its thread.
+
+    A follow-up close to the previous question reuses its chunks. Otherwise the index is searched with the
+    follow-up's embedding blended into the thread's search vector, and with both questions' words, so that
+    e.g. "and on Graviton?" is searched together with the topic it follows up on.
+
+    Returns:
+    tuple: The results, and the search vector and lexical query to remember for the thread.
+    """
+    if float(np.dot(unit(query_embedding), state['embedding'])) >= thread_memory.reuse_similarity:
+        logger.debug("Follow-up is close to the previous question, reusing its chunks")
+        return vs.make_results(state['positions'][:k], snapshot=snapshot), state['search_embedding'], state['query']
+    search_embedding = blend(state['search_embedding'], query_embedding, thread_memory.followup_weight)
+    search_query = merge_queries(state['query'], query)
+    return vs.search_with_embedding(search_query, search_embedding, k, snapshot), search_embedding, search_query
+
+
+def remember_retrieval(thread_memory, copilot_thread_id, search_query, query_embedding, search_embedding, results):
+    if thread_memory is not None and copilot_thread_id and query_embedding is not None:
+        positions = [result['position'] for result in results]
+        # The version the results were retrieved from, which differs from the active one if the index was swapped meanwhile
+        index_version = results[0]['index_version'] if results else vs.INDEX_VERSION
+        thread_memory.put(copilot_thread_id, search_query, query_embedding, search_embedding, positions, index_version)
+
+
+def retrieve_with_memory(query, k, headers, thread_memory, copilot_thread_id):
+    """
+    Retrieve chunks for the latest question, using and updating the retrieval state of its thread.
+
+    A follow-up that adds no search terms to those the thread's chunks were retrieved with is answered with
+    those chunks, without an embedding call or a search, and keeps the thread from expiring.
+
+    Returns:
+    tuple: The query embedding (None if the query was not embedded) and the list of results.
+    """
+    state, snapshot = thread_state(thread_memory, copilot_thread_id)
+    if state is None:
+        query_embedding, results = vs.retrieve(query, k, headers)
+        search_embedding, search_query = query_embedding, query
+    elif not adds_search_terms(state, query):
+        logger.debug("Follow-up adds no new search terms, reusing the thread's chunks")
+        thread_memory.touch(copilot_thread_id)
+        return None, vs.make_results(state['positions'][:k], snapshot=snapshot)
+    else:
+        query_embedding = vs.create_embedding(query, headers, snapshot.embedder)
+        results, search_embedding, search_query = search_followup(thread_memory, state, snapshot, query, query_embedding, k)
+    remember_retrieval(thread_memory, copilot_thread_id, search_query, query_embedding, search_embedding, results)
+    return query_embedding, results
+
+
+async def retrieve_with_memory_async(query, k, headers, thread_memory, copilot_thread_id):
+    """Asyncio version of retrieve_with_memory; searches run in a worker thread."""
+    state, snapshot = thread_state(thread_memory, copilot_thread_id)
+    if state is None:
+        query_embedding, results = await vs.retrieve_async(query, k, headers)
+        search_embedding, search_query = query_embedding, query
+    elif not adds_search_terms(state, query):
+        logger.debug("Follow-up adds no new search terms, reusing the thread's chunks")
+        thread_memory.touch(copilot_thread_id)
+        return None, vs.make_results(state['positions'][:k], snapshot=snapshot)
+    else:
+        query_embedding = await vs.create_embedding_async(query, headers, snapshot.embedder)
+        results, search_embedding, search_query = await asyncio.to_thread(search_followup, thread_memory, state, snapshot, query, query_embedding, k)
+    remember_retrieval(thread_memory, copilot_thread_id, search_query, query_embedding, search_embedding, results)
+    return query_embedding, results
+
+
+def retrieve_context(query, query_embedding, results, amount_of_context_to_use, reranker, snapshot):
+    """Re-rank the retrieved results of a snapshot down to the chunks sent to the LLM, if a reranker is configured."""
+    if reranker is None:
+        return results
+    with observability.span('rerank'):
+        reranked = reranker.rerank(query, query_embedding, results, vs.result_embeddings(results, snapshot), amount_of_context_to_use)
+    logger.debug(f"Re-ranked {len(results)} candidates to {len(reranked)} chunks")
+    return reranked
+
+
+def prepare_prompt(system_message, results, messages, prompt_packer):
+    """Build the prompt messages, packed into a token budget if a PromptPacker is given, and return them with the results used."""
+    with observability.span('context_build'):
+        if prompt_packer is None:
+            return build_prompt_messages(system_message, results, messages), results
+        prompt_messages, packed_results, report = prompt_packer.pack(system_message, results, messages)
+    logger.debug(f"Packed prompt tokens: {report}")
+    return prompt_messages, packed_results
+
+
+def answer_cache_applies(answer_cache, messages):
+    """Answers to follow-up questions depend on the conversation, so only first turns are cached."""
+    return answer_cache is not None and not any(m.get('role') == 'assistant' for m in messages)
+
+
+def agent_flow(amount_of_context_to_use, messages, copilot_thread_id, system_message, model_name, llm_client, headers={}, answer_cache=None, reranker=None, prompt_packer=None, thread_memory=None):
+    """
+    This is the main RAG agent functionality. It takes in the amount of context to use, the messages from the user, the Copilot thread ID, the system message, the model name, the LLM client, and the headers. It then extracts the session info, rephrases the messages, searches for context, and streams the response from the Copilot API as SSE.
+
+    If an AnswerCache is passed as answer_cache, single-turn questions that are close to a previous question and
+    retrieve the same chunks are answered by replaying the previously streamed chunks instead of calling the LLM.
+
+    If a Reranker is passed as reranker, more candidates are retrieved and re-ranked with maximal marginal
+    relevance (and optionally a cross-encoder), so fewer overlapping chunks are sent to the LLM.
+
+    If a PromptPacker is passed as prompt_packer, chunks and conversation history are packed into its token
+    budget, and the packed token counts are reported.
+
+    If a ThreadMemory is passed as thread_memory, follow-up questions are searched in the context of the
+    earlier questions of the same copilot_thread_id, or reuse their chunks.
+    """
+    query = messages[-1]['content']
+    candidates = amount_of_context_to_use * (reranker.candidates if reranker is not None else 1)
+    with observability.span('retrieval'):
+        query_embedding, results = retrieve_with_memory(query, candidates, headers, thread_memory, copilot_thread_id)
+        snapshot = vs.results_snapshot(results)
+        while snapshot is None:
+            # The index was swapped twice since these positions were retrieved, so they are retrieved again
+            logger.info("Index version of the retrieved chunks is no longer loaded, retrieving them again")
+            query_embedding, results = vs.retrieve(query, candidates, headers)
+            snapshot = vs.results_snapshot(results)
+    results = retrieve_context(query, query_embedding, results, amount_of_context_to_use, reranker, snapshot)
+    full_prompt_messages, results = prepare_prompt(system_message, results, messages, prompt_packer)
+
+    # Lexical fast-path queries have no embedding to match cached answers against.
+    use_cache = answer_cache_applies(answer_cache, messages) and query_embedding is not None
+    chunk_ids = [result['metadata']['uuid'] for result in results]
+    if use_cache:
+        cached_chunks = answer_cache.lookup(query_embedding, chunk_ids, model_name, vs.INDEX_VERSION)
+        if cached_chunks is not None:
+            logger.debug(f"Answer cache hit: {answer_cache.stats()}")
+            observability.REQUESTS.labels('cached').inc()
+            stream_stats = observability.StreamStats('cache')
+            for chunk in cached_chunks:
+                stream_stats.chunk(chunk)
+                yield chunk
+            stream_stats.finish()
+            return
+
+    logger.debug(f"Prompt has {len(full_prompt_messages)} messages and {sum(len(m.get('content') or '') for m in full_prompt_messages)} characters")
 
     copilot_req = {
         "model": model_name,
@@ -51,14 +203,89 @@ def agent_flow(amount_of_context_to_use, messages, copilot_thread_id, system_mes
         "stream": True
     }
 
-    chunk_template = sm.get_chunk_template()
-    r = requests.post(llm_client, json=copilot_req, headers=headers, stream=True)
-    r.raise_for_status()
-    stream = r.iter_lines()
+    with observability.span('llm_request'):
+        r = upstream.SESSION.post(llm_client, json=copilot_req, headers=headers, stream=True)
+
+    streamed_chunks = []
+    stream_stats = observability.StreamStats('llm')
+    relay = sm.SSERelay()
+    # Closing the response returns its connection to the session's pool, also when the client disconnects
+    # and the generator is closed mid-stream
+    with r:
+        if not r.ok:
+            observability.REQUESTS.labels('upstream_error').inc()
+        r.raise_for_status()
+        # chunk_size=None yields whatever each socket read returns, instead of one byte at a time
+        for chunk in relay.relay(r.iter_content(chunk_size=None), close_upstream=r.close):
+            # To see what the chunk stream looks like, set LOG_LEVEL=DEBUG and uncomment the line below.
+            # logger.debug(f"Streamed Chunk: {chunk.decode('utf-8')}")
+            stream_stats.chunk(chunk)
+            if use_cache:
+                streamed_chunks.append(chunk)
+            yield chunk  # Send the chunk to the client
+    stream_stats.finish(relay.events if relay.sse_framing else None)
+    observability.REQUESTS.labels('answered').inc()
+
+    # Only complete answers are cached; an interrupted stream never reaches this point.
+    if use_cache:
+        answer_cache.store(query_embedding, chunk_ids, model_name, streamed_chunks, vs.INDEX_VERSION)
+
+
+async def agent_flow_async(amount_of_context_to_use, messages, copilot_thread_id, system_message, model_name, llm_client, headers={}, answer_cache=None, reranker=None, prompt_packer=None, thread_memory=None):
+    """
+    Asyncio version of agent_flow, used by the ASGI application.
+
+    Upstream calls go through the shared, pooled httpx.AsyncClient, and the FAISS search runs in a worker thread
+    so it does not block the event loop. Chunks are read from the upstream response only as fast as the client
+    consumes them, so a slow client applies backpressure instead of buffering the whole answer in memory.
+    """
+    query = messages[-1]['content']
+    candidates = amount_of_context_to_use * (reranker.candidates if reranker is not None else 1)
+    with observability.span('retrieval'):
+        query_embedding, results = await retrieve_with_memory_async(query, candidates, headers, thread_memory, copilot_thread_id)
+        snapshot = vs.results_snapshot(results)
+        while snapshot is None:
+            logger.info("Index version of the retrieved chunks is no longer loaded, retrieving them again")
+            query_embedding, results = await vs.retrieve_async(query, candidates, headers)
+            snapshot = vs.results_snapshot(results)
+    if reranker is not None:
+        results = await asyncio.to_thread(retrieve_context, query, query_embedding, results, amount_of_context_to_use, reranker, snapshot)
+    full_prompt_messages, results = prepare_prompt(system_message, results, messages, prompt_packer)
+
+    use_cache = answer_cache_applies(answer_cache, messages) and query_embedding is not None
+    chunk_ids = [result['metadata']['uuid'] for result in results]
+    if use_cache:
+        cached_chunks = answer_cache.lookup(query_embedding, chunk_ids, model_name, vs.INDEX_VERSION)
+        if cached_chunks is not None:
+            logger.debug(f"Answer cache hit: {answer_cache.stats()}")
+            observability.REQUESTS.labels('cached').inc()
+            stream_stats = observability.StreamStats('cache')
+            for chunk in cached_chunks:
+                stream_stats.chunk(chunk)
+                yield chunk
+            stream_stats.finish()
+            return
+
+    copilot_req = {
+        "model": model_name,
+        "messages": full_prompt_messages,
+        "stream": True
+    }
 
-    for chunk in copilot_response.iter_content():
-            if chunk:
-                # To see what the chunk stream looks like, uncomment the line below.
-                # print("Streamed Chunk:", chunk.decode('utf-8'))
-                yield chunk  # Send the chunk to the client
+    streamed_chunks = []
+    stream_stats = observability.StreamStats('llm')
+    client = upstream.get_async_client()
+    relay = sm.SSERelay()
+    async with client.stream("POST", llm_client, json=copilot_req, headers=headers) as r:
+        r.raise_for_status()
+        # aiter_bytes undoes any Content-Encoding, as iter_content does on the sync path
+        async for chunk in relay.relay_async(r.aiter_bytes()):
+            stream_stats.chunk(chunk)
+            if use_cache:
+                streamed_chunks.append(chunk)
+            yield chunk
+    stream_stats.finish(relay.events if relay.sse_framing else None)
+    observability.REQUESTS.labels('answered').inc()
 
+    if use_cache:
+        answer_cache.store(query_embedding, chunk_ids, model_name, streamed_chunks, vs.INDEX_VERSION)
@@ -0,0 +1,101 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Semantic cache of streamed answers.
+
+    An answer is reused when a new query embedding lies within a cosine distance of
+    `radius` of a cached query AND retrieval returned exactly the same chunks for the
+    same model. Every entry is tied to the index version it was produced with, so
+    rebuilding the index drops all cached answers.
+
+    Args:
+    max_entries (int): Maximum number of cached answers, least recently used are evicted first.
+    ttl_seconds (float): Lifetime of a cached answer in seconds. 0 or less disables expiry.
+    radius (float): Maximum cosine distance (1 - cosine similarity) between two queries.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600, radius: float = 0.05):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.radius = radius
+        self.index_version = None
+        self._entries = OrderedDict()
+        self._by_context = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        context_key, _, _, _ = self._entries.pop(entry_id)
+        bucket = self._by_context[context_key]
+        bucket.discard(entry_id)
+        if not bucket:
+            del self._by_context[context_key]
+
+    def _check_version(self, index_version):
+        if index_version != self.index_version:
+            self._entries.clear()
+            self._by_context.clear()
+            self.index_version = index_version
+
+    def invalidate(self):
+        """Drop every cached answer, e.g. after the index has been rebuilt."""
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+
+    def lookup(self, query_embedding, chunk_ids, model_name: str, index_version=None):
+        """Return the stored stream chunks of a matching answer, or None on a miss."""
+        query = self._unit(query_embedding)
+        context_key = (model_name, tuple(chunk_ids))
+        now = time.time()
+        with self._lock:
+            self._check_version(index_version)
+            for entry_id in list(self._by_context.get(context_key, ())):
+                _, vector, created, chunks = self._entries[entry_id]
+                if self.ttl_seconds > 0 and now - created > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                if 1.0 - float(np.dot(query, vector)) <= self.radius:
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return chunks
+            self.misses += 1
+            return None
+
+    def store(self, query_embedding, chunk_ids, model_name: str, chunks: list, index_version=None):
+        """Cache the complete list of stream chunks produced for a query."""
+        context_key = (model_name, tuple(chunk_ids))
+        with self._lock:
+            self._check_version(index_version)
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (context_key, self._unit(query_embedding), time.time(), list(chunks))
+            self._by_context.setdefault(context_key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters and the current size."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
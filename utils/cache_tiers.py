@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+class LRUCache(OrderedDict):
+    """An OrderedDict that keeps its most recently stored max_entries items. Callers hold their own lock."""
+
+    def __init__(self, max_entries: int):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def store(self, key, value) -> int:
+        """Store value as the most recent entry and return the number of entries evicted."""
+        self[key] = value
+        self.move_to_end(key)
+        evicted = 0
+        while len(self) > self.max_entries:
+            self.popitem(last=False)
+            evicted += 1
+        return evicted
+
+
+class SQLiteTier:
+    """
+    A SQLite table backing an in-process cache, which survives restarts and can be shared by several
+    worker processes.
+
+    Rows older than ttl_seconds, by the time in time_column, are deleted on open and then every
+    purge_every writes, together with the oldest rows beyond max_rows, so the file stops growing.
+
+    Args:
+    path (str): Path of the SQLite file.
+    table (str): Name of the table.
+    columns (str): Column definitions of the table, as in CREATE TABLE.
+    time_column (str): Column holding the time a row was written, as returned by time.time().
+    ttl_seconds (float): Lifetime of a row in seconds. 0 or less disables expiry.
+    max_rows (int): Maximum number of rows kept. 0 for no limit.
+    purge_every (int): Number of writes of this process between two purges.
+    """
+
+    def __init__(self, path: str, table: str, columns: str, time_column: str, ttl_seconds: float,
+                 max_rows: int = 0, purge_every: int = 1000):
+        self.path = path
+        self.table = table
+        self.time_column = time_column
+        self.ttl_seconds = ttl_seconds
+        self.max_rows = max_rows
+        self.purge_every = purge_every
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._pid = os.getpid()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_{time_column} ON {table} ({time_column})")
+        self.purge()
+
+    def connection(self) -> sqlite3.Connection:
+        # A SQLite connection must not be used across fork(), so a forked worker opens its own
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._db
+
+    def write(self, sql: str, params: tuple):
+        """Run one INSERT or UPDATE statement and commit it, purging the table every purge_every writes."""
+        db = self.connection()
+        db.execute(sql, params)
+        db.commit()
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self.purge()
+
+    def purge(self):
+        """Delete expired rows and the oldest rows beyond max_rows."""
+        db = self.connection()
+        if self.ttl_seconds > 0:
+            db.execute(f"DELETE FROM {self.table} WHERE {self.time_column} < ?", (time.time() - self.ttl_seconds,))
+        if self.max_rows > 0:
+            db.execute(
+                f"DELETE FROM {self.table} WHERE rowid IN "
+                f"(SELECT rowid FROM {self.table} ORDER BY {self.time_column} DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,),
+            )
+        db.commit()
@@ -0,0 +1,143 @@
+import json
+import struct
+
+import numpy as np
+
+# File layout:
+#   8 bytes   magic
+#   uint32    length of the JSON header (little-endian)
+#   JSON      header: version, model, dimension, count, dtype
+#   padding   up to a 64-byte boundary
+#   data      count x dimension values of dtype, row-major
+#   scales    int8 only: count float32 per-vector scales, the stored vector times its scale is the original vector
+MAGIC = b"RAGEMB01"
+VERSION = 1
+ALIGNMENT = 64
+DTYPES = ['float32', 'float16', 'int8']
+
+
+def _quantize(batch: np.ndarray, dtype: str):
+    """Convert a float32 batch to the stored dtype, returning the stored values and int8 scales (or None)."""
+    if dtype == 'int8':
+        scales = np.abs(batch).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(batch / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return batch.astype(dtype), None
+
+
+def write_embedding_artifact(artifact_path: str, embeddings: np.ndarray, model_name: str, dtype: str = 'float32', batch_size: int = 10000):
+    """
+    Write embeddings to a versioned binary artifact, in batches so large matrices are never copied whole.
+
+    Args:
+    artifact_path (str): Path of the file to write.
+    embeddings (np.ndarray): Matrix of shape (count, dimension), may be a memmap.
+    model_name (str): Name of the model that produced the embeddings, stored in the header.
+    dtype (str): Storage type, one of DTYPES. float16 halves and int8 quarters the size of float32.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown embedding dtype '{dtype}', expected one of {DTYPES}")
+    count, dimension = embeddings.shape
+    header = json.dumps({
+        'version': VERSION,
+        'model': model_name,
+        'dimension': int(dimension),
+        'count': int(count),
+        'dtype': dtype
+    }).encode('utf-8')
+    prefix = MAGIC + struct.pack('<I', len(header)) + header
+    prefix += b'\0' * (-len(prefix) % ALIGNMENT)
+
+    all_scales = []
+    with open(artifact_path, 'wb') as f:
+        f.write(prefix)
+        for start in range(0, count, batch_size):
+            batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+            values, scales = _quantize(batch, dtype)
+            f.write(values.tobytes())
+            if scales is not None:
+                all_scales.append(scales)
+        if all_scales:
+            f.write(np.concatenate(all_scales).tobytes())
+
+
+class EmbeddingArtifact:
+    """
+    Memory-mapped reader for a file written by write_embedding_artifact.
+
+    Nothing is read until rows are requested, so iterating over a large artifact in batches runs
+    in constant memory.
+    """
+
+    def __init__(self, artifact_path: str):
+        with open(artifact_path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{artifact_path} is not an embedding artifact")
+            header_length = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(header_length))
+        if self.header['version'] > VERSION:
+            raise ValueError(f"{artifact_path} has unsupported version {self.header['version']}")
+
+        self.model = self.header['model']
+        self.dimension = self.header['dimension']
+        self.count = self.header['count']
+        self.dtype = self.header['dtype']
+
+        data_offset = len(MAGIC) + 4 + header_length
+        data_offset += -data_offset % ALIGNMENT
+        shape = (self.count, self.dimension)
+        self.values = np.memmap(artifact_path, dtype=self.dtype, mode='r', offset=data_offset, shape=shape)
+        self.scales = None
+        if self.dtype == 'int8':
+            self.scales = np.memmap(artifact_path, dtype=np.float32, mode='r', offset=data_offset + self.values.nbytes, shape=(self.count,))
+
+    def __len__(self):
+        return self.count
+
+    def get(self, rows) -> np.ndarray:
+        """Return the given rows (a slice or an array of row numbers) as float32."""
+        batch = np.asarray(self.values[rows], dtype=np.float32)
+        if self.scales is not None:
+            batch *= np.asarray(self.scales[rows])[..., None]
+        return batch
+
+    def iter_batches(self, batch_size: int = 10000):
+        """Yield (start row, float32 batch) pairs covering the whole artifact."""
+        for start in range(0, self.count, batch_size):
+            yield start, self.get(slice(start, start + batch_size))
+
+    def sample(self, size: int, seed: int = 0) -> np.ndarray:
+        """Return a random sample of rows as float32, e.g. to train an IVF or PQ index."""
+        if size >= self.count:
+            return self.get(slice(None))
+        rows = np.sort(np.random.default_rng(seed).choice(self.count, size, replace=False))
+        return self.get(rows)
+
+
+class ArtifactRange:
+    """View of the rows [start, stop) of an EmbeddingArtifact, with the same reading methods, e.g. to build one shard."""
+
+    def __init__(self, artifact: EmbeddingArtifact, start: int, stop: int):
+        self.artifact = artifact
+        self.start = start
+        self.stop = stop
+        self.model = artifact.model
+        self.dimension = artifact.dimension
+        self.dtype = artifact.dtype
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def get(self, rows) -> np.ndarray:
+        return self.artifact.get(np.arange(self.start, self.stop)[rows])
+
+    def iter_batches(self, batch_size: int = 10000):
+        for start in range(self.start, self.stop, batch_size):
+            yield start - self.start, self.artifact.get(slice(start, min(start + batch_size, self.stop)))
+
+    def sample(self, size: int, seed: int = 0) -> np.ndarray:
+        if size >= len(self):
+            return self.artifact.get(slice(self.start, self.stop))
+        rows = np.sort(np.random.default_rng(seed).choice(len(self), size, replace=False))
+        return self.artifact.get(rows + self.start)
@@ -0,0 +1,112 @@
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+from utils.cache_tiers import LRUCache, SQLiteTier
+
+
+def normalize_query(query: str) -> str:
+    """Collapse whitespace and case so trivially different queries share a cache entry."""
+    return " ".join(query.split()).casefold()
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU/TTL cache for query embeddings, keyed on normalized query text and model name.
+
+    Entries live in an in-process LRU. If disk_path is given, entries are also written to a
+    SQLite file, which survives restarts and can be shared by several worker processes. The file
+    keeps the newest disk_max_entries entries; older and expired ones are deleted every
+    disk_purge_every writes.
+
+    Args:
+    max_entries (int): Maximum number of embeddings held in memory.
+    ttl_seconds (float): Lifetime of an entry in seconds. 0 or less disables expiry.
+    disk_path (str): Optional path of the SQLite file backing the on-disk tier.
+    disk_max_entries (int): Maximum number of embeddings kept in the SQLite file. 0 for no limit.
+    disk_purge_every (int): Number of writes between two purges of the SQLite file.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600, disk_path: str = None,
+                 disk_max_entries: int = 50000, disk_purge_every: int = 1000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = LRUCache(max_entries)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.disk_path = disk_path
+        self._disk = None
+        if disk_path:
+            self._disk = SQLiteTier(disk_path, 'embeddings', "key TEXT PRIMARY KEY, model TEXT, created REAL, vector BLOB",
+                                    'created', ttl_seconds, disk_max_entries, disk_purge_every)
+
+    @staticmethod
+    def make_key(query: str, model_name: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - created > self.ttl_seconds
+
+    def _store_in_memory(self, key: str, created: float, vector: np.ndarray):
+        self.evictions += self._entries.store(key, (created, vector))
+
+    def get(self, query: str, model_name: str):
+        """Return the cached embedding for the query, or None on a miss."""
+        key = self.make_key(query, model_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, vector = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._entries[key]
+                self.expirations += 1
+
+            if self._disk is not None:
+                row = self._disk.connection().execute(
+                    "SELECT created, vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    vector = np.frombuffer(row[1], dtype=np.float32)
+                    self._store_in_memory(key, row[0], vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, model_name: str, embedding) -> np.ndarray:
+        """Store an embedding and return it as a read-only float32 array."""
+        key = self.make_key(query, model_name)
+        vector = np.array(embedding, dtype=np.float32)
+        vector.flags.writeable = False
+        created = time.time()
+        with self._lock:
+            self._store_in_memory(key, created, vector)
+            if self._disk is not None:
+                self._disk.write(
+                    "INSERT OR REPLACE INTO embeddings (key, model, created, vector) VALUES (?, ?, ?, ?)",
+                    (key, model_name, created, vector.tobytes()),
+                )
+        return vector
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters and the current in-memory size."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
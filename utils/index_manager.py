@@ -0,0 +1,424 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from utils import index_types, observability
+from utils.embedders import create_embedder
+from utils.embedding_artifact import EmbeddingArtifact
+from utils.lexical_index import LexicalIndex
+from utils.metadata_filters import FilterBitmaps, bitmap_positions, build_filter_bitmaps, slice_bitmap
+from utils.metadata_store import MetadataStore
+from utils.retrieval import url_ids
+
+logger = observability.get_logger(__name__)
+
+# Files written by the vectorstore builder that make up one version of the vector store, besides the index files.
+ARTIFACT_FILES = ['index_config.json', 'metadata.json', 'metadata.bin', 'lexical_index.npz', 'chunk_urls.npy', 'filter_bitmaps.npz', 'embeddings.emb']
+CURRENT_FILE = 'CURRENT'
+
+
+def load_faiss_index(index_path: str, use_mmap: bool = False):
+    """Load the FAISS index from a file, optionally memory-mapped so workers share it through the page cache."""
+    logger.info(f"Loading FAISS index from {index_path} (mmap={use_mmap})")
+    if use_mmap:
+        # IO_FLAG_MMAP_IFC maps flat vector storage without copying it; older FAISS releases only have IO_FLAG_MMAP.
+        flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        try:
+            index = faiss.read_index(index_path, flags)
+        except RuntimeError as e:
+            logger.warning(f"Could not memory-map {index_path}, reading it instead: {e}")
+            index = faiss.read_index(index_path)
+    else:
+        index = faiss.read_index(index_path)
+    logger.info(f"Loaded index containing {index.ntotal} vectors")
+    return index
+
+
+def load_metadata(metadata_path: str):
+    """Load metadata from a binary metadata store if one exists next to the JSON file, otherwise from the JSON file."""
+    store_path = os.path.splitext(metadata_path)[0] + '.bin'
+    if os.path.exists(store_path):
+        logger.info(f"Memory-mapping metadata store {store_path}")
+        metadata = MetadataStore(store_path)
+    else:
+        logger.info(f"Loading metadata from {metadata_path}")
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+    logger.info(f"Loaded metadata for {len(metadata)} items")
+    return metadata
+
+
+def load_lexical_index(index_path: str):
+    """Load the BM25 index built next to the FAISS index, or return None if there is none."""
+    if not os.path.exists(index_path):
+        logger.info(f"No lexical index at {index_path}, using vector search only")
+        return None
+    logger.info(f"Loading lexical index from {index_path}")
+    return LexicalIndex(index_path)
+
+
+def load_chunk_urls(chunk_urls_path: str, metadata):
+    """Load the URL ID of every chunk written by the builder, or derive it from the metadata."""
+    if os.path.exists(chunk_urls_path):
+        return np.load(chunk_urls_path)
+    logger.info(f"No {chunk_urls_path}, deriving chunk URLs from metadata")
+    return url_ids(metadata)
+
+
+def load_filter_bitmaps(bitmaps_path: str, metadata):
+    """Load the filter bitmaps written by the builder, or build them from the metadata."""
+    if os.path.exists(bitmaps_path):
+        return FilterBitmaps.load(bitmaps_path)
+    logger.info(f"No {bitmaps_path}, building filter bitmaps from metadata")
+    return FilterBitmaps(build_filter_bitmaps(metadata))
+
+
+def load_embeddings(artifact_path: str, index):
+    """Memory-map the stored chunk embeddings written by the builder, or return None if they are missing or stale."""
+    if not os.path.exists(artifact_path):
+        return None
+    artifact = EmbeddingArtifact(artifact_path)
+    if len(artifact) != index.ntotal:
+        logger.warning(f"Ignoring {artifact_path}: it holds {len(artifact)} vectors, the index {index.ntotal}")
+        return None
+    return artifact
+
+
+def get_index_version(index_path: str) -> str:
+    """Fingerprint an index file so caches can tell when it has been rebuilt."""
+    stat = os.stat(index_path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+class ShardedIndex:
+    """
+    Several FAISS indexes over contiguous ranges of the corpus, searched in parallel and merged.
+
+    A hit at position p of the shard starting at offset is metadata position offset + p, so the
+    merged results are metadata positions like those of a single index. FAISS releases the GIL
+    while searching, so the shards are searched concurrently.
+    """
+
+    def __init__(self, shards: list, offsets: list):
+        self.shards = shards
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.d = shards[0].d
+        self.ntotal = sum(shard.ntotal for shard in shards)
+        self._pid = None
+
+    def _map(self, fn):
+        # Thread pools do not survive fork(), so one is created per process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=len(self.shards))
+        return list(self._executor.map(fn, self.shards))
+
+    def search(self, x: np.ndarray, k: int, bitmap: np.ndarray = None):
+        if bitmap is None:
+            results = self._map(lambda shard: shard.search(x, k))
+        else:
+            # Every shard is searched with the part of the bitmap covering its positions
+            bitmaps = {id(shard): slice_bitmap(bitmap, offset, offset + shard.ntotal)
+                       for shard, offset in zip(self.shards, self.offsets)}
+            results = self._map(lambda shard: search_index(shard, x, k, bitmaps[id(shard)]))
+        distances = np.hstack([d for d, _ in results])
+        indices = np.hstack([np.where(i >= 0, i + offset, -1) for (_, i), offset in zip(results, self.offsets)])
+        # Missing results (-1) sort last
+        distances = np.where(indices >= 0, distances, np.inf).astype(np.float32)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def range_search(self, x: np.ndarray, radius: float):
+        results = self._map(lambda shard: shard.range_search(x, radius))
+        lims = np.zeros(len(x) + 1, dtype=np.int64)
+        distances, indices = [], []
+        for q in range(len(x)):
+            count = 0
+            for (shard_lims, shard_distances, shard_indices), offset in zip(results, self.offsets):
+                start, end = shard_lims[q], shard_lims[q + 1]
+                distances.append(shard_distances[start:end])
+                indices.append(shard_indices[start:end] + offset)
+                count += end - start
+            lims[q + 1] = lims[q] + count
+        return lims, np.concatenate(distances).astype(np.float32), np.concatenate(indices).astype(np.int64)
+
+    def reconstruct_batch(self, positions: np.ndarray) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.int64)
+        vectors = np.empty((len(positions), self.d), dtype=np.float32)
+        shard_of = np.searchsorted(self.offsets, positions, side='right') - 1
+        for s in np.unique(shard_of):
+            rows = shard_of == s
+            vectors[rows] = self.shards[s].reconstruct_batch(positions[rows] - self.offsets[s])
+        return vectors
+
+
+class RefinedIndex:
+    """
+    A compressed index whose candidates are re-ranked by their exact distance to full-precision vectors.
+
+    Every search fetches refine_factor * k candidates from the compressed index, reads their vectors
+    from the memory-mapped embeddings artifact and keeps the k closest. Only the compressed codes
+    are held in memory; the artifact pages of the candidates are read through the page cache.
+    """
+
+    def __init__(self, index, embeddings, refine_factor: int):
+        self.index = index
+        self.embeddings = embeddings
+        self.refine_factor = refine_factor
+        self.d = index.d
+        self.ntotal = index.ntotal
+
+    def _exact_distances(self, x: np.ndarray, queries: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """Squared L2 distances between the queries x[queries] and the stored vectors at positions, pairwise."""
+        candidates, rows = np.unique(positions, return_inverse=True)
+        vectors = self.embeddings.get(candidates)
+        return ((vectors[rows] - x[queries]) ** 2).sum(axis=1, dtype=np.float32)
+
+    def search(self, x: np.ndarray, k: int, bitmap: np.ndarray = None):
+        _, indices = search_index(self.index, x, min(k * self.refine_factor, self.ntotal), bitmap)
+        found = indices >= 0
+        distances = np.full(indices.shape, np.inf, dtype=np.float32)
+        distances[found] = self._exact_distances(x, np.nonzero(found)[0], indices[found])
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        distances, indices = np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+        return distances, np.where(np.isinf(distances), -1, indices)
+
+    def range_search(self, x: np.ndarray, radius: float):
+        # Candidates are found with the compressed distances and kept if their exact distance is within the radius
+        lims, _, indices = self.index.range_search(x, radius)
+        queries = np.repeat(np.arange(len(x)), np.diff(lims.astype(np.int64)))
+        distances = self._exact_distances(x, queries, indices)
+        keep = distances < radius
+        counts = np.bincount(queries[keep], minlength=len(x))
+        return np.concatenate([[0], np.cumsum(counts)]), distances[keep], indices[keep]
+
+    def reconstruct_batch(self, positions: np.ndarray) -> np.ndarray:
+        return self.embeddings.get(np.asarray(positions, dtype=np.int64))
+
+
+def search_index(index, x: np.ndarray, k: int, bitmap: np.ndarray = None):
+    """Search a FAISS, sharded or refined index, only among the positions set in bitmap if given."""
+    if bitmap is None:
+        return index.search(x, k)
+    if isinstance(index, (ShardedIndex, RefinedIndex)):
+        return index.search(x, k, bitmap)
+    if isinstance(index, faiss.IndexPQ):
+        # IndexPQ takes no selector, but its distances are those to the decoded codes, so decoding the
+        # selected codes and comparing them exhaustively gives the same results
+        positions = bitmap_positions(bitmap, index.ntotal)
+        if not len(positions):
+            return np.full((len(x), k), np.inf, dtype=np.float32), np.full((len(x), k), -1, dtype=np.int64)
+        distances, rows = faiss.knn(x, index.reconstruct_batch(positions), min(k, len(positions)))
+        padding = ((0, 0), (0, k - rows.shape[1]))
+        return (np.pad(distances, padding, constant_values=np.inf),
+                np.pad(np.where(rows >= 0, positions[rows], -1), padding, constant_values=-1))
+    return index.search(x, k, params=index_types.search_parameters(index, bitmap))
+
+
+class IndexSnapshot:
+    """
+    Everything loaded from one version of the vector store: the index (one file or several shards),
+    its config, metadata, lexical index, chunk URLs, filter bitmaps, stored embeddings and the query embedder.
+
+    A request reads the active snapshot once and uses it throughout, so it never mixes two versions.
+    """
+
+    def __init__(self, directory: str, version: str = None, use_mmap: bool = True, embedder=None):
+        path = lambda name: os.path.join(directory, name)
+        self.directory = directory
+        self.config = index_types.load_index_config(path('index_config.json'))
+        if 'shards' in self.config:
+            shards = [self._load_index(path(shard['file']), use_mmap) for shard in self.config['shards']]
+            self.index = ShardedIndex(shards, [shard['offset'] for shard in self.config['shards']])
+            logger.info(f"Loaded {len(shards)} shards holding {self.index.ntotal} vectors")
+        else:
+            self.index = self._load_index(path('faiss_index.bin'), use_mmap)
+        self.version = version or get_index_version(path('index_config.json' if 'shards' in self.config else 'faiss_index.bin'))
+        self.metadata = load_metadata(path('metadata.json'))
+        self.lexical_index = load_lexical_index(path('lexical_index.npz'))
+        self.chunk_urls = load_chunk_urls(path('chunk_urls.npy'), self.metadata)
+        self.filter_bitmaps = load_filter_bitmaps(path('filter_bitmaps.npz'), self.metadata)
+        self.embeddings = load_embeddings(path('embeddings.emb'), self.index)
+        refine_factor = self.config.get('params', {}).get('refine_factor', 0)
+        if refine_factor and self.embeddings is not None:
+            self.index = RefinedIndex(self.index, self.embeddings, refine_factor)
+        elif refine_factor:
+            logger.warning("The index config asks for re-ranking with full-precision vectors, but there is no usable embeddings.emb; searching the compressed index only")
+        # Queries are embedded with the backend and model the index was built with, recorded in index_config.json.
+        if embedder is None or embedder.config() != create_embedder_config(self.config):
+            embedder = create_embedder(self.config.get('embedding'))
+        self.embedder = embedder
+
+    def _load_index(self, index_path: str, use_mmap: bool):
+        # Indexes keyed by chunk ID store their vectors in metadata order, so the wrapped index is searched directly.
+        index = index_types.unwrap_id_map(load_faiss_index(index_path, use_mmap))
+        index_types.apply_search_params(index, self.config)
+        return index
+
+
+def create_embedder_config(index_config: dict) -> dict:
+    """The embedder config an index config asks for, with the defaults filled in."""
+    embedding = index_config.get('embedding') or {}
+    return {'backend': embedding.get('backend', 'remote'), 'model': embedding.get('model', 'text-embedding-ada-002')}
+
+
+class LocalArtifactSource:
+    """
+    Versions of the vector store kept as subdirectories of a local directory, e.g. a shared volume.
+
+    The name of the active version is read from the CURRENT file in the root directory, which
+    publishing replaces atomically after all files of the new version are in place.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def current_version(self) -> str:
+        with open(os.path.join(self.root, CURRENT_FILE), 'r') as f:
+            return f.read().strip()
+
+    def fetch(self, version: str) -> str:
+        return os.path.join(self.root, version)
+
+
+class S3ArtifactSource:
+    """
+    Versions of the vector store kept under s3://bucket/prefix/<version>/, the active one named in
+    s3://bucket/prefix/CURRENT. A version is downloaded to cache_dir before it is loaded.
+
+    Every worker process polls on its own, so downloads and cleanups hold an exclusive lock on a file in
+    cache_dir: a version is downloaded once, by the first worker that sees it, and the others wait for
+    it and load the same files, which they then share through the page cache.
+    """
+
+    LOCK_FILE = '.lock'
+
+    def __init__(self, bucket: str, prefix: str = 'vectorstore/', cache_dir: str = 'index_cache'):
+        import boto3
+        self.s3 = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+
+    def current_version(self) -> str:
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + CURRENT_FILE)
+        return response['Body'].read().decode('utf-8').strip()
+
+    def _lock(self):
+        """Open and exclusively lock the lock file of cache_dir; closing the returned file releases the lock."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        lock = open(os.path.join(self.cache_dir, self.LOCK_FILE), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def fetch(self, version: str) -> str:
+        directory = os.path.join(self.cache_dir, version)
+        if os.path.isdir(directory):
+            return directory
+        with self._lock():
+            if os.path.isdir(directory):
+                return directory
+            # Download to a directory of this process and rename it, so a half-downloaded version is never loaded
+            partial = tempfile.mkdtemp(prefix=f".{version}.", dir=self.cache_dir)
+            try:
+                paginator = self.s3.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{version}/"):
+                    for item in page.get('Contents', []):
+                        name = item['Key'].rsplit('/', 1)[-1]
+                        logger.info(f"Downloading s3://{self.bucket}/{item['Key']}")
+                        self.s3.download_file(self.bucket, item['Key'], os.path.join(partial, name))
+                os.rename(partial, directory)
+            except OSError:
+                # Another process completed the same version first
+                if not os.path.isdir(directory):
+                    raise
+            finally:
+                shutil.rmtree(partial, ignore_errors=True)
+        return directory
+
+    def cleanup(self, keep: list):
+        """Delete downloaded versions other than those in keep, and downloads left behind by crashed processes."""
+        # Downloads hold the lock, so none is in progress while it is held here
+        with self._lock():
+            for name in os.listdir(self.cache_dir):
+                if name not in keep and name != self.LOCK_FILE:
+                    shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+
+class IndexManager:
+    """
+    Holds the active IndexSnapshot and swaps in new versions of the vector store under live traffic.
+
+    Without a source, the vector store in `directory` is loaded once. With a source (LocalArtifactSource
+    or S3ArtifactSource), its CURRENT version is loaded, and a background thread checks for a new version
+    every poll_seconds, loads it completely, then replaces the active snapshot with a single assignment.
+    Requests already running keep the snapshot they started with; the previous snapshot stays available
+    through snapshot(version) until the next swap. Once it is gone, snapshot(version) returns None, and
+    chunk positions retrieved from it have to be retrieved again from the active snapshot.
+    """
+
+    def __init__(self, source=None, directory: str = '.', poll_seconds: float = 60, use_mmap: bool = True):
+        self.source = source
+        self.poll_seconds = poll_seconds
+        self.use_mmap = use_mmap
+        self.swaps = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        if source is None:
+            self.current = IndexSnapshot(directory, use_mmap=use_mmap)
+        else:
+            version = source.current_version()
+            self.current = IndexSnapshot(source.fetch(version), version, use_mmap)
+        self.previous = None
+
+    def snapshot(self, version=None) -> IndexSnapshot:
+        """
+        Return the active snapshot, or the snapshot of the given version if it is the active or the previous one.
+        Returns None for any other version, whose chunk positions do not match a loaded index.
+        """
+        if self.source is not None and self._pid != os.getpid():
+            self._start()
+        current, previous = self.current, self.previous
+        if version is None or current.version == version:
+            return current
+        if previous is not None and previous.version == version:
+            return previous
+        return None
+
+    def _start(self):
+        # Started lazily, and again after a fork, since threads do not survive fork().
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Could not check for a new index version: {e}")
+
+    def check(self) -> bool:
+        """Load and activate the source's current version if it differs from the active one. Returns whether it swapped."""
+        version = self.source.current_version()
+        if version == self.current.version:
+            return False
+        logger.info(f"Loading index version {version}")
+        snapshot = IndexSnapshot(self.source.fetch(version), version, self.use_mmap, self.current.embedder)
+        self.previous, self.current = self.current, snapshot
+        self.swaps += 1
+        logger.info(f"Switched to index version {version}")
+        if hasattr(self.source, 'cleanup'):
+            self.source.cleanup([snapshot.version, self.previous.version])
+        return True
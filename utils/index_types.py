@@ -0,0 +1,236 @@
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+
+from utils import observability
+from utils.embedding_artifact import ArtifactRange
+
+logger = observability.get_logger(__name__)
+
+INDEX_TYPES = ['flat', 'hnsw', 'ivf', 'ivfpq', 'sq8', 'fp16', 'pq']
+
+# Build and search parameters for each index type. nlist=None picks a value from the corpus size.
+# sq8, fp16 and pq scan every vector like flat, but store 8-bit, 16-bit or product-quantized codes
+# instead of float32. With refine_factor > 0, refine_factor * k candidates are re-ranked by their exact
+# distance to the full-precision vectors of the memory-mapped embeddings.emb.
+DEFAULT_PARAMS = {
+    'flat': {},
+    'hnsw': {'M': 32, 'efConstruction': 200, 'efSearch': 64},
+    'ivf': {'nlist': None, 'nprobe': 16},
+    'ivfpq': {'nlist': None, 'nprobe': 16, 'pq_m': 64, 'pq_nbits': 8, 'refine_factor': 0},
+    'sq8': {'refine_factor': 2},
+    'fp16': {'refine_factor': 0},
+    'pq': {'pq_m': 64, 'pq_nbits': 8, 'refine_factor': 8},
+}
+
+
+def default_nlist(num_vectors: int) -> int:
+    """Pick an IVF list count of ~4*sqrt(n), keeping at least 39 training points per list as FAISS expects."""
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def resolve_params(index_type: str, num_vectors: int, **overrides) -> dict:
+    """Merge user overrides into the defaults for index_type, dropping unset (None) overrides."""
+    if index_type not in DEFAULT_PARAMS:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    params = dict(DEFAULT_PARAMS[index_type])
+    params.update({key: value for key, value in overrides.items() if value is not None and key in params})
+    if 'nlist' in params and params['nlist'] is None:
+        params['nlist'] = default_nlist(num_vectors)
+    return params
+
+
+def create_index(index_type: str, dimension: int, num_vectors: int, **overrides):
+    """Create an empty, untrained FAISS index of the requested type and return it with its resolved parameters."""
+    params = resolve_params(index_type, num_vectors, **overrides)
+
+    if index_type == 'flat':
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, params['M'])
+        index.hnsw.efConstruction = params['efConstruction']
+    elif index_type == 'ivf':
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFFlat(quantizer, dimension, params['nlist'])
+    elif index_type == 'sq8':
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    elif index_type == 'fp16':
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    else:
+        if dimension % params['pq_m'] != 0:
+            raise ValueError(f"pq_m={params['pq_m']} must divide the embedding dimension {dimension}")
+        if index_type == 'pq':
+            index = faiss.IndexPQ(dimension, params['pq_m'], params['pq_nbits'])
+        else:
+            quantizer = faiss.IndexFlatL2(dimension)
+            index = faiss.IndexIVFPQ(quantizer, dimension, params['nlist'], params['pq_m'], params['pq_nbits'])
+
+    return index, params
+
+
+def fill_index(index, index_type: str, params: dict, training_vectors, batches, ids: np.ndarray = None):
+    """
+    Train an index if needed and add (start row, vectors) batches to it.
+
+    A flat index is wrapped in an IndexIDMap2 when ids are given, and the batches are added under those IDs.
+    Returns the filled index and the index config (type, dimension and parameters) to persist next to it.
+    """
+    dimension = index.d
+    if not index.is_trained:
+        logger.info(f"Training {index_type} index with params {params}")
+        index.train(np.ascontiguousarray(training_vectors, dtype=np.float32))
+    if ids is not None and index_type == 'flat':
+        index = faiss.IndexIDMap2(index)
+        ids = np.asarray(ids, dtype=np.int64)
+        for start, batch in batches:
+            index.add_with_ids(np.ascontiguousarray(batch, dtype=np.float32), ids[start:start + len(batch)])
+    else:
+        for _, batch in batches:
+            index.add(np.ascontiguousarray(batch, dtype=np.float32))
+
+    config = {'index_type': index_type, 'dimension': dimension, 'params': params}
+    apply_search_params(index, config)
+    return index, config
+
+
+def build_index(embeddings: np.ndarray, index_type: str = 'flat', ids: np.ndarray = None, **overrides):
+    """
+    Build and fill a FAISS index of the requested type.
+
+    Args:
+    embeddings (np.ndarray): float32 matrix of shape (n, dimension).
+    index_type (str): One of INDEX_TYPES.
+    ids (np.ndarray): Optional int64 chunk IDs. A flat index is then wrapped in an IndexIDMap2, so it can
+        later be updated in place with add_with_ids/remove_ids.
+    overrides: Build/search parameters overriding DEFAULT_PARAMS, e.g. nlist=1024 or efSearch=128.
+
+    Returns:
+    tuple: The filled index and the index config (type, dimension and parameters) to persist next to it.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    num_vectors, dimension = embeddings.shape
+    index, params = create_index(index_type, dimension, num_vectors, **overrides)
+    return fill_index(index, index_type, params, embeddings, [(0, embeddings)], ids)
+
+
+def build_index_from_artifact(artifact, index_type: str = 'flat', ids: np.ndarray = None, batch_size: int = 10000, train_size: int = 100000, **overrides):
+    """
+    Build a FAISS index from an EmbeddingArtifact without loading the whole artifact into memory.
+
+    Trainable index types are trained on a random sample of train_size vectors, then vectors are
+    added batch_size at a time. Takes the same index_type, ids and overrides as build_index.
+    """
+    index, params = create_index(index_type, artifact.dimension, len(artifact), **overrides)
+    training_vectors = artifact.sample(train_size) if not index.is_trained else None
+    return fill_index(index, index_type, params, training_vectors, artifact.iter_batches(batch_size), ids)
+
+
+def build_shards_from_artifact(artifact, index_type: str, num_shards: int, **options):
+    """
+    Split an EmbeddingArtifact into num_shards contiguous row ranges and build one index per range.
+
+    Shards hold no IDs: a hit at position p of the shard starting at row offset is metadata position
+    offset + p. Takes the same options as build_index_from_artifact, except ids.
+
+    Returns:
+    tuple: The list of shard indexes and the index config, whose 'shards' entry lists the file name,
+        row offset and row count of every shard.
+    """
+    bounds = np.linspace(0, len(artifact), num_shards + 1).astype(np.int64)
+    shards = []
+    shard_entries = []
+    config = None
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        logger.info(f"Building shard {i + 1}/{num_shards} with rows {start} to {stop}")
+        index, config = build_index_from_artifact(ArtifactRange(artifact, int(start), int(stop)), index_type, **options)
+        shards.append(index)
+        shard_entries.append({'file': f"shard_{i:03d}.bin", 'offset': int(start), 'count': int(stop - start)})
+    config['shards'] = shard_entries
+    return shards, config
+
+
+def update_id_map_index(index, ids: np.ndarray, embeddings: np.ndarray):
+    """
+    Bring an IndexIDMap2 over a flat index in line with the current chunks, in place.
+
+    Vectors whose ID is no longer present are removed and vectors with new IDs are added; vectors
+    that are still present are left untouched. Removal keeps the remaining vectors in order, so the
+    position of every vector still matches the order of index.id_map.
+    """
+    existing = faiss.vector_to_array(index.id_map)
+    stale = np.setdiff1d(existing, ids)
+    if len(stale):
+        index.remove_ids(stale)
+    new = ~np.isin(ids, existing)
+    if new.any():
+        index.add_with_ids(np.ascontiguousarray(embeddings[new], dtype=np.float32), ids[new])
+    logger.info(f"Removed {len(stale)} and added {int(new.sum())} vectors, index now holds {index.ntotal}")
+    return index
+
+
+def id_map_order(index) -> np.ndarray:
+    """Return the chunk IDs of an IndexIDMap2 in the order of the vectors stored in it."""
+    return faiss.vector_to_array(faiss.downcast_index(index).id_map)
+
+
+def unwrap_id_map(index):
+    """
+    Return the index wrapped by an IndexIDMap/IndexIDMap2, or the index itself.
+
+    The builder writes metadata in the order of the vectors inside the ID map, so searching the
+    wrapped index directly returns metadata positions without an ID translation step.
+    """
+    wrapper = faiss.downcast_index(index)
+    if isinstance(wrapper, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        inner = faiss.downcast_index(wrapper.index)
+        # The object passed in owns the wrapper, which owns the inner index: keep it alive as long as the inner index is used.
+        inner.referenced_objects = [index]
+        return inner
+    if wrapper is not index:
+        # downcast_index returns a new, non-owning proxy: keep the owning object alive with it.
+        wrapper.referenced_objects = [index]
+    return wrapper
+
+
+def apply_search_params(index, config: dict):
+    """Apply the search-time knobs (efSearch, nprobe) stored in an index config to a loaded index."""
+    params = config.get('params', {})
+    if 'efSearch' in params:
+        unwrap_id_map(index).hnsw.efSearch = params['efSearch']
+    if 'nprobe' in params:
+        faiss.extract_index_ivf(index).nprobe = params['nprobe']
+
+
+def search_parameters(index, bitmap: np.ndarray):
+    """
+    SearchParameters restricting a search of index to the positions set in a packed bitmap.
+
+    The index's own efSearch or nprobe is carried over, since parameters passed to a search replace them.
+    """
+    selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+    index = unwrap_id_map(index)
+    if isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    elif isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # The selector reads the bitmap without owning it
+    params.referenced_objects = [selector, bitmap]
+    return params
+
+
+def save_index_config(config: dict, config_path: str):
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def load_index_config(config_path: str) -> dict:
+    """Load an index config, falling back to a flat index when the file does not exist."""
+    if not os.path.exists(config_path):
+        return {'index_type': 'flat', 'params': {}}
+    with open(config_path, 'r') as f:
+        return json.load(f)
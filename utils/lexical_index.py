@@ -0,0 +1,138 @@
+import math
+import re
+from typing import List
+
+import numpy as np
+
+from utils.metadata_filters import bitmap_contains
+
+# Identifiers such as vld1q_f32, __arm_sve, armv8.2-a or neoverse-n1 are kept as one token;
+# compound tokens are also split on '.' and '-' so their parts match on their own.
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+(?:[.\-][a-z0-9_]+)*")
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in into is it its me my no not of on or
+so than that the their them then there these they this to was we what when where which who why will with you your
+""".split())
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase and split text into terms, keeping identifiers intact and dropping stopwords."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if '.' in token or '-' in token:
+            tokens.extend(part for part in re.split(r"[.\-]", token) if part and part not in STOPWORDS)
+    return tokens
+
+
+def document_text(item: dict) -> str:
+    """The text indexed for a chunk: its title, keywords and content."""
+    return f"{item.get('title', '')}\n{item.get('keywords', '')}\n{item.get('original_text', '')}"
+
+
+def build_lexical_index(metadata) -> dict:
+    """
+    Build a BM25 inverted index over chunk metadata, in metadata order.
+
+    BM25 term weights do not depend on the query, so the full score contribution of every posting is
+    computed here, and a query only has to sum the postings of its terms.
+    """
+    postings = {}
+    doc_lengths = np.zeros(len(metadata), dtype=np.int32)
+    for doc, item in enumerate(metadata):
+        tokens = tokenize(document_text(item))
+        doc_lengths[doc] = len(tokens)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            postings.setdefault(token, []).append((doc, count))
+
+    num_docs = len(metadata)
+    average_length = float(doc_lengths.mean()) if num_docs else 0.0
+    vocab = sorted(postings)
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    docs = []
+    scores = []
+    for term_id, term in enumerate(vocab):
+        term_postings = postings[term]
+        idf = math.log(1 + (num_docs - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+        for doc, tf in term_postings:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[doc] / average_length)
+            docs.append(doc)
+            scores.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        offsets[term_id + 1] = len(docs)
+
+    return {
+        'vocab': np.array(vocab, dtype=np.str_),
+        'offsets': offsets,
+        'docs': np.array(docs, dtype=np.int32),
+        'scores': np.array(scores, dtype=np.float32),
+        'num_docs': np.array([num_docs], dtype=np.int64),
+    }
+
+
+def save_lexical_index(lexical_index: dict, index_path: str):
+    np.savez(index_path, **lexical_index)
+
+
+class LexicalIndex:
+    """BM25 search over an inverted index written by save_lexical_index."""
+
+    def __init__(self, index_path: str):
+        with np.load(index_path, allow_pickle=False) as data:
+            self.vocab = data['vocab']
+            self.offsets = data['offsets']
+            self.docs = data['docs']
+            self.scores = data['scores']
+            self.num_docs = int(data['num_docs'][0])
+
+    def term_id(self, term: str):
+        """Return the position of a term in the sorted vocabulary, or None if it does not occur."""
+        position = int(np.searchsorted(self.vocab, term))
+        if position < len(self.vocab) and self.vocab[position] == term:
+            return position
+        return None
+
+    def search(self, query: str, k: int = 5, bitmap: np.ndarray = None):
+        """Return the positions and BM25 scores of the k best matching chunks, best first, only among those set in bitmap if given."""
+        term_ids = [t for t in (self.term_id(term) for term in set(tokenize(query))) if t is not None]
+        if not term_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        docs = np.concatenate([self.docs[self.offsets[t]:self.offsets[t + 1]] for t in term_ids])
+        scores = np.concatenate([self.scores[self.offsets[t]:self.offsets[t + 1]] for t in term_ids])
+        if bitmap is not None:
+            allowed = bitmap_contains(bitmap, docs)
+            docs, scores = docs[allowed], scores[allowed]
+        # Sum the scores per document over the matched postings only
+        unique_docs, inverse = np.unique(docs, return_inverse=True)
+        totals = np.bincount(inverse, weights=scores)
+        top = np.argsort(-totals, kind='stable')[:k]
+        return unique_docs[top].astype(np.int64), totals[top].astype(np.float32)
+
+    def exact_identifier(self, query: str):
+        """
+        Return the term if the query is a single identifier-like term present in the index, else None.
+
+        Identifiers (instruction names, intrinsics, architecture names) contain a digit or an underscore,
+        e.g. vld1q_f32 or sve2. They are matched far better lexically than by embedding similarity.
+        """
+        candidate = query.strip().strip('`"\'?!.,:;()').lower()
+        if not candidate or TOKEN_PATTERN.fullmatch(candidate) is None:
+            return None
+        if not any(c.isdigit() or c == '_' for c in candidate):
+            return None
+        return candidate if self.term_id(candidate) is not None else None
+
+
+def reciprocal_rank_fusion(rankings, k: int = 60) -> list:
+    """Fuse several ranked lists of chunk positions into one, scoring each chunk with sum(1 / (k + rank))."""
+    fused = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            fused[doc] = fused.get(doc, 0.0) + 1.0 / (k + rank)
+    return sorted(fused, key=fused.get, reverse=True)
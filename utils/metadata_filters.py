@@ -0,0 +1,181 @@
+import re
+from array import array
+
+import numpy as np
+
+# Metadata fields a search can be restricted to. Values of one field are OR-ed, fields are AND-ed.
+FILTER_FIELDS = ['keywords', 'learning_path', 'category']
+
+LEARNING_PATH_URL = re.compile(r'/learning-paths/([^/]+)/([^/]+)')
+# Number of set bits in every byte value
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+
+
+def filter_values(item: dict) -> dict:
+    """
+    The values of every filter field of a chunk.
+
+    keywords are the comma-separated keywords of its Learning Path. A Learning Path URL such as
+    https://learn.arm.com/learning-paths/servers-and-cloud-computing/mongodb/... has category
+    "servers-and-cloud-computing" and learning_path "servers-and-cloud-computing/mongodb".
+    """
+    keywords = [keyword.strip().lower() for keyword in item.get('keywords', '').split(',') if keyword.strip()]
+    match = LEARNING_PATH_URL.search(item.get('url', ''))
+    return {
+        'keywords': keywords,
+        'learning_path': [f"{match.group(1)}/{match.group(2)}"] if match else [],
+        'category': [match.group(1)] if match else [],
+    }
+
+
+def build_filter_bitmaps(metadata) -> dict:
+    """
+    Index the chunk positions of every value of every filter field, in metadata order.
+
+    The chunks of a Learning Path are stored next to each other, so most values cover a few runs of
+    consecutive positions, which are stored as (start, end) ranges. A value whose ranges would take
+    more space than a bitmap of all chunks, such as a category, is stored as a bitmap packed 8 positions
+    to a byte with position p at bit p % 8 of byte p // 8, the layout of faiss.IDSelectorBitmap. The
+    size is thus bounded by the number of (chunk, value) pairs rather than values x chunks.
+    """
+    num_docs = len(metadata)
+    bitmap_size = (num_docs + 7) // 8
+    # A value switches to a bitmap once its ranges (16 bytes each) outgrow one
+    max_ranges = max(1, bitmap_size // 16)
+    values = {field: {} for field in FILTER_FIELDS}
+    for position, item in enumerate(metadata):
+        for field, field_values in filter_values(item).items():
+            for value in field_values:
+                entry = values[field].get(value)
+                if entry is None:
+                    values[field][value] = [array('q', [position]), array('q', [position + 1]), None]
+                elif entry[2] is not None:
+                    entry[2][position >> 3] |= 1 << (position & 7)
+                elif entry[1][-1] == position:
+                    entry[1][-1] = position + 1
+                elif entry[1][-1] < position:
+                    entry[0].append(position)
+                    entry[1].append(position + 1)
+                    if len(entry[0]) > max_ranges:
+                        entry[2] = np.zeros(bitmap_size, dtype=np.uint8)
+                        for start, end in zip(entry[0], entry[1]):
+                            fill_range(entry[2], start, end)
+                        entry[0], entry[1] = array('q'), array('q')
+
+    arrays = {'num_docs': np.array([num_docs], dtype=np.int64)}
+    for field in FILTER_FIELDS:
+        names = sorted(values[field])
+        entries = [values[field][name] for name in names]
+        is_dense = np.array([entry[2] is not None for entry in entries], dtype=bool)
+        dense = [entry[2] for entry in entries if entry[2] is not None]
+        arrays[f'{field}_values'] = np.array(names, dtype=np.str_)
+        # Row of each value in the bitmaps, or -1 for values stored as ranges
+        arrays[f'{field}_rows'] = np.where(is_dense, np.cumsum(is_dense) - 1, -1).astype(np.int64)
+        arrays[f'{field}_offsets'] = np.concatenate([[0], np.cumsum([len(entry[0]) for entry in entries])]).astype(np.int64)
+        arrays[f'{field}_starts'] = np.array([start for entry in entries for start in entry[0]], dtype=np.int64)
+        arrays[f'{field}_ends'] = np.array([end for entry in entries for end in entry[1]], dtype=np.int64)
+        arrays[f'{field}_bitmaps'] = np.vstack(dense) if dense else np.zeros((0, bitmap_size), dtype=np.uint8)
+    return arrays
+
+
+def save_filter_bitmaps(bitmaps: dict, bitmaps_path: str):
+    np.savez(bitmaps_path, **bitmaps)
+
+
+def bitmap_count(bitmap: np.ndarray) -> int:
+    """Number of positions set in a packed bitmap."""
+    return int(POPCOUNT[bitmap].sum())
+
+
+def bitmap_positions(bitmap: np.ndarray, num_docs: int) -> np.ndarray:
+    """The positions set in a packed bitmap, in increasing order."""
+    return np.flatnonzero(np.unpackbits(bitmap, count=num_docs, bitorder='little')).astype(np.int64)
+
+
+def bitmap_contains(bitmap: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Whether each of the given positions is set in a packed bitmap."""
+    positions = np.asarray(positions, dtype=np.int64)
+    return ((bitmap[positions >> 3] >> (positions & 7).astype(np.uint8)) & 1).astype(bool)
+
+
+def fill_range(bitmap: np.ndarray, start: int, end: int):
+    """Set positions start to end (exclusive) in a packed bitmap."""
+    if end <= start:
+        return
+    first, last = start >> 3, (end - 1) >> 3
+    head = (0xFF << (start & 7)) & 0xFF
+    tail = (1 << (((end - 1) & 7) + 1)) - 1
+    if first == last:
+        bitmap[first] |= head & tail
+    else:
+        bitmap[first] |= head
+        bitmap[first + 1:last] = 0xFF
+        bitmap[last] |= tail
+
+
+def slice_bitmap(bitmap: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """The part of a packed bitmap for positions start to stop, re-packed so that start is position 0."""
+    first = start // 8
+    bits = np.unpackbits(bitmap[first:(stop + 7) // 8], bitorder='little')[start - first * 8:stop - first * 8]
+    return np.packbits(bits, bitorder='little')
+
+
+class FilterBitmaps:
+    """The per-value ranges and bitmaps written by save_filter_bitmaps, combined into one bitmap per search filter."""
+
+    def __init__(self, bitmaps: dict):
+        self.num_docs = int(bitmaps['num_docs'][0])
+        self.values = {field: bitmaps[f'{field}_values'] for field in FILTER_FIELDS}
+        self.bitmaps = {field: bitmaps[f'{field}_bitmaps'] for field in FILTER_FIELDS}
+        empty = np.zeros(0, dtype=np.int64)
+        self.rows, self.offsets, self.starts, self.ends = {}, {}, {}, {}
+        for field in FILTER_FIELDS:
+            count = len(self.values[field])
+            # Files written before ranges were introduced hold a bitmap for every value
+            self.rows[field] = bitmaps.get(f'{field}_rows', np.arange(count, dtype=np.int64))
+            self.offsets[field] = bitmaps.get(f'{field}_offsets', np.zeros(count + 1, dtype=np.int64))
+            self.starts[field] = bitmaps.get(f'{field}_starts', empty)
+            self.ends[field] = bitmaps.get(f'{field}_ends', empty)
+
+    @classmethod
+    def load(cls, bitmaps_path: str):
+        with np.load(bitmaps_path, allow_pickle=False) as data:
+            return cls({name: data[name] for name in data.files})
+
+    def value_bitmap(self, field: str, wanted: list) -> np.ndarray:
+        """Packed bitmap of the chunks having any of the wanted values of a field."""
+        bitmap = np.zeros((self.num_docs + 7) // 8, dtype=np.uint8)
+        values = self.values[field]
+        for value, row in zip(wanted, np.searchsorted(values, wanted)):
+            if row >= len(values) or values[row] != value:
+                continue
+            if self.rows[field][row] >= 0:
+                bitmap |= self.bitmaps[field][self.rows[field][row]]
+            first, last = self.offsets[field][row], self.offsets[field][row + 1]
+            for start, end in zip(self.starts[field][first:last].tolist(), self.ends[field][first:last].tolist()):
+                fill_range(bitmap, start, end)
+        return bitmap
+
+    def bitmap(self, filters: dict) -> np.ndarray:
+        """
+        Combine the ranges and bitmaps of a search filter into one bitmap.
+
+        Args:
+        filters (dict): Maps filter fields to a value or a list of values, e.g.
+            {'category': 'servers-and-cloud-computing', 'keywords': ['neon', 'sve']}.
+
+        Returns:
+        np.ndarray: Packed bitmap of the chunks matching any value of every given field.
+        """
+        combined = np.full((self.num_docs + 7) // 8, 0xFF, dtype=np.uint8)
+        for field, wanted in filters.items():
+            if field not in self.values:
+                raise ValueError(f"Unknown filter field '{field}', expected one of {FILTER_FIELDS}")
+            wanted = [wanted] if isinstance(wanted, str) else list(wanted)
+            if field == 'keywords':
+                wanted = [value.lower() for value in wanted]
+            combined &= self.value_bitmap(field, wanted)
+        # Clear the padding bits past the last chunk
+        if self.num_docs % 8:
+            combined[-1] &= (1 << (self.num_docs % 8)) - 1
+        return combined
@@ -0,0 +1,86 @@
+import json
+import mmap
+import struct
+
+import numpy as np
+
+# File layout, all integers little-endian:
+#   8 bytes   magic
+#   uint64    number of records n
+#   uint64    n + 1 offsets of each record, relative to the start of the data section
+#   data      the records, each one UTF-8 encoded JSON
+MAGIC = b"RAGMETA1"
+HEADER = struct.Struct("<8sQ")
+
+
+def write_metadata_store(metadata, store_path: str):
+    """
+    Write metadata dictionaries to an offset-indexed binary store.
+
+    metadata can be a list, or any sized iterable producing the records one at a time, which are then
+    written without holding them all in memory.
+    """
+    count = len(metadata)
+    offsets = np.zeros(count + 1, dtype='<u8')
+    with open(store_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count))
+        # The offset table is written once all record sizes are known
+        f.seek(HEADER.size + offsets.nbytes)
+        position = 0
+        for i, item in enumerate(metadata):
+            record = json.dumps(item, separators=(',', ':')).encode('utf-8')
+            f.write(record)
+            position += len(record)
+            offsets[i + 1] = position
+        f.seek(HEADER.size)
+        f.write(offsets.tobytes())
+
+
+def write_metadata_json(store, json_path: str):
+    """Write the records of a MetadataStore to a JSON array, one record per line, copying them without decoding."""
+    with open(json_path, 'wb') as f:
+        f.write(b'[')
+        for idx in range(len(store)):
+            f.write(b'\n' if idx == 0 else b',\n')
+            f.write(store.record(idx))
+        f.write(b'\n]\n')
+
+
+class MetadataStore:
+    """
+    Read-only, memory-mapped view of a store written by write_metadata_store.
+
+    Opening the store only maps the file; a record is decoded when it is indexed. Pages are
+    shared through the OS page cache by every process that opens the same file.
+    """
+
+    def __init__(self, store_path: str):
+        with open(store_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{store_path} is not a metadata store")
+        self._count = count
+        self._offsets = np.frombuffer(self._mmap, dtype='<u8', count=count + 1, offset=HEADER.size)
+        self._data_start = HEADER.size + self._offsets.nbytes
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        return json.loads(self.record(idx))
+
+    def record(self, idx) -> bytes:
+        """Return the JSON encoding of a record, without decoding it."""
+        idx = int(idx)
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError(f"metadata index {idx} out of range")
+        start = self._data_start + int(self._offsets[idx])
+        end = self._data_start + int(self._offsets[idx + 1])
+        return self._mmap[start:end]
+
+    def __iter__(self):
+        for idx in range(self._count):
+            yield self[idx]
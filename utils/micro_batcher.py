@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """
+    Coalesce single-item calls arriving from concurrent requests into batched calls.
+
+    Items submitted with the same key within window_ms of the first one are passed together to
+    batch_fn(key, items), which must return one result per item in the same order. A batch is
+    dispatched early once it holds max_batch_size items. Items with different keys are never
+    batched together, e.g. requests authenticated with different tokens.
+
+    Args:
+    batch_fn: Callable taking a key and a list of items and returning a list of results.
+    window_ms (float): How long to wait for more items after the first item of a batch arrives.
+    max_batch_size (int): Maximum number of items per batch.
+    max_in_flight (int): Maximum number of batches executed concurrently.
+    """
+
+    def __init__(self, batch_fn, window_ms: float = 10, max_batch_size: int = 32, max_in_flight: int = 4):
+        self.batch_fn = batch_fn
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._pid = None
+        self.batches = 0
+        self.items = 0
+
+    def _start(self):
+        # Started lazily, and again after a fork, since threads do not survive fork().
+        self._pid = os.getpid()
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, item, key=None) -> Future:
+        """Queue an item and return a Future resolved with its result once its batch has run."""
+        future = Future()
+        with self._cond:
+            if self._pid != os.getpid():
+                self._start()
+            batch = self._pending.setdefault(key, {'deadline': time.monotonic() + self.window, 'entries': []})
+            batch['entries'].append((item, future))
+            self._cond.notify()
+        return future
+
+    def __call__(self, item, key=None):
+        return self.submit(item, key).result()
+
+    def _take_ready(self):
+        """Remove and return the batches that are full or past their deadline, and the time until the next deadline."""
+        now = time.monotonic()
+        ready = []
+        next_deadline = None
+        for key in list(self._pending):
+            batch = self._pending[key]
+            if len(batch['entries']) >= self.max_batch_size or batch['deadline'] <= now:
+                entries = batch['entries']
+                ready.append((key, entries[:self.max_batch_size]))
+                if len(entries) > self.max_batch_size:
+                    batch['entries'] = entries[self.max_batch_size:]
+                else:
+                    del self._pending[key]
+            elif next_deadline is None or batch['deadline'] < next_deadline:
+                next_deadline = batch['deadline']
+        timeout = None if next_deadline is None else max(0.0, next_deadline - now)
+        return ready, timeout
+
+    def _run(self):
+        while True:
+            with self._cond:
+                ready, timeout = self._take_ready()
+                while not ready:
+                    self._cond.wait(timeout)
+                    ready, timeout = self._take_ready()
+            for key, entries in ready:
+                self._executor.submit(self._execute, key, entries)
+
+    def _execute(self, key, entries):
+        self.batches += 1
+        self.items += len(entries)
+        try:
+            results = self.batch_fn(key, [item for item, _ in entries])
+        except Exception as e:
+            for _, future in entries:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(entries, results):
+            future.set_result(result)
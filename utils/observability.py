@@ -0,0 +1,218 @@
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Trace of the request being served, and its start time and stage durations. Worker threads started with
+# asyncio.to_thread or contextvars.copy_context see the same trace.
+TRACE_ID = contextvars.ContextVar('trace_id', default='-')
+TRACE_START = contextvars.ContextVar('trace_start', default=None)
+TRACE_STAGES = contextvars.ContextVar('trace_stages', default=None)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the trace ID of the current request to every record, on the thread that logs it."""
+
+    def filter(self, record):
+        record.trace_id = TRACE_ID.get()
+        return True
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues log records for a listener thread that writes them to the target handler, so a request never
+    waits on stdout. The listener is started lazily, and again after a fork, since threads do not survive fork().
+    """
+
+    def __init__(self, target: logging.Handler):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            self._pid = os.getpid()
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        self.queue.put_nowait(record)
+
+
+def create_logger() -> logging.Logger:
+    """Create the application logger, writing leveled, trace-tagged lines to stdout through a background thread."""
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(logging.Formatter("%(asctime)s %(levelname)s trace=%(trace_id)s %(name)s: %(message)s"))
+    handler = BackgroundQueueHandler(target)
+    handler.addFilter(TraceIdFilter())
+    logger = logging.getLogger("copilot")
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    return logger
+
+
+LOGGER = create_logger()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Return the logger of a module, e.g. get_logger(__name__)."""
+    return LOGGER.getChild(name)
+
+
+logger = get_logger(__name__)
+
+
+class _NullMetric:
+    """Stands in for a metric when prometheus_client is not installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+
+def _histogram(name: str, documentation: str, labelnames, buckets):
+    if prometheus_client is None:
+        return _NullMetric()
+    return prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+THROUGHPUT_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+STAGE_SECONDS = _histogram('copilot_stage_seconds', 'Duration of each stage of an /agent request.', ['stage'], LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = _histogram('copilot_time_to_first_token_seconds', 'Time from receiving an /agent request to streaming its first chunk.', ['source'], LATENCY_BUCKETS)
+STREAM_SECONDS = _histogram('copilot_stream_seconds', 'Time from receiving an /agent request to streaming its last chunk.', ['source'], LATENCY_BUCKETS)
+STREAM_BYTES = _histogram('copilot_stream_bytes', 'Bytes streamed in answer to an /agent request.', ['source'], SIZE_BUCKETS)
+STREAM_THROUGHPUT = _histogram('copilot_stream_bytes_per_second', 'Bytes per second streamed between the first and last chunk of an /agent answer.', ['source'], THROUGHPUT_BUCKETS)
+REQUESTS = prometheus_client.Counter('copilot_agent_requests', 'Handled /agent requests by outcome.', ['outcome']) if prometheus_client else _NullMetric()
+
+
+def start_trace(copilot_thread_id: str = None) -> str:
+    """
+    Start the trace of a new request and return its ID.
+
+    The ID starts with the copilot_thread_id when it is known, so all turns of a conversation can be
+    found together, followed by a random per-request part.
+    """
+    request_id = uuid.uuid4().hex[:12]
+    TRACE_ID.set(f"{copilot_thread_id}/{request_id}" if copilot_thread_id else request_id)
+    TRACE_START.set(time.perf_counter())
+    TRACE_STAGES.set({})
+    return TRACE_ID.get()
+
+
+def trace_thread(copilot_thread_id: str) -> str:
+    """Prefix the ID of the current trace with the copilot_thread_id once the request body is parsed."""
+    if copilot_thread_id:
+        TRACE_ID.set(f"{copilot_thread_id}/{TRACE_ID.get().rsplit('/', 1)[-1]}")
+    return TRACE_ID.get()
+
+
+@contextmanager
+def span(stage: str):
+    """Time a stage of the current request, recording it in the stage histogram and the trace."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        stages = TRACE_STAGES.get()
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + elapsed
+        logger.debug(f"stage={stage} duration_ms={elapsed * 1000:.1f}")
+
+
+class StreamStats:
+    """
+    Measures an answer stream: time to first chunk and total duration from the start of the trace, bytes and
+    writes sent, and the throughput between the first and last chunk.
+
+    Args:
+    source (str): Where the answer comes from, "llm" or "cache".
+    """
+
+    def __init__(self, source: str = "llm"):
+        self.source = source
+        self.start = TRACE_START.get() or time.perf_counter()
+        self.first_chunk = None
+        self.bytes = 0
+        self.writes = 0
+
+    def chunk(self, chunk: bytes):
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter() - self.start
+            TIME_TO_FIRST_TOKEN.labels(self.source).observe(self.first_chunk)
+        self.bytes += len(chunk)
+        self.writes += 1
+
+    def finish(self, events: int = None):
+        """
+        Record the finished stream and log a summary of the request with the duration of every stage.
+
+        Args:
+        events (int): Number of server-sent events relayed, when the stream was regrouped into events.
+        """
+        duration = time.perf_counter() - self.start
+        STREAM_SECONDS.labels(self.source).observe(duration)
+        STREAM_BYTES.labels(self.source).observe(self.bytes)
+        streaming = duration - self.first_chunk if self.first_chunk is not None else 0.0
+        throughput = f"{self.bytes / streaming:.0f}" if streaming > 0 else "-"
+        if streaming > 0:
+            STREAM_THROUGHPUT.labels(self.source).observe(self.bytes / streaming)
+        stages = " ".join(f"{stage}_ms={seconds * 1000:.1f}" for stage, seconds in (TRACE_STAGES.get() or {}).items())
+        ttft = f"{self.first_chunk * 1000:.1f}" if self.first_chunk is not None else "-"
+        counts = f"writes={self.writes}" + (f" events={events}" if events is not None else "")
+        logger.info(f"answer source={self.source} ttft_ms={ttft} duration_ms={duration * 1000:.1f} bytes={self.bytes} "
+                    f"{counts} bytes_per_s={throughput} {stages}".rstrip())
+
+
+def metrics_response():
+    """
+    Return the body and content type of the /metrics endpoint, or None if prometheus_client is not installed.
+
+    When PROMETHEUS_MULTIPROC_DIR is set, e.g. by gunicorn.conf.py, the metrics of all worker processes are aggregated.
+    """
+    if prometheus_client is None:
+        return None
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    """Drop the live-process metrics of an exited worker, in multiprocess mode."""
+    if prometheus_client is not None and os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
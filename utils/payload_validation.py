@@ -7,6 +7,9 @@ import requests
 import hmac
 import hashlib
 import os
+from utils import observability
+
+logger = observability.get_logger(__name__)
 
 WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
 if not WEBHOOK_SECRET:
@@ -41,9 +44,12 @@ def verify_signature(payload_body, signature_header):
     return hmac.compare_digest(expected_signature, signature_header)
 
 
+# Where the keys that sign Copilot requests are published; configurable for local benchmarks.
+PUBLIC_KEYS_URL = os.getenv("COPILOT_PUBLIC_KEYS_URL", "https://api.github.com/meta/public_keys/copilot_api")
+
+
 def fetch_public_key():
-    url = "https://api.github.com/meta/public_keys/copilot_api"
-    response = requests.get(url)
+    response = requests.get(PUBLIC_KEYS_URL)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch public key: {response.status_code}")
 
@@ -77,5 +83,5 @@ def valid_payload(data, sig, public_key):
     except InvalidSignature:
         return False
     except Exception as e:
-        print(f"Error validating payload: {e}")
+        logger.error(f"Error validating payload: {e}")
         return False
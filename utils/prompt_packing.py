@@ -0,0 +1,80 @@
+from utils.tokens import count_tokens
+
+# Tokens the chat format adds around every message, and to prime the reply
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+
+
+def format_context(index: int, metadata: dict) -> str:
+    """Format one retrieved chunk as a numbered context block of the system message."""
+    return f"CONTEXT {index}\nTITLE:{metadata['title']}\nURL:{metadata['url']}\n\n{metadata['original_text']}\n\n"
+
+
+def message_tokens(message: dict) -> int:
+    content = message.get('content')
+    return MESSAGE_OVERHEAD + (count_tokens(content) if isinstance(content, str) else 0)
+
+
+class PromptPacker:
+    """
+    Packs the system message, ranked chunks and conversation history into a token budget.
+
+    The system message and the latest message are always sent. Chunks are added in rank order while
+    they fit, leaving room for the earlier messages up to history_budget tokens; earlier messages are
+    then added from the most recent backwards while the total stays within token_budget.
+
+    Args:
+    token_budget (int): Maximum number of prompt tokens.
+    history_budget (int): Tokens reserved for earlier messages of the conversation. Only as many as the
+        history needs are reserved, so a short thread leaves the rest to chunks, and a long thread never
+        takes more than this from the context.
+    """
+
+    def __init__(self, token_budget: int = 8000, history_budget: int = 2000):
+        self.token_budget = token_budget
+        self.history_budget = history_budget
+
+    def pack(self, system_message: str, results: list, messages: list):
+        """
+        Build the prompt messages.
+
+        Returns:
+        tuple: The prompt messages, the results whose chunks were included, and a report of the token counts.
+        """
+        latest, history = messages[-1:], messages[:-1]
+        used = REPLY_OVERHEAD + MESSAGE_OVERHEAD + count_tokens(system_message) + sum(message_tokens(m) for m in latest)
+
+        context_budget = self.token_budget - used - min(self.history_budget, sum(message_tokens(m) for m in history))
+        blocks = []
+        packed_results = []
+        context_tokens = 0
+        for result in results:
+            block = format_context(len(blocks) + 1, result['metadata'])
+            tokens = count_tokens(block)
+            if context_tokens + tokens > context_budget:
+                continue
+            blocks.append(block)
+            packed_results.append(result)
+            context_tokens += tokens
+        used += context_tokens
+
+        kept_history = []
+        history_tokens = 0
+        for message in reversed(history):
+            tokens = message_tokens(message)
+            if used + history_tokens + tokens > self.token_budget:
+                break
+            kept_history.append(message)
+            history_tokens += tokens
+        kept_history.reverse()
+
+        prompt_messages = [{"role": "system", "content": system_message + "".join(blocks)}] + kept_history + latest
+        report = {
+            "total": used + history_tokens,
+            "context": context_tokens,
+            "history": history_tokens,
+            "chunks": len(packed_results),
+            "dropped_chunks": len(results) - len(packed_results),
+            "dropped_messages": len(history) - len(kept_history),
+        }
+        return prompt_messages, packed_results, report
@@ -0,0 +1,117 @@
+import numpy as np
+
+from utils import observability
+
+logger = observability.get_logger(__name__)
+
+DEFAULT_CROSS_ENCODER = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+
+
+def _unit_rows(vectors) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def mmr(relevance: np.ndarray, embeddings: np.ndarray, k: int, lambda_mult: float = 0.5, max_similarity: float = None) -> list:
+    """
+    Order candidates by maximal marginal relevance and return the positions of up to k of them.
+
+    Each step picks the candidate maximizing lambda_mult * relevance - (1 - lambda_mult) * (highest cosine
+    similarity to an already picked candidate), so a chunk that repeats a picked one loses to a less
+    relevant chunk that adds something new.
+
+    Args:
+    relevance (np.ndarray): Relevance of each candidate to the query, e.g. cosine similarity.
+    embeddings (np.ndarray): Candidate embeddings, one row per candidate.
+    k (int): Maximum number of candidates to pick.
+    lambda_mult (float): 1 ranks by relevance only, 0 by diversity only.
+    max_similarity (float): If set, candidates whose cosine similarity to a picked candidate exceeds it are
+        dropped, so fewer than k chunks are returned when the rest would mostly repeat them.
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    similarities = _unit_rows(embeddings) @ _unit_rows(embeddings).T
+    redundancy = np.full(len(relevance), -np.inf, dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    picked = []
+    while len(picked) < k and available.any():
+        if picked:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarities[best])
+        if max_similarity is not None:
+            available &= redundancy <= max_similarity
+    return picked
+
+
+class CrossEncoder:
+    """Local cross-encoder that scores (query, chunk) pairs jointly, which ranks more precisely than embedding similarity."""
+
+    def __init__(self, model_name: str = DEFAULT_CROSS_ENCODER, max_length: int = 512):
+        # Imported here so deployments without re-ranking do not need PyTorch and transformers
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        logger.info(f"Loading cross-encoder {model_name}")
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+        self.max_length = max_length
+
+    def score(self, query: str, texts: list) -> np.ndarray:
+        """Return a relevance in [0, 1] for every text."""
+        encoded = self.tokenizer([query] * len(texts), texts, padding=True, truncation=True, max_length=self.max_length, return_tensors='pt')
+        with self.torch.inference_mode():
+            logits = self.model(**encoded).logits[:, 0]
+        return self.torch.sigmoid(logits).numpy().astype(np.float32)
+
+
+class Reranker:
+    """
+    Re-ranking stage between retrieval and prompt building.
+
+    Retrieval fetches `candidates` times more chunks than are sent to the LLM. They are scored by
+    cosine similarity to the query, or by a cross-encoder if one is configured, and the final chunks
+    are picked by maximal marginal relevance so near-duplicate chunks do not fill the context.
+
+    Args:
+    mmr_lambda (float): Trade-off between relevance (1) and diversity (0).
+    candidates (int): Over-fetch factor of retrieval.
+    max_similarity (float): Drop chunks more similar than this to an already picked chunk. None keeps k chunks.
+    cross_encoder_model (str): Name of a local cross-encoder model, None to score with embeddings only.
+    """
+
+    def __init__(self, mmr_lambda: float = 0.5, candidates: int = 3, max_similarity: float = None, cross_encoder_model: str = None):
+        self.mmr_lambda = mmr_lambda
+        self.candidates = candidates
+        self.max_similarity = max_similarity
+        self.cross_encoder = CrossEncoder(cross_encoder_model) if cross_encoder_model else None
+
+    def rerank(self, query: str, query_embedding, results: list, embeddings: np.ndarray, k: int) -> list:
+        """
+        Pick up to k of the retrieved results.
+
+        Args:
+        query (str): The user's question.
+        query_embedding: Its embedding, or None if it was not embedded (lexical fast path).
+        results (list): Retrieved result dictionaries, best first.
+        embeddings (np.ndarray): Stored embedding of every result, one row per result.
+        k (int): Maximum number of results to keep.
+        """
+        if len(results) <= 1:
+            return results[:k]
+        if self.cross_encoder is not None:
+            relevance = self.cross_encoder.score(query, [result['metadata']['original_text'] for result in results])
+        elif query_embedding is not None:
+            relevance = (_unit_rows(embeddings) @ _unit_rows(query_embedding).T).ravel()
+        else:
+            # Without a query embedding, fall back on the retrieval order
+            relevance = np.linspace(1.0, 0.0, len(results), dtype=np.float32)
+        picked = mmr(relevance, embeddings, k, self.mmr_lambda, self.max_similarity)
+        return [dict(results[i], rank=rank) for rank, i in enumerate(picked, 1)]
@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def url_ids(metadata) -> np.ndarray:
+    """Map every chunk, in metadata order, to an integer ID of its page URL."""
+    ids = {}
+    return np.array([ids.setdefault(item.get('url', ''), len(ids)) for item in metadata], dtype=np.int32)
+
+
+def select_diverse(distances: np.ndarray, indices: np.ndarray, chunk_urls: np.ndarray, k: int, threshold: float):
+    """
+    Pick up to k results per query from a batch of FAISS search results, at most one per page URL.
+
+    Args:
+    distances (np.ndarray): (n, m) distances, each row sorted in increasing order as FAISS returns them.
+    indices (np.ndarray): (n, m) metadata positions, -1 where there is no result.
+    chunk_urls (np.ndarray): URL ID of every metadata position.
+    k (int): Number of results to keep per query.
+    threshold (float): Results at this distance or further are dropped.
+
+    Returns:
+    np.ndarray: (n, m) boolean mask of the kept results. The closest chunk of each URL is kept.
+    """
+    n, m = indices.shape
+    valid = (indices >= 0) & (distances < threshold)
+    # One key per (query, URL) pair, so duplicates are found for the whole batch at once
+    keys = np.arange(n, dtype=np.int64)[:, None] * (int(chunk_urls.max(initial=0)) + 1) + chunk_urls[np.where(valid, indices, 0)]
+    keys = np.where(valid, keys, -1).ravel()
+    unique_keys, first = np.unique(keys, return_index=True)
+    keep = np.zeros(n * m, dtype=bool)
+    keep[first[unique_keys >= 0]] = True
+    keep = keep.reshape(n, m)
+    keep &= np.cumsum(keep, axis=1) <= k
+    return keep
+
+
+def first_per_url(positions: np.ndarray, chunk_urls: np.ndarray, k: int) -> np.ndarray:
+    """Keep the first chunk of each URL in a ranked array of metadata positions, up to k of them."""
+    positions = np.asarray(positions, dtype=np.int64)
+    _, first = np.unique(chunk_urls[positions], return_index=True)
+    return positions[np.sort(first)[:k]]
+
+
+def range_results(lims: np.ndarray, distances: np.ndarray, indices: np.ndarray, chunk_urls: np.ndarray, k: int):
+    """
+    Turn the output of a FAISS range_search into up to k (positions, distances) per query, one per URL.
+
+    Range search returns every chunk within the radius, unordered, so each query's hits are sorted first.
+    """
+    results = []
+    for start, end in zip(lims[:-1], lims[1:]):
+        order = np.argsort(distances[start:end], kind='stable')
+        hits, hit_distances = indices[start:end][order], distances[start:end][order]
+        _, first = np.unique(chunk_urls[hits], return_index=True)
+        first = np.sort(first)[:k]
+        results.append((hits[first], hit_distances[first]))
+    return results
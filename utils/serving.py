@@ -0,0 +1,52 @@
+import gc
+import os
+import sys
+
+from utils import observability
+
+logger = observability.get_logger(__name__)
+
+
+def worker_layout(cores: int = None, workers: int = None, search_threads: int = None):
+    """
+    Split the cores between worker processes and the FAISS OpenMP threads of each worker.
+
+    Either number can be fixed and the other is derived from it, so that workers x search_threads
+    does not exceed the cores. With neither fixed, every core runs one single-threaded worker, which
+    suits many concurrent small searches best.
+
+    Returns:
+    tuple: The number of workers and of search threads per worker.
+    """
+    cores = cores or os.cpu_count() or 1
+    if workers is None and search_threads is None:
+        search_threads = 1
+    if workers is None:
+        workers = max(1, cores // search_threads)
+    if search_threads is None:
+        search_threads = max(1, cores // workers)
+    if workers * search_threads > cores:
+        logger.warning(f"{workers} workers x {search_threads} search threads oversubscribe {cores} cores")
+    return workers, search_threads
+
+
+def freeze_preloaded_objects():
+    """
+    Move everything loaded so far into the permanent GC generation, in the master process just before forking.
+
+    The garbage collector writes to the header of every object it visits, which would copy the pages
+    holding the preloaded index metadata into each worker. Frozen objects are never visited.
+    """
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Froze {gc.get_freeze_count()} preloaded objects before forking workers")
+
+
+def set_search_threads(search_threads: int, embedding_threads: int = None):
+    """Set the OpenMP threads FAISS searches with, and the threads of the local embedding model if one is loaded."""
+    import faiss
+    faiss.omp_set_num_threads(search_threads)
+    # PyTorch is only imported when the index was built with the local embedder
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(embedding_threads or search_threads)
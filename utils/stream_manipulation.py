@@ -1,17 +1,189 @@
-def get_chunk_template():
-    chunk_template = {
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {"content": ""},
-                                "logprobs": None,
-                                "finish_reason": None
-                            }
-                        ],
-                        "created": 0,
-                        "id": "",
-                        "model": "",
-                        "system_fingerprint": "",
-                        "object": "chat.completion.chunk"
-                    }
-    return chunk_template
\ No newline at end of file
+import asyncio
+import os
+import queue
+import threading
+import time
+from typing import AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, List
+
+# With STREAM_SSE_FRAMING=true (the default), the upstream server-sent events stream is relayed as whole
+# events, so a client never receives half an event. With false, upstream reads are forwarded as they arrive.
+STREAM_SSE_FRAMING = os.getenv("STREAM_SSE_FRAMING", "true").lower() == "true"
+
+# Complete events are held and sent in one write until STREAM_FLUSH_BYTES of them are pending or
+# STREAM_FLUSH_MS have passed since the previous write. Both default to 0, which sends the events of
+# every upstream read as soon as they are complete. The first write is never held.
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "0"))
+STREAM_FLUSH_MS = float(os.getenv("STREAM_FLUSH_MS", "0"))
+
+# Upstream reads held between the reading thread and a client that is slower than upstream
+READ_QUEUE_SIZE = 8
+
+
+class SSERelay:
+    """
+    Regroups the bytes of an upstream server-sent events stream into writes of whole events.
+
+    Events end with a blank line ("\\n\\n" or "\\r\\n\\r\\n"). Received bytes are scanned once for event
+    ends; the complete events are sent according to the flush policy and the incomplete tail is kept
+    for the next read. Whatever is left when the upstream stream ends is sent as it is.
+
+    With a time limit, relay and relay_async also send held events when the limit passes while upstream
+    is silent, so a pause of the model never delays events that were already received. With only a byte
+    limit, events are held until enough of them are pending or upstream ends.
+
+    Args:
+    flush_bytes (int): Send once this many bytes of complete events are pending. 0 for no byte limit.
+    flush_ms (float): Send once this long has passed since the previous write. 0 for no time limit.
+    sse_framing (bool): Regroup into whole events. If False, every upstream read is forwarded unchanged.
+    """
+
+    def __init__(self, flush_bytes: int = STREAM_FLUSH_BYTES, flush_ms: float = STREAM_FLUSH_MS, sse_framing: bool = STREAM_SSE_FRAMING):
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_ms / 1000
+        self.sse_framing = sse_framing
+        self.buffer = bytearray()
+        self.complete = 0           # Length of the complete events at the start of buffer
+        self.last_write = None
+        self.events = 0
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add bytes read from upstream and return the writes that are due, at most one."""
+        if not self.sse_framing:
+            return [data] if data else []
+        # An event end split between two reads starts in the last 2 bytes already received
+        start = max(self.complete, len(self.buffer) - 2)
+        self.buffer += data
+        end = max(self._event_end(b"\n\n", start), self._event_end(b"\n\r\n", start))
+        if end > self.complete:
+            self.events += self.buffer.count(b"\n\n", start, end) + self.buffer.count(b"\n\r\n", start, end)
+            self.complete = end
+        if self.complete and self._due():
+            return [self._take(self.complete)]
+        return []
+
+    def expire(self) -> List[bytes]:
+        """Return the held events if the time limit has passed."""
+        if self.complete and self.timeout() == 0:
+            return [self._take(self.complete)]
+        return []
+
+    def timeout(self):
+        """Seconds until held events are due by the time limit, or None if none are held or there is no time limit."""
+        if not self.complete or not self.flush_seconds:
+            return None
+        return max(0.0, self.last_write + self.flush_seconds - time.perf_counter())
+
+    def close(self) -> List[bytes]:
+        """Return the final write, with everything still held when upstream ends."""
+        return [self._take(len(self.buffer))] if self.buffer else []
+
+    def relay(self, chunks: Iterable[bytes], close_upstream: Callable[[], None] = None) -> Iterator[bytes]:
+        """
+        Relay the reads of an upstream response as writes to the client.
+
+        Args:
+        chunks (Iterable[bytes]): The upstream reads.
+        close_upstream (callable): Closes the upstream response. Called when the relay stops, also when the client
+            disconnects, so the thread reading upstream for the time limit stops reading.
+        """
+        if not (self.sse_framing and self.flush_seconds):
+            for data in chunks:
+                yield from self.feed(data)
+            yield from self.close()
+            return
+
+        # Upstream is read in a thread, so held events can be sent when their time is up between reads. The queue
+        # is small, so a slow client holds back reading upstream instead of buffering the answer in memory.
+        reads = queue.Queue(maxsize=READ_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def read():
+            try:
+                for data in chunks:
+                    if stopped.is_set():
+                        return
+                    reads.put(data)
+                if not stopped.is_set():
+                    reads.put(None)
+            except Exception as e:
+                if not stopped.is_set():
+                    reads.put(e)
+
+        threading.Thread(target=read, daemon=True).start()
+        try:
+            while True:
+                try:
+                    data = reads.get(timeout=self.timeout())
+                except queue.Empty:
+                    yield from self.expire()
+                    continue
+                if data is None:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                yield from self.feed(data)
+        finally:
+            stopped.set()
+            if close_upstream is not None:
+                close_upstream()
+            # A reader waiting for room in the queue puts its read and then sees it has to stop
+            while not reads.empty():
+                reads.get_nowait()
+        yield from self.close()
+
+    async def relay_async(self, chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+        """Asyncio version of relay."""
+        if not (self.sse_framing and self.flush_seconds):
+            async for data in chunks:
+                for write in self.feed(data):
+                    yield write
+            for write in self.close():
+                yield write
+            return
+
+        iterator = chunks.__aiter__()
+
+        async def next_read():
+            try:
+                return await iterator.__anext__()
+            except StopAsyncIteration:
+                return None
+
+        # The pending read is waited for without cancelling it, so a time-out cannot lose upstream bytes
+        pending = None
+        try:
+            while True:
+                pending = pending or asyncio.ensure_future(next_read())
+                done, _ = await asyncio.wait({pending}, timeout=self.timeout())
+                if not done:
+                    for write in self.expire():
+                        yield write
+                    continue
+                data, pending = pending.result(), None
+                if data is None:
+                    break
+                for write in self.feed(data):
+                    yield write
+        finally:
+            if pending is not None:
+                pending.cancel()
+        for write in self.close():
+            yield write
+
+    def _event_end(self, separator: bytes, start: int) -> int:
+        position = self.buffer.rfind(separator, start)
+        return position + len(separator) if position >= 0 else 0
+
+    def _due(self) -> bool:
+        if self.last_write is None or not (self.flush_bytes or self.flush_seconds):
+            return True
+        if self.flush_bytes and self.complete >= self.flush_bytes:
+            return True
+        return bool(self.flush_seconds) and time.perf_counter() - self.last_write >= self.flush_seconds
+
+    def _take(self, length: int) -> bytes:
+        write = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self.complete -= min(length, self.complete)
+        self.last_write = time.perf_counter()
+        return write
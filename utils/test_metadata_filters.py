@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+from utils.metadata_filters import (FILTER_FIELDS, FilterBitmaps, bitmap_contains, bitmap_count, bitmap_positions,
+                                    build_filter_bitmaps, fill_range, filter_values, save_filter_bitmaps, slice_bitmap)
+
+CATEGORIES = ['servers-and-cloud-computing', 'embedded-and-microcontrollers', 'laptops-and-desktops']
+KEYWORDS = ['linux', 'neon', 'sve', 'docker', 'python']
+
+
+def synthetic_metadata(learning_paths: int = 60, seed: int = 0) -> list:
+    """Chunks stored Learning Path by Learning Path, like the vector store builder writes them."""
+    rng = np.random.default_rng(seed)
+    metadata = []
+    for path in range(learning_paths):
+        category = CATEGORIES[path % len(CATEGORIES)]
+        keywords = ', '.join(KEYWORDS[i] for i in rng.choice(len(KEYWORDS), size=rng.integers(0, 3), replace=False))
+        for page in range(rng.integers(1, 12)):
+            metadata.append({
+                'url': f"https://learn.arm.com/learning-paths/{category}/path-{path}/page-{page}/",
+                'keywords': keywords.upper() if path % 7 == 0 else keywords,
+            })
+    # Chunks outside any Learning Path have no category or learning_path
+    metadata.insert(0, {'url': 'https://learn.arm.com/install-guides/gcc/', 'keywords': 'GCC'})
+    return metadata
+
+
+def brute_force(metadata, field: str, wanted) -> np.ndarray:
+    return np.array([position for position, item in enumerate(metadata)
+                     if set(filter_values(item)[field]) & set(wanted)], dtype=np.int64)
+
+
+def test_filter_values():
+    item = {'url': 'https://learn.arm.com/learning-paths/servers-and-cloud-computing/mongodb/intro/',
+            'keywords': 'MongoDB, databases ,, '}
+    assert filter_values(item) == {
+        'keywords': ['mongodb', 'databases'],
+        'learning_path': ['servers-and-cloud-computing/mongodb'],
+        'category': ['servers-and-cloud-computing'],
+    }
+    assert filter_values({}) == {'keywords': [], 'learning_path': [], 'category': []}
+
+
+def test_fill_range_matches_brute_force():
+    for size in (1, 8, 9, 24):
+        for start in range(size + 1):
+            for end in range(size + 1):
+                bitmap = np.zeros((size + 7) // 8, dtype=np.uint8)
+                fill_range(bitmap, start, end)
+                assert bitmap_positions(bitmap, size).tolist() == list(range(start, end))
+
+
+def test_bitmap_helpers():
+    positions = np.array([0, 3, 7, 8, 15, 16, 29])
+    bitmap = np.zeros(4, dtype=np.uint8)
+    for position in positions:
+        fill_range(bitmap, position, position + 1)
+    assert bitmap_count(bitmap) == len(positions)
+    assert bitmap_positions(bitmap, 30).tolist() == positions.tolist()
+    assert bitmap_contains(bitmap, np.arange(30)).nonzero()[0].tolist() == positions.tolist()
+    assert bitmap_positions(slice_bitmap(bitmap, 3, 17), 14).tolist() == (positions[(positions >= 3) & (positions < 17)] - 3).tolist()
+
+
+def test_values_are_stored_as_ranges_or_bitmaps():
+    metadata = synthetic_metadata()
+    bitmaps = build_filter_bitmaps(metadata)
+    filters = FilterBitmaps(bitmaps)
+    assert filters.num_docs == len(metadata)
+    # The pages of a Learning Path are one run of positions
+    assert (bitmaps['learning_path_rows'] == -1).all()
+    assert np.diff(bitmaps['learning_path_offsets']).tolist() == [1] * len(bitmaps['learning_path_values'])
+    # A category is spread over every third Learning Path, more runs than fit in the size of a bitmap
+    assert (bitmaps['category_rows'] >= 0).all()
+    assert bitmaps['category_bitmaps'].shape == (len(CATEGORIES), (len(metadata) + 7) // 8)
+    assert len(bitmaps['category_starts']) == 0
+
+
+@pytest.mark.parametrize('field', FILTER_FIELDS)
+def test_every_value_matches_brute_force(field):
+    metadata = synthetic_metadata()
+    filters = FilterBitmaps(build_filter_bitmaps(metadata))
+    for value in filters.values[field].tolist():
+        positions = bitmap_positions(filters.value_bitmap(field, [value]), filters.num_docs)
+        assert positions.tolist() == brute_force(metadata, field, [value]).tolist()
+
+
+def test_combined_filter_matches_brute_force():
+    metadata = synthetic_metadata()
+    filters = FilterBitmaps(build_filter_bitmaps(metadata))
+    wanted = {'category': CATEGORIES[0], 'keywords': ['NEON', 'sve', 'unknown']}
+    expected = np.intersect1d(brute_force(metadata, 'category', [CATEGORIES[0]]),
+                              brute_force(metadata, 'keywords', ['neon', 'sve']))
+    bitmap = filters.bitmap(wanted)
+    assert bitmap_positions(bitmap, filters.num_docs).tolist() == expected.tolist()
+    assert bitmap_count(bitmap) == len(expected)
+
+
+def test_empty_filter_matches_every_chunk_and_no_padding():
+    metadata = synthetic_metadata()
+    filters = FilterBitmaps(build_filter_bitmaps(metadata))
+    assert len(metadata) % 8
+    assert bitmap_count(filters.bitmap({})) == len(metadata)
+    assert bitmap_count(filters.bitmap({'learning_path': 'no/such-path'})) == 0
+
+
+def test_unknown_field_is_rejected():
+    filters = FilterBitmaps(build_filter_bitmaps(synthetic_metadata()))
+    with pytest.raises(ValueError):
+        filters.bitmap({'author': 'someone'})
+
+
+def test_save_and_load(tmp_path):
+    metadata = synthetic_metadata()
+    path = str(tmp_path / 'filter_bitmaps.npz')
+    save_filter_bitmaps(build_filter_bitmaps(metadata), path)
+    filters = FilterBitmaps.load(path)
+    for value in KEYWORDS:
+        positions = bitmap_positions(filters.bitmap({'keywords': value}), filters.num_docs)
+        assert positions.tolist() == brute_force(metadata, 'keywords', [value]).tolist()
+
+
+def test_loads_files_with_a_bitmap_for_every_value():
+    metadata = synthetic_metadata()
+    bitmaps = build_filter_bitmaps(metadata)
+    # The layout written before ranges: one dense bitmap per value and no range arrays
+    old = {'num_docs': bitmaps['num_docs']}
+    for field in FILTER_FIELDS:
+        old[f'{field}_values'] = bitmaps[f'{field}_values']
+        old[f'{field}_bitmaps'] = np.vstack([FilterBitmaps(bitmaps).value_bitmap(field, [value])
+                                             for value in bitmaps[f'{field}_values'].tolist()])
+    filters = FilterBitmaps(old)
+    for field in FILTER_FIELDS:
+        for value in filters.values[field].tolist():
+            positions = bitmap_positions(filters.value_bitmap(field, [value]), filters.num_docs)
+            assert positions.tolist() == brute_force(metadata, field, [value]).tolist()
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.stream_manipulation import READ_QUEUE_SIZE, SSERelay
+
+
+def relay_all(relay: SSERelay, reads) -> list:
+    writes = [write for data in reads for write in relay.feed(data)]
+    return writes + relay.close()
+
+
+def paused(reads, pause: float, after: int):
+    """Upstream reads with a pause of the model after the first `after` of them."""
+    for i, data in enumerate(reads):
+        if i == after:
+            time.sleep(pause)
+        yield data
+
+
+def timed(writes) -> list:
+    start = time.perf_counter()
+    return [(write, time.perf_counter() - start) for write in writes]
+
+
+def test_writes_are_whole_events():
+    reads = [b"data: a\n\ndata: b", b"c\n\nda", b"ta: d\n\n"]
+    assert relay_all(SSERelay(0, 0, True), reads) == [b"data: a\n\n", b"data: bc\n\n", b"data: d\n\n"]
+
+
+def test_crlf_events():
+    reads = [b"data: a\r\n\r\ndata: b\r\n", b"\r\ndata: c"]
+    relay = SSERelay(0, 0, True)
+    assert relay_all(relay, reads) == [b"data: a\r\n\r\n", b"data: b\r\n\r\n", b"data: c"]
+    assert relay.events == 2
+
+
+def test_event_end_split_across_reads():
+    # Every split of the blank line between two reads, byte by byte in the worst case
+    stream = b"data: one\n\ndata: two\r\n\r\ndata: three\n\n"
+    relay = SSERelay(0, 0, True)
+    writes = relay_all(relay, [stream[i:i + 1] for i in range(len(stream))])
+    assert writes == [b"data: one\n\n", b"data: two\r\n\r\n", b"data: three\n\n"]
+    assert relay.events == 3
+
+
+def test_incomplete_tail_is_sent_when_upstream_ends():
+    relay = SSERelay(0, 0, True)
+    assert relay.feed(b"data: a\n\ndata: [DO") == [b"data: a\n\n"]
+    assert relay.feed(b"NE]") == []
+    assert relay.close() == [b"data: [DONE]"]
+    assert relay.close() == []
+
+
+def test_byte_limit_holds_events_after_the_first_write():
+    relay = SSERelay(flush_bytes=16, flush_ms=0, sse_framing=True)
+    assert relay.feed(b"data: 1\n\n") == [b"data: 1\n\n"]
+    assert relay.feed(b"data: 2\n\n") == []
+    assert relay.feed(b"data: 3\n\ndata: 4") == [b"data: 2\n\ndata: 3\n\n"]
+    assert relay.close() == [b"data: 4"]
+
+
+def test_without_framing_reads_are_forwarded_unchanged():
+    reads = [b"data: a", b"\n", b"\ndata: b\n\n", b""]
+    assert relay_all(SSERelay(flush_bytes=1000, flush_ms=1000, sse_framing=False), reads) == reads[:3]
+
+
+def test_time_limit_sends_held_events_while_upstream_pauses():
+    reads = [b"data: 1\n\n", b"data: 2\n\n", b"data: 3\n\n"]
+    relay = SSERelay(flush_bytes=0, flush_ms=50, sse_framing=True)
+    writes = timed(relay.relay(paused(reads, 0.5, after=2)))
+    assert [write for write, _ in writes] == reads
+    # Event 2 is held at most flush_ms, not until upstream resumes
+    assert writes[1][1] < 0.3
+    assert writes[2][1] >= 0.5
+
+
+def test_time_limit_async():
+    reads = [b"data: 1\n\n", b"data: 2\n\n", b"data: 3\n\n"]
+
+    async def upstream():
+        for i, data in enumerate(reads):
+            if i == 2:
+                await asyncio.sleep(0.5)
+            yield data
+
+    async def collect():
+        start = time.perf_counter()
+        relay = SSERelay(flush_bytes=0, flush_ms=50, sse_framing=True)
+        return [(write, time.perf_counter() - start) async for write in relay.relay_async(upstream())]
+
+    writes = asyncio.run(collect())
+    assert [write for write, _ in writes] == reads
+    assert writes[1][1] < 0.3
+    assert writes[2][1] >= 0.5
+
+
+def test_time_limit_keeps_a_split_event_whole():
+    reads = [b"data: 1\n\n", b"data: 2\n", b"\ndata: 3\n\n"]
+    relay = SSERelay(flush_bytes=0, flush_ms=20, sse_framing=True)
+    writes = list(relay.relay(paused(reads, 0.1, after=2)))
+    # Half of event 2 is not sent when the time limit passes during the pause
+    assert writes == [b"data: 1\n\n", b"data: 2\n\ndata: 3\n\n"]
+
+
+def test_upstream_error_is_raised_to_the_client():
+    def upstream():
+        yield b"data: 1\n\n"
+        raise ConnectionError("upstream closed")
+
+    writes = []
+    with pytest.raises(ConnectionError):
+        for write in SSERelay(flush_bytes=0, flush_ms=50, sse_framing=True).relay(upstream()):
+            writes.append(write)
+    assert writes == [b"data: 1\n\n"]
+
+
+def test_slow_client_holds_back_upstream_and_disconnect_closes_it():
+    reads = [0]
+    closed = threading.Event()
+
+    def upstream():
+        while not closed.is_set():
+            reads[0] += 1
+            yield b"data: x\n\n"
+
+    writes = SSERelay(flush_bytes=0, flush_ms=50, sse_framing=True).relay(upstream(), close_upstream=closed.set)
+    next(writes)
+    time.sleep(0.2)
+    # The reading thread stops once the queue is full instead of buffering the whole answer
+    assert reads[0] <= READ_QUEUE_SIZE + 2
+    writes.close()
+    assert closed.is_set()
+    stopped_at = reads[0]
+    time.sleep(0.1)
+    assert reads[0] <= stopped_at + 1
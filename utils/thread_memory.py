@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+from utils.cache_tiers import LRUCache, SQLiteTier
+from utils.lexical_index import tokenize
+
+# Words of follow-ups that ask about the previous answer rather than about something new, e.g. "Can you elaborate?"
+FOLLOWUP_WORDS = frozenset("""
+about again also answer clarify detail details elaborate else example examples explain expand further mean more ok okay
+please say show simpler step steps sure tell thank thanks
+""".split())
+
+# Terms kept in the lexical query of a thread, so it does not grow with every follow-up
+MAX_QUERY_TERMS = 64
+
+
+def unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def blend(previous, current, weight: float) -> np.ndarray:
+    """Mix a follow-up's embedding with the thread's previous search vector, giving the follow-up `weight`."""
+    return unit(weight * unit(current) + (1 - weight) * unit(previous))
+
+
+class ThreadMemory:
+    """
+    Per-conversation retrieval state, keyed on copilot_thread_id.
+
+    For every thread the last query embedding, the blended vector the thread searches with, the lexical
+    query its chunks were retrieved with and the retrieved chunk positions are kept, so a follow-up question can be searched in
+    the context of the conversation, or answered with the chunks already retrieved.
+
+    Threads live in an in-process LRU. If disk_path is given, they are also written to a SQLite file,
+    which survives restarts and can be shared by several worker processes.
+
+    Args:
+    max_threads (int): Maximum number of threads held in memory.
+    ttl_seconds (float): Time after the last message when a thread is forgotten. 0 or less disables expiry.
+    disk_path (str): Optional path of the SQLite file backing the on-disk tier.
+    followup_weight (float): Weight of a follow-up's own embedding in the blended search vector.
+    reuse_similarity (float): Cosine similarity to the previous question above which its chunks are reused
+        without a new search.
+    """
+
+    def __init__(self, max_threads: int = 10000, ttl_seconds: float = 3600, disk_path: str = None,
+                 followup_weight: float = 0.6, reuse_similarity: float = 0.95):
+        self.max_threads = max_threads
+        self.ttl_seconds = ttl_seconds
+        self.followup_weight = followup_weight
+        self.reuse_similarity = reuse_similarity
+        self._threads = LRUCache(max_threads)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.disk_path = disk_path
+        self._disk = None
+        if disk_path:
+            self._disk = SQLiteTier(disk_path, 'threads',
+                                    "thread_id TEXT PRIMARY KEY, updated REAL, state TEXT, embedding BLOB, search_embedding BLOB",
+                                    'updated', ttl_seconds)
+
+    def _expired(self, updated: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - updated > self.ttl_seconds
+
+    def get(self, thread_id: str, index_version=None):
+        """Return the state of a thread, or None if it is unknown, expired or was retrieved from another index."""
+        with self._lock:
+            state = self._threads.get(thread_id)
+            if state is None and self._disk is not None:
+                row = self._disk.connection().execute(
+                    "SELECT updated, state, embedding, search_embedding FROM threads WHERE thread_id = ?", (thread_id,)
+                ).fetchone()
+                if row is not None:
+                    state = dict(json.loads(row[1]), updated=row[0],
+                                 embedding=np.frombuffer(row[2], dtype=np.float32),
+                                 search_embedding=np.frombuffer(row[3], dtype=np.float32))
+                    self._threads.store(thread_id, state)
+            if state is None or self._expired(state['updated']) or state['index_version'] != index_version:
+                self._threads.pop(thread_id, None)
+                self.misses += 1
+                return None
+            self._threads.move_to_end(thread_id)
+            self.hits += 1
+            return state
+
+    def put(self, thread_id: str, query: str, embedding, search_embedding, positions, index_version=None):
+        """Record the latest retrieval of a thread."""
+        state = {
+            'query': query,
+            'positions': [int(position) for position in positions],
+            'index_version': index_version,
+            'updated': time.time(),
+            'embedding': unit(embedding),
+            'search_embedding': unit(search_embedding),
+        }
+        with self._lock:
+            self._threads.store(thread_id, state)
+            if self._disk is not None:
+                self._disk.write(
+                    "INSERT OR REPLACE INTO threads (thread_id, updated, state, embedding, search_embedding) VALUES (?, ?, ?, ?, ?)",
+                    (thread_id, state['updated'],
+                     json.dumps({'query': query, 'positions': state['positions'], 'index_version': index_version}),
+                     state['embedding'].tobytes(), state['search_embedding'].tobytes()),
+                )
+
+    def touch(self, thread_id: str):
+        """Refresh the time of a thread's last message, when its state is reused without a new retrieval."""
+        updated = time.time()
+        with self._lock:
+            state = self._threads.get(thread_id)
+            if state is not None:
+                state['updated'] = updated
+            if self._disk is not None:
+                self._disk.write("UPDATE threads SET updated = ? WHERE thread_id = ?", (updated, thread_id))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._threads), "hits": self.hits, "misses": self.misses}
+
+
+def merge_queries(previous: str, query: str) -> str:
+    """The lexical query of a follow-up searched in the context of its thread: the terms of both, at most MAX_QUERY_TERMS."""
+    terms = list(dict.fromkeys(tokenize(previous) + tokenize(query)))
+    return ' '.join(terms[-MAX_QUERY_TERMS:])
+
+
+def adds_search_terms(state: dict, query: str) -> bool:
+    """
+    Return whether a follow-up mentions terms that are not in the lexical query of the thread's chunks.
+
+    Words asking about the previous answer do not count, so "Can you elaborate?" adds none and the
+    thread's chunks are reused without embedding it.
+    """
+    searched = set(tokenize(state['query']))
+    return any(term not in searched and term not in FOLLOWUP_WORDS for term in tokenize(query))
@@ -0,0 +1,29 @@
+from functools import lru_cache
+
+# Tokenizers of the models whose token limits are counted: prompts are sent to the chat model (gpt-4o),
+# chunks and embedding batches to text-embedding-ada-002.
+CHAT_ENCODING = "o200k_base"
+EMBEDDING_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str):
+    """Load a tiktoken encoding, or return None if tiktoken is not installed or its data cannot be downloaded."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str, encoding: str = CHAT_ENCODING) -> int:
+    """Count tokens with tiktoken if it is installed, otherwise estimate ~4 characters per token."""
+    tokenizer = get_encoding(encoding)
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def count_embedding_tokens(text: str) -> int:
+    """count_tokens for the embedding model."""
+    return count_tokens(text, EMBEDDING_ENCODING)
@@ -0,0 +1,53 @@
+import importlib.util
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Point COPILOT_API_URL at a stand-in such as benchmarks/mock_copilot_api.py to run without the real API.
+COPILOT_API_URL = os.getenv("COPILOT_API_URL", "https://api.githubcopilot.com")
+
+# Maximum number of kept-alive connections to the Copilot API per process.
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "100"))
+
+
+def create_session(pool_size: int = UPSTREAM_POOL_SIZE) -> requests.Session:
+    """Create a requests session that keeps TLS connections to the Copilot API alive between calls."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared by every request served by the synchronous Flask application.
+SESSION = create_session()
+
+_async_client = None
+
+
+def get_async_client():
+    """
+    Return the process-wide httpx.AsyncClient used by the asyncio serving mode, creating it on first use.
+
+    HTTP/2 is used when the h2 package is installed, so many concurrent streams share one connection.
+    """
+    global _async_client
+    if _async_client is None:
+        import httpx
+
+        _async_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=UPSTREAM_POOL_SIZE, max_keepalive_connections=UPSTREAM_POOL_SIZE),
+            # Completions can pause for a long time between tokens, so there is no read timeout.
+            timeout=httpx.Timeout(30.0, read=None),
+        )
+    return _async_client
+
+
+async def close_async_client():
+    """Close the shared httpx.AsyncClient, if one was created."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
@@ -1,86 +1,387 @@
+import asyncio
+import os
 import faiss
-import json
-import requests
 import numpy as np
+from utils import observability
+from utils.embedding_cache import EmbeddingCache
+from utils.index_manager import IndexManager, LocalArtifactSource, S3ArtifactSource, search_index
+from utils.lexical_index import reciprocal_rank_fusion
+from utils.metadata_filters import bitmap_count, bitmap_positions
+from utils.micro_batcher import MicroBatcher
+from utils.retrieval import first_per_url, range_results, select_diverse
 
-def load_faiss_index(index_path: str):
-    """Load the FAISS index from a file."""
-    print(f"Loading FAISS index from {index_path}")
-    index = faiss.read_index(index_path)
-    print(f"Loaded index containing {index.ntotal} vectors")
-    return index
+logger = observability.get_logger(__name__)
 
+# Memory-map the index instead of reading it into every worker's heap. Set FAISS_MMAP=0 to disable.
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
 
-def load_metadata(metadata_path: str):
-    """Load metadata from a JSON file."""
-    print(f"Loading metadata from {metadata_path}")
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
-    print(f"Loaded metadata for {len(metadata)} items")
-    return metadata
 
+def create_index_manager() -> IndexManager:
+    """
+    Create the index manager from INDEX_SOURCE.
+
+    Unset, the vector store in the working directory is loaded once. "s3" watches s3://BUCKET_NAME/INDEX_S3_PREFIX,
+    any other value is a local directory of versions. New versions are picked up every INDEX_POLL_SECONDS.
+    """
+    source = os.getenv("INDEX_SOURCE")
+    poll_seconds = float(os.getenv("INDEX_POLL_SECONDS", "60"))
+    if not source:
+        return IndexManager(use_mmap=FAISS_MMAP)
+    if source == "s3":
+        artifact_source = S3ArtifactSource(os.getenv("BUCKET_NAME"), os.getenv("INDEX_S3_PREFIX", "vectorstore/"),
+                                           os.getenv("INDEX_CACHE_DIR", "index_cache"))
+    else:
+        artifact_source = LocalArtifactSource(source)
+    return IndexManager(artifact_source, poll_seconds=poll_seconds, use_mmap=FAISS_MMAP)
+
+
+INDEX_MANAGER = create_index_manager()
+
+# Attributes of the active snapshot, kept readable as module attributes, e.g. vectorstore_functions.INDEX_VERSION.
+SNAPSHOT_ATTRIBUTES = {
+    'FAISS_INDEX': 'index',
+    'FAISS_METADATA': 'metadata',
+    'INDEX_VERSION': 'version',
+    'INDEX_CONFIG': 'config',
+    'LEXICAL_INDEX': 'lexical_index',
+    'CHUNK_URLS': 'chunk_urls',
+    'CHUNK_EMBEDDINGS': 'embeddings',
+    'EMBEDDER': 'embedder',
+}
+
+
+def __getattr__(name):
+    if name in SNAPSHOT_ATTRIBUTES:
+        return getattr(INDEX_MANAGER.snapshot(), SNAPSHOT_ATTRIBUTES[name])
+    if name == 'MODEL_NAME':
+        return INDEX_MANAGER.snapshot().embedder.model_name
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Squared L2 distance above which a chunk is considered unrelated; tuned for normalized embeddings.
+DISTANCE_THRESHOLD = float(os.getenv("DISTANCE_THRESHOLD", "1.1"))
+
+# With a lexical index, dense and BM25 rankings of HYBRID_CANDIDATES * k chunks each are fused.
+# Set HYBRID_SEARCH=0 to use vector search only.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "4"))
+
+# Searches fetch RETRIEVAL_OVERFETCH * k chunks, so k distinct pages remain after deduplication by URL,
+# and fetch more if they do not. With RANGE_SEARCH=1, every chunk within DISTANCE_THRESHOLD is fetched instead.
+RETRIEVAL_OVERFETCH = int(os.getenv("RETRIEVAL_OVERFETCH", "4"))
+RANGE_SEARCH = os.getenv("RANGE_SEARCH", "0") == "1"
+
+# Filtered searches pass the bitmap of matching chunks to FAISS, which skips all others while searching. When at most
+# FILTER_EXACT_MAX chunks match, their stored embeddings are compared with the query directly instead, which is faster
+# than walking an HNSW graph or IVF lists that mostly hold other chunks.
+FILTER_EXACT_MAX = int(os.getenv("FILTER_EXACT_MAX", "20000"))
+
+# Repeated queries (retries, regenerations, common questions) are answered from this cache
+# instead of a round trip to the embeddings endpoint. Set EMBEDDING_CACHE_PATH to add an
+# on-disk tier shared by all workers that survives restarts, capped at EMBEDDING_CACHE_DISK_SIZE entries.
+EMBEDDING_CACHE = EmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL", "86400")),
+    disk_path=os.getenv("EMBEDDING_CACHE_PATH"),
+    disk_max_entries=int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "50000")),
+)
+
+
+def request_embeddings(queries: list, headers=None, embedder=None):
+    """Embed a list of queries with a single call to the embedder, by default that of the active index."""
+    embedder = embedder or INDEX_MANAGER.snapshot().embedder
+    logger.debug(f"Creating {len(queries)} embedding(s) using {embedder.backend} model: {embedder.model_name}")
+    return embedder.embed(queries, headers)
+
+
+def headers_key(headers, embedder) -> tuple:
+    """Hashable batching key; only requests for the same model and with the same credentials are batched together."""
+    if embedder.backend == 'local':
+        # The local model needs no credentials, so all queries for it can share a batch
+        return (embedder.model_name,)
+    return (embedder.model_name,) + tuple(sorted((headers or {}).items()))
+
+
+# Under load, concurrent single-query embedding calls are coalesced into one batched call when
+# EMBEDDING_BATCH_WINDOW_MS is set, and concurrent FAISS searches into one search over the stacked
+# query matrix when SEARCH_BATCH_WINDOW_MS is set.
+EMBEDDING_BATCHER = None
+# Embedder of every model name seen in a batching key, so a batch is embedded with the model its queries asked for
+EMBEDDERS_BY_MODEL = {}
+if float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "0")) > 0:
+    EMBEDDING_BATCHER = MicroBatcher(
+        lambda key, queries: request_embeddings(queries, dict(key[1:]), EMBEDDERS_BY_MODEL[key[0]]),
+        window_ms=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS")),
+        max_batch_size=int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32")),
+    )
+
+
+def search_batch(snapshot, items: list) -> list:
+    """Run one FAISS search of a snapshot for a list of (query vector, k) items and split the results per item."""
+    max_k = max(k for _, k in items)
+    distances, indices = snapshot.index.search(np.vstack([vector for vector, _ in items]), max_k)
+    return [(distances[i:i + 1, :k], indices[i:i + 1, :k]) for i, (_, k) in enumerate(items)]
 
-FAISS_INDEX = load_faiss_index("faiss_index.bin")
-FAISS_METADATA = load_metadata("metadata.json")
-MODEL_NAME = 'text-embedding-ada-002'
-DISTANCE_THRESHOLD = 1.1
 
-llm_client = "https://api.githubcopilot.com/embeddings"
+SEARCH_BATCHER = None
+if float(os.getenv("SEARCH_BATCH_WINDOW_MS", "0")) > 0:
+    SEARCH_BATCHER = MicroBatcher(
+        search_batch,
+        window_ms=float(os.getenv("SEARCH_BATCH_WINDOW_MS")),
+        max_batch_size=int(os.getenv("SEARCH_BATCH_MAX_SIZE", "64")),
+        max_in_flight=1,
+    )
 
 
-def create_embedding(query: str, headers=None):
-    print(f"Creating embedding using model: {MODEL_NAME}")
-    copilot_req = {
-        "model": MODEL_NAME,
-        "input": [query]
-    }
-    r = requests.post(llm_client, json=copilot_req, headers=headers)
-    r.raise_for_status()
-    return_dict = r.json()
+def create_embedding(query: str, headers=None, embedder=None):
+    """Embed a query with the given embedder, by default that of the active index, through the embedding cache."""
+    embedder = embedder or INDEX_MANAGER.snapshot().embedder
+    cached = EMBEDDING_CACHE.get(query, embedder.model_name)
+    if cached is not None:
+        logger.debug(f"Embedding cache hit: {EMBEDDING_CACHE.stats()}")
+        return cached
 
-    return return_dict['data'][0]['embedding']
+    with observability.span('embedding'):
+        if EMBEDDING_BATCHER is not None:
+            EMBEDDERS_BY_MODEL[embedder.model_name] = embedder
+            embedding = EMBEDDING_BATCHER(query, headers_key(headers, embedder))
+        else:
+            embedding = request_embeddings([query], headers, embedder)[0]
 
+    return EMBEDDING_CACHE.put(query, embedder.model_name, embedding)
 
-def embedding_search(query: str, k: int = 5, headers=None):
+
+async def create_embedding_async(query: str, headers=None, embedder=None):
+    """Asyncio version of create_embedding, sharing its cache. Remote embeddings use the pooled httpx.AsyncClient."""
+    embedder = embedder or INDEX_MANAGER.snapshot().embedder
+    cached = EMBEDDING_CACHE.get(query, embedder.model_name)
+    if cached is not None:
+        logger.debug(f"Embedding cache hit: {EMBEDDING_CACHE.stats()}")
+        return cached
+
+    with observability.span('embedding'):
+        if EMBEDDING_BATCHER is not None:
+            EMBEDDERS_BY_MODEL[embedder.model_name] = embedder
+            embedding = await asyncio.wrap_future(EMBEDDING_BATCHER.submit(query, headers_key(headers, embedder)))
+            return EMBEDDING_CACHE.put(query, embedder.model_name, embedding)
+
+        logger.debug(f"Creating embedding using {embedder.backend} model: {embedder.model_name}")
+        embeddings = await embedder.embed_async([query], headers)
+    return EMBEDDING_CACHE.put(query, embedder.model_name, embeddings[0])
+
+
+def embedding_search(query: str, k: int = 5, headers=None, filters=None):
     """
     Search the FAISS index with a text query.
 
     Args:
     query (str): The text to search for.
     k (int): The number of results to return.
+    filters (dict): Optional metadata filter, mapping 'keywords', 'learning_path' or 'category' to a value or a
+        list of values, e.g. {'category': 'servers-and-cloud-computing'}. Only matching chunks are returned.
 
     Returns:
     list: A list of dictionaries containing search results with distances and metadata.
     """
-    print(f"Searching for: '{query}'")
+    logger.debug(f"Searching for: '{query}'")
     # Convert query to embedding
     query_embedding = create_embedding(query, headers)
-    query_array = np.array(query_embedding, dtype=np.float32).reshape(1, -1)
-
-    # Perform the search
-    distances, indices = FAISS_INDEX.search(query_array, k)
-    print(distances, indices)
-    # Prepare results
-    results = []
-    for i, (dist, idx) in enumerate(zip(distances[0], indices[0])):
-        if idx != -1:  # -1 index means no result found
-            if float(dist) < DISTANCE_THRESHOLD:
-                result = {
-                    "rank": i + 1,
-                    "distance": float(dist),
-                    "metadata": FAISS_METADATA[idx]
-                }
-                results.append(result)
+    return vector_search(query_embedding, k, filters=filters)
+
 
+def filter_bitmap(filters, snapshot):
+    """The packed bitmap of the chunks of a snapshot matching a metadata filter, or None without a filter."""
+    if not filters:
+        return None
+    return snapshot.filter_bitmaps.bitmap(filters)
+
+
+def knn_search(snapshot, query_array: np.ndarray, k: int, bitmap: np.ndarray = None):
+    """
+    Search the index of a snapshot, only among the chunks set in bitmap if given.
+
+    Unfiltered single queries go through the search batcher when it is enabled.
+    """
+    if bitmap is not None:
+        return search_index(snapshot.index, query_array, k, bitmap)
+    if SEARCH_BATCHER is not None and len(query_array) == 1:
+        # Batches are keyed on the snapshot itself, so they are searched in the index the positions are read from
+        return SEARCH_BATCHER((query_array, k), snapshot)
+    return snapshot.index.search(query_array, k)
+
+
+def exact_search(query_array: np.ndarray, vectors: np.ndarray, positions: np.ndarray, k: int):
+    """Find the k closest of the given vectors, returning their positions like a FAISS search."""
+    distances, rows = faiss.knn(query_array, vectors, k)
+    return distances, np.where(rows >= 0, positions[rows], -1)
+
+
+def search_diverse(query_embeddings, k: int = 5, snapshot=None, bitmap: np.ndarray = None) -> list:
+    """
+    Find the k closest chunks within DISTANCE_THRESHOLD for each query, at most one chunk per page URL.
+
+    Args:
+    query_embeddings: One embedding, or a matrix with one embedding per row.
+    k (int): The number of results per query. Fewer are returned only if fewer pages are close enough.
+    snapshot: The IndexSnapshot to search, by default the active one.
+    bitmap (np.ndarray): Optional packed bitmap of the chunks to search among, from filter_bitmap.
+
+    Returns:
+    list: One (metadata positions, distances) pair of arrays per query, closest first.
+    """
+    with observability.span('vector_search'):
+        return _search_diverse(query_embeddings, k, snapshot or INDEX_MANAGER.snapshot(), bitmap)
+
+
+def _search_diverse(query_embeddings, k: int, snapshot, bitmap: np.ndarray = None) -> list:
+    index = snapshot.index
+    query_array = np.ascontiguousarray(np.asarray(query_embeddings, dtype=np.float32).reshape(-1, index.d))
+    num_queries = len(query_array)
+    available = index.ntotal if bitmap is None else bitmap_count(bitmap)
+    if available == 0:
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))] * num_queries
+
+    if bitmap is not None and available <= FILTER_EXACT_MAX and snapshot.embeddings is not None:
+        # Few enough chunks match to compare the queries with each of them
+        positions = bitmap_positions(bitmap, index.ntotal)
+        vectors = snapshot.embeddings.get(positions)
+        search = lambda queries, fetch: exact_search(queries, vectors, positions, fetch)
+    else:
+        search = lambda queries, fetch: knn_search(snapshot, queries, fetch, bitmap)
+
+    if RANGE_SEARCH and bitmap is None:
+        try:
+            lims, distances, indices = index.range_search(query_array, DISTANCE_THRESHOLD)
+            return range_results(lims, distances, indices, snapshot.chunk_urls, k)
+        except RuntimeError as e:
+            logger.warning(f"Range search is not supported by this index, using k-NN search: {e}")
+
+    results = [None] * num_queries
+    rows = np.arange(num_queries)
+    fetch = k * RETRIEVAL_OVERFETCH
+    while len(rows):
+        fetch = min(fetch, available)
+        distances, indices = search(query_array[rows], fetch)
+        keep = select_diverse(distances, indices, snapshot.chunk_urls, k, DISTANCE_THRESHOLD)
+        # A query is done when it has k pages, or when fetching more cannot find another chunk within the threshold
+        done = (keep.sum(axis=1) >= k) | (fetch == available) | (indices[:, -1] < 0) | (distances[:, -1] >= DISTANCE_THRESHOLD)
+        for row, row_keep, row_distances, row_indices in zip(rows[done], keep[done], distances[done], indices[done]):
+            results[row] = (row_indices[row_keep], row_distances[row_keep])
+        rows = rows[~done]
+        fetch *= 4
     return results
 
-def deduplicate_urls(embedding_results: list):
-    """Deduplicate metadata based on the 'url' field."""
-    seen_urls = set()
-    deduplicated_results = []
-    for item in embedding_results:
-        url = item["metadata"].get("url")
-        if url and url not in seen_urls:
-            seen_urls.add(url)
-            deduplicated_results.append(item)
-    return deduplicated_results
\ No newline at end of file
+
+def make_results(positions, distances=None, snapshot=None) -> list:
+    """Build the result dictionaries for the final, ranked metadata positions of a snapshot, by default the active one."""
+    snapshot = snapshot or INDEX_MANAGER.snapshot()
+    return [{
+        "rank": i + 1,
+        "distance": None if distances is None else distances.get(position),
+        "position": position,
+        "index_version": snapshot.version,
+        "metadata": snapshot.metadata[position]
+    } for i, position in enumerate(positions)]
+
+
+def results_snapshot(results: list):
+    """Return the snapshot the results were retrieved from (the active one if there are none), or None if it is no longer loaded."""
+    return INDEX_MANAGER.snapshot(results[0]['index_version'] if results else None)
+
+
+def result_embeddings(results: list, snapshot=None) -> np.ndarray:
+    """Return the stored embeddings of the given results of a snapshot, from embeddings.emb or reconstructed from its index."""
+    snapshot = snapshot or results_snapshot(results)
+    positions = np.array([result['position'] for result in results], dtype=np.int64)
+    if snapshot.embeddings is not None:
+        return snapshot.embeddings.get(positions)
+    return snapshot.index.reconstruct_batch(positions)
+
+
+def vector_search(query_embedding, k: int = 5, snapshot=None, filters=None):
+    """
+    Search the FAISS index with an already computed query embedding.
+
+    Args:
+    query_embedding: The embedding vector of the query.
+    k (int): The number of results to return.
+    snapshot: The IndexSnapshot to search, by default the active one.
+    filters (dict): Optional metadata filter, as taken by embedding_search.
+
+    Returns:
+    list: A list of dictionaries containing search results with distances and metadata, one per page URL.
+    """
+    snapshot = snapshot or INDEX_MANAGER.snapshot()
+    positions, distances = search_diverse(query_embedding, k, snapshot, filter_bitmap(filters, snapshot))[0]
+    return make_results(positions.tolist(), dict(zip(positions.tolist(), distances.tolist())), snapshot)
+
+
+def hybrid_search(query: str, query_embedding, k: int = 5, snapshot=None, filters=None):
+    """
+    Search with both the FAISS index and the BM25 lexical index and fuse the rankings with reciprocal rank fusion.
+
+    Returns the same result dictionaries as vector_search. Chunks only found lexically have a distance of None.
+    """
+    snapshot = snapshot or INDEX_MANAGER.snapshot()
+    bitmap = filter_bitmap(filters, snapshot)
+    dense_positions, dense_distances = search_diverse(query_embedding, k * HYBRID_CANDIDATES, snapshot, bitmap)[0]
+    with observability.span('lexical_search'):
+        lexical_docs, _ = snapshot.lexical_index.search(query, k * HYBRID_CANDIDATES, bitmap)
+    lexical_docs = first_per_url(lexical_docs, snapshot.chunk_urls, k * HYBRID_CANDIDATES)
+
+    fused = reciprocal_rank_fusion([dense_positions.tolist(), lexical_docs.tolist()])
+    positions = first_per_url(fused, snapshot.chunk_urls, k).tolist() if fused else []
+    return make_results(positions, dict(zip(dense_positions.tolist(), dense_distances.tolist())), snapshot)
+
+
+def lexical_search(query: str, k: int = 5, snapshot=None, filters=None):
+    """Search the BM25 lexical index only, returning the same result dictionaries as vector_search."""
+    snapshot = snapshot or INDEX_MANAGER.snapshot()
+    with observability.span('lexical_search'):
+        docs, _ = snapshot.lexical_index.search(query, k * HYBRID_CANDIDATES, filter_bitmap(filters, snapshot))
+    return make_results(first_per_url(docs, snapshot.chunk_urls, k).tolist(), snapshot=snapshot)
+
+
+def is_exact_identifier(query: str, snapshot) -> bool:
+    return snapshot.lexical_index is not None and HYBRID_SEARCH and snapshot.lexical_index.exact_identifier(query) is not None
+
+
+def retrieve(query: str, k: int = 5, headers=None, filters=None):
+    """
+    Retrieve context for a query, choosing the cheapest search that suits it.
+
+    Queries that are a single exact identifier known to the lexical index (e.g. an intrinsic name) are
+    answered lexically, without an embedding round trip. Other queries are embedded and searched with
+    hybrid search when a lexical index is available, or vector search otherwise. The whole retrieval
+    uses the index that is active when it starts, even if a new version is swapped in meanwhile.
+    filters restricts the results to chunks matching a metadata filter, as taken by embedding_search.
+
+    Returns:
+    tuple: The query embedding (None if the query was not embedded) and the list of results.
+    """
+    snapshot = INDEX_MANAGER.snapshot()
+    if is_exact_identifier(query, snapshot):
+        logger.debug(f"Exact identifier query, using lexical search: '{query}'")
+        return None, lexical_search(query, k, snapshot, filters)
+
+    query_embedding = create_embedding(query, headers, snapshot.embedder)
+    return query_embedding, search_with_embedding(query, query_embedding, k, snapshot, filters)
+
+
+async def retrieve_async(query: str, k: int = 5, headers=None, filters=None):
+    """Asyncio version of retrieve; the index search runs in a worker thread."""
+    snapshot = INDEX_MANAGER.snapshot()
+    if is_exact_identifier(query, snapshot):
+        logger.debug(f"Exact identifier query, using lexical search: '{query}'")
+        return None, lexical_search(query, k, snapshot, filters)
+
+    query_embedding = await create_embedding_async(query, headers, snapshot.embedder)
+    return query_embedding, await asyncio.to_thread(search_with_embedding, query, query_embedding, k, snapshot, filters)
+
+
+def search_with_embedding(query: str, query_embedding, k: int = 5, snapshot=None, filters=None):
+    """Hybrid search when a lexical index is available and enabled, vector search otherwise."""
+    snapshot = snapshot or INDEX_MANAGER.snapshot()
+    if snapshot.lexical_index is not None and HYBRID_SEARCH:
+        return hybrid_search(query, query_embedding, k, snapshot, filters)
+    return vector_search(query_embedding, k, snapshot, filters)
@@ -1,11 +1,41 @@
 from bs4 import BeautifulSoup
-import argparse, requests, re, uuid, yaml, os, sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+import argparse, requests, re, uuid, yaml, os, sys, glob, json, threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from markdown_chunker import chunk_markdown
+from chunk_store import ChunkStore
 
 
 # Global variables
 github_raw_link = "https://raw.githubusercontent.com/ArmDeveloperEcosystem/arm-learning-paths/refs/heads/production/content"
 site_link = "https://learn.arm.com"
+sitemap_link = "https://learn.arm.com/sitemap.xml"
 chunk_index = 1
+chunk_index_lock = threading.Lock()
+
+# Shared HTTP session, so all workers reuse connections to learn.arm.com and GitHub
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=32))
+
+# All chunks, in one SQLite file. None when chunks are saved as one yaml file each (--yaml).
+chunk_store_file = './chunks/chunks.db'
+chunk_store = None
+
+# ETag/Last-Modified of every fetched markdown page, and the chunk files it produced, so unchanged pages are skipped on re-runs
+http_cache_file = './chunks/http_cache.json'
+http_cache = {}
+http_cache_lock = threading.Lock()
+
+# Website URLs of all pages found in this crawl, including pages that could not be fetched. Chunks of other pages are deleted at the end.
+seen_pages = set()
+
+# Chunk sizes in tokens of the embedding model, set by argparse
+chunk_max_tokens = 512
+chunk_min_tokens = 256
+chunk_overlap_tokens = 0
+chunker = 'tokens'
 
 # Default Learning Path URL if not provided via argparse
 default_lp = 'https://learn.arm.com/learning-paths/cross-platform/kleidiai-explainer'
@@ -38,87 +68,248 @@ class Chunk:
         return f"Chunk(title={self.title}, url={self.url}, uuid={self.uuid}, keywords={self.keywords}, content={self.content})"
 
 
-def processLearningPath(url):
-    def chunkizeLearningPath(relative_url, title, keywords):
-        global chunk_index
-
-        # 1) Construct proper URLs to obtain raw markdown content from GitHub
-        if relative_url.endswith('/'):
-            relative_url = relative_url[:-1]
-        MARKDOWN_url = github_raw_link + relative_url + '.md'
-        WEBSITE_url = site_link + relative_url
-
-        # 2) Skip if url is invalid
-        try:
-            response = requests.get(WEBSITE_url)
-            response.raise_for_status()  # Ensure we got a valid response
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred when accessing {WEBSITE_url}: {http_err}")
-
-        # 3) Get markdown content from GitHub
-        gh_response = requests.get(MARKDOWN_url)
-        gh_response.raise_for_status()  # Ensure we got a valid response, throw exception if not
-        md_content = gh_response.text
-        markdown = md_content[md_content.find('---', 3)  + 3:].strip()  #  Remove frontmatter bounded by '---'    +3 to remove the '---' and strip to remove leading/trailing whitespace
-
-        # 4) Get sized text snippets the markdown
+def loadHttpCache():
+    global http_cache, chunk_index
+    if os.path.exists(http_cache_file):
+        with open(http_cache_file, 'r') as f:
+            http_cache = json.load(f)
+
+    # Continue numbering after existing chunk files so chunks of unchanged pages are kept
+    existing = [int(re.search(r'chunk_(\d+)\.yaml$', path).group(1)) for path in glob.glob('./chunks/chunk_*.yaml')]
+    chunk_index = max(existing, default=0) + 1
+
+
+def chunkStorage():
+    return 'yaml' if chunk_store is None else 'store'
+
+
+def saveHttpCache():
+    if not os.path.exists('./chunks/'):
+        os.makedirs('./chunks/')
+    with http_cache_lock:
+        with open(http_cache_file, 'w') as f:
+            json.dump(http_cache, f, indent=2)
+
+
+def conditionalGet(url):
+    """GET url, sending the validators cached from the previous run. Returns None if the page has not changed."""
+    headers = {}
+    with http_cache_lock:
+        cached = http_cache.get(url, {})
+    # Pages saved to the other storage are fetched again, so their chunks end up in the one in use
+    if cached.get('storage', 'yaml') != chunkStorage():
+        cached = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    response = session.get(url, headers=headers)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()  # Ensure we got a valid response, throw exception if not
+    return response
+
+
+def removeFrontmatter(md_content):
+    return md_content[md_content.find('---', 3)  + 3:].strip()  #  Remove frontmatter bounded by '---'    +3 to remove the '---' and strip to remove leading/trailing whitespace
+
+
+def chunkizeLearningPath(relative_url, title, keywords):
+    global chunk_index
+
+    # 1) Construct proper URLs to obtain raw markdown content from GitHub
+    if relative_url.endswith('/'):
+        relative_url = relative_url[:-1]
+    MARKDOWN_url = github_raw_link + relative_url + '.md'
+    WEBSITE_url = site_link + relative_url
+
+    # 2) Get markdown content from GitHub, skipping it if it has not changed since the last run.
+    #    The page is listed by the Learning Path navigation, so it exists; a page that fails keeps its previous chunks.
+    with http_cache_lock:
+        seen_pages.add(WEBSITE_url)
+    try:
+        gh_response = conditionalGet(MARKDOWN_url)
+    except requests.exceptions.RequestException as err:
+        print(f"   Failed to fetch {MARKDOWN_url}, keeping its previous chunks: {err}")
+        return
+    if gh_response is None:
+        print(f"   Unchanged, skipping {WEBSITE_url}")
+        return
+    markdown = removeFrontmatter(gh_response.text)
+
+    # 3) Get sized text snippets the markdown
+    if chunker == 'words':
         text_snippets = obtainTextSnippets__Markdown(markdown)
-
-        # 5) Create chunk for each text_snippet & save to yaml file
-        for text_snippet in text_snippets:
-            chunk = Chunk(
-                title        = title,
-                url          = WEBSITE_url,
-                uuid         = str(uuid.uuid4()),
-                keywords     = keywords,
-                content      = text_snippet
-            )
-
+    else:
+        text_snippets = obtainTextSnippets__MarkdownTokens(markdown)
+
+    # 4) Create chunk for each text_snippet & save to the chunk store, or to yaml files
+    # Create ./chunks/ directory if it doesn't exist
+    os.makedirs('./chunks/', exist_ok=True)
+
+    chunks = [
+        Chunk(
+            title        = title,
+            url          = WEBSITE_url,
+            uuid         = str(uuid.uuid5(uuid.NAMESPACE_URL, WEBSITE_url + '\n' + text_snippet)),   # Stable, content-derived ID
+            keywords     = keywords,
+            content      = text_snippet
+        )
+        for text_snippet in text_snippets
+    ]
+
+    saved_chunks = []
+    if chunk_store is not None:
+        # Replaces the chunks this page produced on a previous run
+        chunk_store.replace_page(WEBSITE_url, [chunk.toDict() for chunk in chunks])
+        print(f"   {len(chunks)} chunks of {WEBSITE_url} queued.")
+    else:
+        # Remove the chunks this page produced on a previous run
+        with http_cache_lock:
+            previous_chunks = http_cache.get(MARKDOWN_url, {}).get('chunks', [])
+        for previous_chunk in previous_chunks:
+            if os.path.exists(f"./chunks/chunk_{previous_chunk}.yaml"):
+                os.remove(f"./chunks/chunk_{previous_chunk}.yaml")
+
+        for chunk in chunks:
             # Save chunk
-            # Create ./chunks/ directory if it doesn't exist
-            if not os.path.exists('./chunks/'):
-                os.makedirs('./chunks/')
-            with open(f"./chunks/chunk_{chunk_index}.yaml", 'w') as file:
+            with chunk_index_lock:
+                current_index = chunk_index
+                chunk_index += 1
+            with open(f"./chunks/chunk_{current_index}.yaml", 'w') as file:
                 yaml.dump(chunk.toDict(), file, default_flow_style=False, sort_keys=False)
-            print(f"   Chunk {chunk_index} saved, snippet of {len(text_snippet.split())}.")
-            chunk_index += 1
+            print(f"   Chunk {current_index} saved, snippet of {len(chunk.content.split())}.")
+            saved_chunks.append(current_index)
+
+    # Only remember the validators once the chunks are saved. The chunk store is flushed before the cache is written.
+    with http_cache_lock:
+        http_cache[MARKDOWN_url] = {
+            'etag': gh_response.headers.get('ETag'),
+            'last_modified': gh_response.headers.get('Last-Modified'),
+            'chunks': saved_chunks,
+            'storage': chunkStorage()
+        }
 
+
+def obtainSubpages(url):
+    """Return the title, keywords and subpage links of a Learning Path."""
     # Get Learning Path page elements
-    response = requests.get(url)
+    response = session.get(url)
+    response.raise_for_status()
     soup = BeautifulSoup(response.text, 'html.parser')
-    
-    # Find all subpages in the Learning Path by iterating over its inner navigation and process them independently
-    print('------------------------------------------------------------')
+
+    title = 'Arm Learning Path - '+soup.find(id='learning-path-title').get_text()       # Obtain title of learning path
+
+    ads_tags = soup.find_all('ads-tag')                                                 # Obtain keywords of learning path, removing duplicates
+    keywords = []
+    for tag in ads_tags:
+        keyword = tag.get_text().strip()
+        if keyword not in keywords:
+            keywords.append(keyword)
+
+    # Find all subpages in the Learning Path by iterating over its inner navigation
+    hrefs = []
     for link in soup.find_all(class_='inner-learning-path-navbar-element'):
-        
-        if 'content-individual-a-mobile' not in link.get('class', []):                      # Ignore mobile links
+
+        if 'content-individual-a-mobile' not in link.get('class', []):                  # Ignore mobile links
             href = link.get('href')
             # Ignore files that have _index, _next-stpes, or _demo in their name
-            if '0-weight' in link.get('class', []):                                         # Ignore index
+            if '0-weight' in link.get('class', []):                                     # Ignore index
                 continue
-            if any(substring in href for substring in ['_next-steps', '_demo']):            # Ignore next-steps and demo
-                continue    
+            if any(substring in href for substring in ['_next-steps', '_demo']):        # Ignore next-steps and demo
+                continue
+            hrefs.append(href)
 
-            title = 'Arm Learning Path - '+soup.find(id='learning-path-title').get_text()   # Obtain title of learning path
+    return title, keywords, hrefs
 
-            ads_tags = soup.findAll('ads-tag')                                              # Obtain keywords of learning path, removing duplicates
-            keywords = []
-            for tag in ads_tags:
-                keyword = tag.get_text().strip()
-                if keyword not in keywords:
-                    keywords.append(keyword)
 
-            # Process each subpage
-            chunkizeLearningPath(href,title,keywords)
+def processLearningPath(url):
+    print('------------------------------------------------------------')
+    title, keywords, hrefs = obtainSubpages(url)
 
+    # Process each subpage
+    for href in hrefs:
+        chunkizeLearningPath(href, title, keywords)
 
     print('Completed chunking of', title)
     print('   from the url:', url)
     print('------------------------------------------------------------')
 
 
+def processLearningPaths(urls, workers=8):
+    """
+    Chunk several Learning Paths, fetching Learning Path pages and their subpages on a bounded worker pool.
+    Returns the URLs of the Learning Paths that were loaded; the pages of the others are unknown.
+    """
+    loaded = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        page_futures = {executor.submit(obtainSubpages, url): url for url in urls}
+        subpage_futures = []
+        for future in as_completed(page_futures):
+            try:
+                title, keywords, hrefs = future.result()
+            except requests.exceptions.RequestException as err:
+                print(f"Skipping {page_futures[future]}: {err}")
+                continue
+            loaded.append(page_futures[future])
+            print(f"Queued {len(hrefs)} pages of {title}")
+            for href in hrefs:
+                subpage_futures.append(executor.submit(chunkizeLearningPath, href, title, keywords))
+
+        for future in as_completed(subpage_futures):
+            try:
+                future.result()
+            except requests.exceptions.RequestException as err:
+                print(f"Failed to chunk a page: {err}")
+    return loaded
+
+
+def learningPathPrefix(url):
+    """URL prefix of the pages of a Learning Path."""
+    return url.rstrip('/') + '/'
+
+
+def removeStalePages(prefixes=('',)):
+    """Delete the chunks of the pages under one of prefixes that were not found in this crawl, and forget their validators."""
+    prefixes = tuple(prefixes)
+    if chunk_store is not None:
+        stale = chunk_store.delete_pages_except(seen_pages, prefixes)
+    else:
+        with http_cache_lock:
+            stale = [site_link + markdown_url[len(github_raw_link):-len('.md')] for markdown_url, cached in http_cache.items()
+                     if cached.get('storage', 'yaml') == 'yaml']
+        stale = [url for url in stale if url.startswith(prefixes) and url not in seen_pages]
+
+    with http_cache_lock:
+        for url in stale:
+            cached = http_cache.pop(github_raw_link + url[len(site_link):] + '.md', {})
+            if chunk_store is None:
+                for previous_chunk in cached.get('chunks', []):
+                    if os.path.exists(f"./chunks/chunk_{previous_chunk}.yaml"):
+                        os.remove(f"./chunks/chunk_{previous_chunk}.yaml")
+            print(f"   Removed the chunks of {url}, which is no longer listed")
+
+
+def obtainLearningPathUrls(sitemap_url):
+    """Return the Learning Path root URLs listed in a sitemap."""
+    response = session.get(sitemap_url)
+    response.raise_for_status()
+    urls = []
+    for loc in re.findall(r'<loc>\s*(.*?)\s*</loc>', response.text):
+        if re.match(rf'^{re.escape(site_link)}/learning-paths/[^/]+/[^/]+/?$', loc) and loc not in urls:
+            urls.append(loc)
+    return urls
+
+
+def obtainTextSnippets__MarkdownTokens(content):
+    """Split content into chunks sized in embedding model tokens, in a single pass over its heading tree."""
+    return chunk_markdown(content, max_tokens=chunk_max_tokens, min_tokens=chunk_min_tokens,
+                          min_final_tokens=chunk_min_tokens // 2, overlap_tokens=chunk_overlap_tokens)
+
+
 def obtainTextSnippets__Markdown(content, min_words=300, max_words=500, min_final_words=200):
-    """Split content into chunks based on headers and word count constraints."""
+    """Split content into chunks based on headers and word count constraints. Kept as the baseline of benchmarks/chunking.py."""
 
     # Helper function to count words
     def word_count(text):
@@ -201,13 +392,47 @@ def obtainTextSnippets__Markdown(content, min_words=300, max_words=500, min_fina
 
 
 def main():
+    global chunk_max_tokens, chunk_min_tokens, chunk_overlap_tokens, chunker, chunk_store
+
     # Argparse input for a single learning path URL. If none given, default to a known-good Learning Path URL.
     parser = argparse.ArgumentParser(description="Turn a Learning Path (specified via URL) into a chunk ready for RAG.")
     parser.add_argument("--url", nargs='?', default=default_lp, help=f"Full path to a Learning Path to chunk. If none specified, defaults to {default_lp}")
+    parser.add_argument("--urls-file", help="File with one Learning Path URL per line to chunk, instead of --url.")
+    parser.add_argument("--sitemap", nargs='?', const=sitemap_link, help=f"Chunk every Learning Path listed in a sitemap, instead of --url. Defaults to {sitemap_link}")
+    parser.add_argument("--workers", type=int, default=8, help="Number of pages fetched in parallel when chunking several Learning Paths.")
+    parser.add_argument("--max-tokens", type=int, default=chunk_max_tokens, help="Maximum size of a chunk in tokens of the embedding model.")
+    parser.add_argument("--min-tokens", type=int, default=chunk_min_tokens, help="Size from which a chunk is ended at the next heading.")
+    parser.add_argument("--overlap-tokens", type=int, default=chunk_overlap_tokens, help="Tokens of whole paragraphs repeated from the end of the previous chunk when a section is split.")
+    parser.add_argument("--chunker", choices=['tokens', 'words'], default=chunker, help="'words' uses the previous chunker, which sizes chunks in words.")
+    parser.add_argument("--yaml", action="store_true", help=f"Save every chunk to its own chunk_N.yaml file instead of {chunk_store_file}.")
     args = parser.parse_args()
-    lp_url = args.url
 
-    processLearningPath(lp_url)
+    chunk_max_tokens, chunk_min_tokens, chunk_overlap_tokens, chunker = args.max_tokens, args.min_tokens, args.overlap_tokens, args.chunker
+
+    if not args.yaml:
+        os.makedirs('./chunks/', exist_ok=True)
+        chunk_store = ChunkStore(chunk_store_file)
+    loadHttpCache()
+    try:
+        # A sitemap lists the whole corpus. A URL file or a single Learning Path only covers the pages of the
+        # Learning Paths it names, so only their pages are pruned.
+        if args.sitemap:
+            urls = obtainLearningPathUrls(args.sitemap)
+            if len(processLearningPaths(urls, args.workers)) == len(urls):
+                removeStalePages()
+            else:
+                print("Some Learning Paths could not be loaded, keeping the chunks of pages not found in this crawl")
+        elif args.urls_file:
+            with open(args.urls_file, 'r') as f:
+                urls = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            removeStalePages([learningPathPrefix(url) for url in processLearningPaths(urls, args.workers)])
+        else:
+            processLearningPath(args.url)
+            removeStalePages([learningPathPrefix(args.url)])
+    finally:
+        if chunk_store is not None:
+            chunk_store.close()
+        saveHttpCache()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
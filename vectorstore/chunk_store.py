@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+COLUMNS = ('uuid', 'url', 'title', 'keywords', 'content', 'chunk_number')
+
+
+class ChunkStore:
+    """
+    Single-file SQLite store of the chunks of all pages, indexed by chunk UUID and page URL.
+
+    Pages are queued with replace_page and written in batches, each in one transaction. Chunk numbers
+    are assigned by SQLite and never reused, so concurrent workers and later runs cannot collide.
+    """
+
+    def __init__(self, store_path: str, batch_size: int = 1000):
+        self.db = sqlite3.connect(store_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "chunk_number INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT NOT NULL UNIQUE, url TEXT NOT NULL, "
+            "title TEXT, keywords TEXT, content TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_url ON chunks (url)")
+        self.db.commit()
+        self.batch_size = batch_size
+        self._pending_urls = []
+        self._pending_rows = []
+        self._lock = threading.Lock()
+
+    def replace_page(self, url: str, chunks: List[Dict]):
+        """Queue the chunks of a page, replacing the chunks it had before once the batch is written."""
+        with self._lock:
+            self._pending_urls.append(url)
+            self._pending_rows.extend((c['uuid'], url, c['title'], c['keywords'], c['content']) for c in chunks)
+            if len(self._pending_rows) >= self.batch_size:
+                self._write_pending()
+
+    def flush(self):
+        """Write all queued pages."""
+        with self._lock:
+            self._write_pending()
+
+    def delete_pages_except(self, urls, prefixes: Tuple[str, ...] = ('',)) -> List[str]:
+        """Delete the chunks of the pages whose URL starts with one of prefixes and is not in urls, and return those URLs."""
+        with self._lock:
+            self._write_pending()
+            stale = [url for (url,) in self.db.execute("SELECT DISTINCT url FROM chunks")
+                     if url.startswith(prefixes) and url not in urls]
+            with self.db:
+                self.db.executemany("DELETE FROM chunks WHERE url = ?", [(url,) for url in stale])
+        return stale
+
+    def _write_pending(self):
+        if not self._pending_urls:
+            return
+        with self.db:
+            self.db.executemany("DELETE FROM chunks WHERE url = ?", [(url,) for url in self._pending_urls])
+            # A page that repeats a snippet produces the same UUID twice; it is stored once
+            self.db.executemany(
+                "INSERT OR IGNORE INTO chunks (uuid, url, title, keywords, content) VALUES (?, ?, ?, ?, ?)",
+                self._pending_rows,
+            )
+        self._pending_urls = []
+        self._pending_rows = []
+
+    def chunks(self, chunk_numbers: Sequence[int] = None) -> Iterator[Tuple]:
+        """
+        Stream the stored chunks as (uuid, url, title, keywords, content, chunk_number) rows, in chunk number order,
+        or only the given chunks in the given order.
+        """
+        if chunk_numbers is None:
+            cursor = self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM chunks ORDER BY chunk_number")
+        else:
+            # The order is joined from a temporary table, so SQLite streams the rows without sorting them in memory
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS chunk_order (position INTEGER PRIMARY KEY, chunk_number INTEGER)")
+            self.db.execute("DELETE FROM chunk_order")
+            self.db.executemany("INSERT INTO chunk_order VALUES (?, ?)", enumerate(map(int, chunk_numbers)))
+            self.db.commit()
+            cursor = self.db.execute(
+                f"SELECT {', '.join('chunks.' + column for column in COLUMNS)} "
+                "FROM chunk_order JOIN chunks USING (chunk_number) ORDER BY position"
+            )
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,137 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List
+
+import openai
+
+from utils.tokens import count_embedding_tokens
+
+
+def plan_batches(contents: List[str], max_batch_tokens: int, max_batch_items: int) -> List[List[int]]:
+    """Group content indices into batches that stay within a token budget and an item limit."""
+    batches = []
+    current = []
+    current_tokens = 0
+    for i, content in enumerate(contents):
+        tokens = count_embedding_tokens(content)
+        if current and (current_tokens + tokens > max_batch_tokens or len(current) >= max_batch_items):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def retry_delay(error: Exception, attempt: int, base_delay: float = 1.0, max_delay: float = 60.0):
+    """
+    Return how long to wait before retrying a failed request, or None if it should not be retried.
+
+    Rate limits, server errors, timeouts and connection errors are retried. The server's
+    retry-after-ms / retry-after header is honoured, otherwise the delay grows exponentially with jitter.
+    """
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code not in (408, 409, 429) and error.status_code < 500:
+            return None
+        headers = error.response.headers
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000.0
+            if headers.get('retry-after'):
+                return float(headers['retry-after'])
+        except ValueError:
+            pass
+    elif not isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return None
+    return min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit that halves on every rate-limit response and grows back by one after a run of successes.
+
+    This keeps the number of in-flight requests close to what the API quota sustains.
+    """
+
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, rate_limited: bool = False):
+        with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                print(f"Rate limited, reducing concurrency to {self.limit}")
+            else:
+                self.successes += 1
+                if self.limit < self.maximum and self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+            self._cond.notify_all()
+
+
+def run_batches(contents: List[str], embed_batch: Callable[[List[str]], list], on_batch: Callable[[List[int], list], None],
+                max_in_flight: int = 4, max_batch_tokens: int = 20000, max_batch_items: int = 100, max_retries: int = 8):
+    """
+    Embed contents with several concurrent requests.
+
+    Args:
+    contents (List[str]): Texts to embed.
+    embed_batch: Callable embedding a list of texts with one request and returning one embedding per text.
+    on_batch: Called on the calling thread with the content indices and embeddings of every completed batch,
+        e.g. to checkpoint them, so an interrupted run only loses the batches still in flight.
+    max_in_flight (int): Maximum number of concurrent requests, reduced automatically while rate limited.
+    max_batch_tokens (int): Token budget of a single request.
+    max_batch_items (int): Maximum number of texts in a single request.
+    max_retries (int): Number of retries of a failed batch before the run is aborted.
+    """
+    batches = plan_batches(contents, max_batch_tokens, max_batch_items)
+    print(f"Embedding {len(contents)} texts in {len(batches)} batches with up to {max_in_flight} requests in flight")
+    limit = AdaptiveLimit(max_in_flight)
+
+    def run(batch_indices):
+        texts = [contents[i] for i in batch_indices]
+        for attempt in range(max_retries + 1):
+            limit.acquire()
+            try:
+                embeddings = embed_batch(texts)
+            except Exception as e:
+                rate_limited = isinstance(e, openai.RateLimitError)
+                limit.release(rate_limited)
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt == max_retries:
+                    raise
+                print(f"Batch of {len(texts)} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            limit.release()
+            return batch_indices, embeddings
+
+    completed = 0
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = [executor.submit(run, batch) for batch in batches]
+        try:
+            for future in as_completed(futures):
+                batch_indices, embeddings = future.result()
+                on_batch(batch_indices, embeddings)
+                completed += 1
+                print(f"Completed batch {completed}/{len(batches)}")
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
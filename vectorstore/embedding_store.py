@@ -0,0 +1,48 @@
+import hashlib
+import sqlite3
+from typing import Dict, List
+
+import numpy as np
+
+
+def content_hash(content: str) -> str:
+    """Hash of a chunk's text; chunks with the same text share an embedding."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """Persistent SQLite store of embeddings keyed by (content hash, model name)."""
+
+    def __init__(self, store_path: str):
+        self.db = sqlite3.connect(store_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "content_hash TEXT, model TEXT, vector BLOB, PRIMARY KEY (content_hash, model))"
+        )
+        self.db.commit()
+
+    def get_many(self, hashes: List[str], model_name: str) -> Dict[str, np.ndarray]:
+        """Return the stored embeddings of the given content hashes; missing hashes are left out."""
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        # Stay well below SQLite's limit on the number of query parameters
+        for i in range(0, len(unique_hashes), 500):
+            batch = unique_hashes[i:i + 500]
+            rows = self.db.execute(
+                f"SELECT content_hash, vector FROM embeddings WHERE model = ? AND content_hash IN ({','.join('?' * len(batch))})",
+                [model_name, *batch],
+            )
+            for row_hash, vector in rows:
+                found[row_hash] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, hashes: List[str], embeddings: np.ndarray, model_name: str):
+        """Store embeddings and commit immediately, so completed work survives an interrupted run."""
+        self.db.executemany(
+            "INSERT OR REPLACE INTO embeddings (content_hash, model, vector) VALUES (?, ?, ?)",
+            [(h, model_name, np.asarray(e, dtype=np.float32).tobytes()) for h, e in zip(hashes, embeddings)],
+        )
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
@@ -1,27 +1,47 @@
 import yaml
 import faiss
 import numpy as np
-import math
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator
 import json
 import os
 import glob
 from openai import AzureOpenAI
 import sys
-import datetime
+import argparse
+import uuid
+
+# Index helpers are shared with the Flask application, which lives one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import index_types
+from utils.metadata_store import MetadataStore, write_metadata_json, write_metadata_store
+from utils.lexical_index import build_lexical_index, save_lexical_index
+from utils.metadata_filters import build_filter_bitmaps, save_filter_bitmaps
+from utils.retrieval import url_ids
+from utils.embedding_artifact import EmbeddingArtifact, write_embedding_artifact, DTYPES
+from utils.embedders import BACKENDS, DEFAULT_LOCAL_MODEL, LocalEmbedder
+from embedding_store import EmbeddingStore, content_hash
+from chunk_store import ChunkStore
+from embedding_scheduler import run_batches
 
 # Global variable for subfolder name
 subfolder = "chunks/"
+embedding_model = 'text-embedding-ada-002'
+
 
+# Azure OpenAI client for the remote embedder, only created when it is used
+llm_client = None
 
-# Obtain LLM testing key
-print("Starting...obtaining LLM API Key...")
-azure_api_key = os.getenv("AZURE_OPENAI_KEY")
-azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-if azure_api_key is None:
-    print("API_KEY is not set. Please set and try again.")
-    sys.exit()
-llm_client = AzureOpenAI(api_key=azure_api_key, azure_endpoint=azure_endpoint, api_version="2023-05-15")
+def create_llm_client() -> AzureOpenAI:
+    """Create the Azure OpenAI client, exiting if the API key is not set."""
+    # Obtain LLM testing key
+    print("Starting...obtaining LLM API Key...")
+    azure_api_key = os.getenv("AZURE_OPENAI_KEY")
+    azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    if azure_api_key is None:
+        print("API_KEY is not set. Please set and try again.")
+        sys.exit()
+    # Retries are handled by the batch scheduler, which also adapts its concurrency to rate limits
+    return AzureOpenAI(api_key=azure_api_key, azure_endpoint=azure_endpoint, api_version="2023-05-15", max_retries=0)
 
 def load_local_yaml_files() -> List[Dict]:
     """Load locally stored YAML files and return their contents as a list of dictionaries."""
@@ -46,94 +66,322 @@ def load_local_yaml_files() -> List[Dict]:
     print(f"Loaded {len(yaml_contents)} YAML files")
     return yaml_contents
 
-def create_embeddings(contents: List[str], model_name: str = 'text-embedding-ada-002', batch_size: int = 100) -> np.ndarray:
-    """Create embeddings for the given contents using OpenAI API."""
+def load_chunks(chunk_numbers: np.ndarray = None) -> Iterator[Tuple]:
+    """
+    Stream (uuid, url, title, keywords, content, chunk_number) rows from the chunk store, or from the YAML files if there is none.
+
+    If chunk_numbers is given, only those chunks are streamed, in that order.
+    """
+    chunk_store_filename = subfolder+'chunks.db'
+    if os.path.exists(chunk_store_filename):
+        store = ChunkStore(chunk_store_filename)
+        print(f"Loading {len(store)} chunks from {chunk_store_filename}")
+        return store.chunks(chunk_numbers)
+    rows = [(c['uuid'], c['url'], c['title'], c['keywords'], c['content'], c['chunk_number']) for c in load_local_yaml_files()]
+    if chunk_numbers is None:
+        return iter(rows)
+    row_of_chunk = {row[5]: row for row in rows}
+    return (row_of_chunk[chunk_number] for chunk_number in chunk_numbers.tolist())
+
+def unique_chunks(rows: Iterator[Tuple]) -> Iterator[Tuple]:
+    """Skip the rows of chunks already seen. Chunk UUIDs are derived from URL and content, so a chunk saved twice is indexed once."""
+    seen_ids = set()
+    for row in rows:
+        if chunk_id(row[0]) not in seen_ids:
+            seen_ids.add(chunk_id(row[0]))
+            yield row
+
+class ChunkMetadata:
+    """Metadata records of the given chunks, in the given order, streamed from the chunks one at a time."""
+
+    def __init__(self, chunk_numbers: np.ndarray):
+        self.chunk_numbers = chunk_numbers
+
+    def __len__(self):
+        return len(self.chunk_numbers)
+
+    def __iter__(self):
+        for chunk_uuid, url, title, keywords, content, chunk_number in load_chunks(self.chunk_numbers):
+            yield {
+                'uuid': chunk_uuid,
+                'url': url,
+                'original_text': content,
+                'title': title,
+                'keywords': keywords,
+                'chunk_number': chunk_number
+            }
+
+def create_embeddings(contents: List[str], model_name: str = 'text-embedding-ada-002', batch_size: int = 100, max_batch_tokens: int = 20000, max_in_flight: int = 4, on_batch=None, embedder=None) -> np.ndarray:
+    """
+    Create embeddings for the given contents using OpenAI API, or the given local embedder.
+
+    Batches are sized by token budget and sent concurrently, backing off on rate limits and server errors.
+    A local embedder runs one batch at a time, since the model already uses all of its threads.
+    If given, on_batch(indices, embeddings) is called as each batch completes so the caller can checkpoint it.
+    """
     print(f"Creating embeddings using model: {model_name}")
-    all_embeddings = []
-    
-    # Process in batches
-    for i in range(0, len(contents), batch_size):
-        batch = contents[i:i + batch_size]
-        print(f"Processing batch {i//batch_size + 1}/{math.ceil(len(contents)/batch_size)}")
-        
-        try:
-            response = llm_client.embeddings.create(
-                model=model_name,
-                input=batch
-            )
-            # Extract embeddings from response
-            batch_embeddings = [item.embedding for item in response.data]
-            all_embeddings.extend(batch_embeddings)
-            print("created embeddings: ", batch_embeddings)
-            
-        except Exception as e:
-            print(f"Error creating embeddings for batch: {e}")
-            raise
-    
+    all_embeddings = [None] * len(contents)
+
+    def embed_batch(batch):
+        if embedder is not None:
+            return embedder.embed(batch)
+        response = llm_client.embeddings.create(
+            model=model_name,
+            input=batch
+        )
+        # Extract embeddings from response
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    if embedder is not None:
+        max_in_flight = 1
+
+    def collect_batch(indices, batch_embeddings):
+        for i, embedding in zip(indices, batch_embeddings):
+            all_embeddings[i] = embedding
+        if on_batch is not None:
+            on_batch(indices, batch_embeddings)
+
+    run_batches(contents, embed_batch, collect_batch, max_in_flight, max_batch_tokens, batch_size)
+
     # Convert to numpy array
-    embeddings_array = np.array(all_embeddings)
+    embeddings_array = np.array(all_embeddings, dtype=np.float32)
     print(f"Created embeddings with shape: {embeddings_array.shape}")
     return embeddings_array
 
-def create_faiss_index(embeddings: np.ndarray, metadata: List[Dict]) -> Tuple[faiss.IndexFlatL2, List[Dict]]:
-    """Create a FAISS index with the given embeddings and metadata."""
-    print("Creating FAISS index")
+def create_faiss_index(embeddings: np.ndarray, index_type: str = 'flat', ids: np.ndarray = None, **index_params) -> Tuple[faiss.Index, Dict]:
+    """Create a FAISS index of the given type with the given embeddings, keyed by chunk IDs if given."""
+    print(f"Creating FAISS {index_type} index")
     print(f"Embeddings shape: {embeddings.shape}")
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+    index, index_config = index_types.build_index(embeddings, index_type, ids, **index_params)
     print(f"Added {index.ntotal} vectors to the index")
-    return index, metadata
+    return index, index_config
 
-def main():
-    print("Starting the FAISS datastore creation process")
+def chunk_id(chunk_uuid: str) -> int:
+    """Derive a stable, non-negative int64 FAISS ID from a chunk's UUID."""
+    return uuid.UUID(chunk_uuid).int >> 65
+
+def embed_with_store(hashes: List[str], store: EmbeddingStore, model_name: str = embedding_model, **embedding_options) -> np.ndarray:
+    """
+    Return embeddings for the chunks with the given content hashes, only calling the embeddings API for contents not already in the store.
 
-    # Load local YAML files
-    yaml_contents = load_local_yaml_files()
-
-    # Extract content, uuid, url, and original text from YAML files
-    print("Extracting content and metadata from YAML files")
-    contents = []
-    metadata = []
-    for i, yaml_content in enumerate(yaml_contents, 1):
-        print(f"Processing YAML content {i}/{len(yaml_contents)}")
-        contents.append(yaml_content['content'])
-        metadata.append({
-            'uuid': yaml_content['uuid'],
-            'url': yaml_content['url'],
-            'original_text': yaml_content['content'],
-            'title': yaml_content['title'],
-            'keywords': yaml_content['keywords'],
-            'chunk_number': yaml_content['chunk_number']
-        })
-
-    # Create embeddings
-    embeddings = create_embeddings(contents)
-
-    print("Saving embeddings to file")
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{subfolder}embeddings_{timestamp}.txt"
-    np.savetxt(filename, embeddings)
-
-    # Create FAISS index
-    print("Creating FAISS index")
-    index, metadata = create_faiss_index(embeddings, metadata)
-
-    # Save the FAISS index
+    Only the contents of new or changed chunks are read back from the chunks. Every completed batch is written to
+    the store straight away, so an interrupted run resumes where it stopped.
+    """
+    stored = store.get_many(hashes, model_name)
+    missing = {}
+    if len(stored) < len(set(hashes)):
+        for row in load_chunks():
+            h = content_hash(row[4])
+            if h not in stored:
+                missing.setdefault(h, row[4])
+    print(f"Reusing {len(set(hashes)) - len(missing)} stored embeddings, embedding {len(missing)} new or changed chunks")
+    if missing:
+        missing_hashes = list(missing.keys())
+
+        def checkpoint(indices, batch_embeddings):
+            store.put_many([missing_hashes[i] for i in indices], batch_embeddings, model_name)
+
+        new_embeddings = create_embeddings(list(missing.values()), model_name, on_batch=checkpoint, **embedding_options)
+        stored.update(zip(missing_hashes, new_embeddings))
+    return np.vstack([stored[h] for h in hashes]).astype(np.float32)
+
+def load_updatable_index(index_filename: str, index_type: str, dimension: int, embedding_config: Dict):
+    """Return the previous index if it can be updated in place (a flat IndexIDMap2 of the same dimension and embedding model), else None."""
+    if index_type != 'flat' or not os.path.exists(index_filename):
+        return None
+    previous_config = index_types.load_index_config(subfolder+'index_config.json')
+    if 'shards' in previous_config:
+        return None
+    if previous_config.get('embedding', {'backend': 'remote', 'model': embedding_model}) != embedding_config:
+        return None
+    index = faiss.read_index(index_filename)
+    if not isinstance(index, faiss.IndexIDMap2) or index.d != dimension:
+        return None
+    return index
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Embed the chunks in ./chunks/ and build a FAISS index from them.")
+    parser.add_argument("--index-type", choices=index_types.INDEX_TYPES, default='flat', help="FAISS index type to build. Defaults to an exact flat index. sq8, fp16 and pq store compressed vectors.")
+    parser.add_argument("--nlist", type=int, help="Number of IVF lists (ivf, ivfpq). Defaults to ~4*sqrt(number of chunks).")
+    parser.add_argument("--nprobe", type=int, help="Number of IVF lists visited per search (ivf, ivfpq).")
+    parser.add_argument("--M", type=int, help="Number of neighbours per HNSW node (hnsw).")
+    parser.add_argument("--ef-construction", dest="efConstruction", type=int, help="HNSW candidate list size while building (hnsw).")
+    parser.add_argument("--ef-search", dest="efSearch", type=int, help="HNSW candidate list size while searching (hnsw).")
+    parser.add_argument("--pq-m", dest="pq_m", type=int, help="Number of PQ sub-quantizers, must divide the embedding dimension (ivfpq, pq).")
+    parser.add_argument("--pq-nbits", dest="pq_nbits", type=int, help="Bits per PQ code (ivfpq, pq).")
+    parser.add_argument("--refine-factor", dest="refine_factor", type=int, help="Re-rank refine_factor * k candidates of a compressed index by their exact distance to the vectors in embeddings.emb, 0 to disable (ivfpq, sq8, fp16, pq).")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="Maximum number of concurrent embeddings requests. Reduced automatically while rate limited.")
+    parser.add_argument("--max-batch-tokens", type=int, default=20000, help="Token budget of a single embeddings request.")
+    parser.add_argument("--batch-size", type=int, default=100, help="Maximum number of chunks in a single embeddings request.")
+    parser.add_argument("--full-rebuild", action="store_true", help="Rebuild a flat index from scratch instead of updating the previous one in place.")
+    parser.add_argument("--embeddings-dtype", choices=DTYPES, default='float32', help="Storage type of the saved embeddings artifact. float16 and int8 are smaller but lossy.")
+    parser.add_argument("--embedder", choices=BACKENDS, default='remote', help="Embed chunks with the Azure OpenAI API (remote) or a sentence-embedding model on the local CPU (local). The Flask application embeds queries with the same backend.")
+    parser.add_argument("--local-model", default=DEFAULT_LOCAL_MODEL, help="Hugging Face model used by the local embedder.")
+    parser.add_argument("--shards", type=int, default=1, help="Split the corpus into this many indexes, which the Flask application searches in parallel and merges.")
+    parser.add_argument("--from-embeddings", metavar="ARTIFACT", help="Rebuild or retune the index from a saved embeddings artifact and the existing metadata, without loading chunks or calling the embeddings API.")
+    return parser.parse_args()
+
+def save_index(index, index_config: Dict):
+    """Save the FAISS index, and its type and parameters so the search side can apply the same knobs."""
     index_filename = subfolder+'faiss_index.bin'
     print(f"Saving FAISS index to {index_filename}")
     faiss.write_index(index, index_filename)
 
-    # Save metadata
+    index_config_filename = subfolder+'index_config.json'
+    print(f"Saving index config to {index_config_filename}")
+    index_types.save_index_config(index_config, index_config_filename)
+    print(f"FAISS index saved to: {os.path.abspath(index_filename)}")
+    print(f"Index config saved to: {os.path.abspath(index_config_filename)}")
+
+def save_shards(shards: List, index_config: Dict):
+    """Save the shard indexes under the file names listed in the index config, then the index config."""
+    for shard, entry in zip(shards, index_config['shards']):
+        shard_filename = subfolder+entry['file']
+        print(f"Saving FAISS shard with {shard.ntotal} vectors to {shard_filename}")
+        faiss.write_index(shard, shard_filename)
+
+    index_config_filename = subfolder+'index_config.json'
+    print(f"Saving index config to {index_config_filename}")
+    index_types.save_index_config(index_config, index_config_filename)
+    print(f"Index config saved to: {os.path.abspath(index_config_filename)}")
+
+def rebuild_from_embeddings(artifact_path: str, index_type: str, index_params: Dict, num_shards: int = 1):
+    """Build a new index from an embeddings artifact, streaming it in batches so memory use stays constant."""
+    artifact = EmbeddingArtifact(artifact_path)
+    print(f"Loaded embeddings artifact with {len(artifact)} {artifact.dtype} vectors of dimension {artifact.dimension} from model {artifact.model}")
+    metadata_store_filename = subfolder+'metadata.bin'
+    if os.path.exists(metadata_store_filename):
+        metadata = MetadataStore(metadata_store_filename)
+    else:
+        with open(subfolder+'metadata.json', 'r') as f:
+            metadata = json.load(f)
+    if len(metadata) != len(artifact):
+        raise ValueError(f"{artifact_path} holds {len(artifact)} vectors but the metadata holds {len(metadata)} items")
+
+    # The embedding backend is recorded in the index config of the build that wrote the artifact; indexes built
+    # before the local embedder existed have none and were embedded remotely
+    embedding_config = index_types.load_index_config(subfolder+'index_config.json').get('embedding', {'backend': 'remote', 'model': embedding_model})
+    if embedding_config['model'] != artifact.model:
+        raise ValueError(f"{artifact_path} was embedded with {artifact.model} but index_config.json records {embedding_config['model']}; rebuild from the chunks instead")
+    if num_shards > 1:
+        shards, index_config = index_types.build_shards_from_artifact(artifact, index_type, num_shards, **index_params)
+        index_config['embedding'] = embedding_config
+        save_shards(shards, index_config)
+        return
+
+    # Artifact rows are in metadata order, so the ID map keeps that order and metadata stays valid
+    ids = np.fromiter((chunk_id(item['uuid']) for item in metadata), dtype=np.int64, count=len(metadata))
+    index, index_config = index_types.build_index_from_artifact(artifact, index_type, ids, **index_params)
+    index_config['embedding'] = embedding_config
+    print(f"Added {index.ntotal} vectors to the index")
+    save_index(index, index_config)
+
+def main():
+    args = parse_args()
+    index_params = {key: value for key, value in vars(args).items() if key not in ('index_type', 'full_rebuild', 'embeddings_dtype', 'from_embeddings', 'max_in_flight', 'max_batch_tokens', 'batch_size', 'embedder', 'local_model', 'shards')}
+    embedding_options = {'max_in_flight': args.max_in_flight, 'max_batch_tokens': args.max_batch_tokens, 'batch_size': args.batch_size}
+
+    if args.from_embeddings:
+        print("Rebuilding the FAISS index from saved embeddings")
+        rebuild_from_embeddings(args.from_embeddings, args.index_type, index_params, args.shards)
+        return
+
+    print("Starting the FAISS datastore creation process")
+
+    global llm_client
+    if args.embedder == 'local':
+        embedder = LocalEmbedder(args.local_model)
+        model_name = embedder.model_name
+        embedding_options['embedder'] = embedder
+    else:
+        llm_client = create_llm_client()
+        model_name = embedding_model
+    embedding_config = {'backend': args.embedder, 'model': model_name}
+
+    # Only the ID, chunk number and content hash of every chunk are kept in memory; contents and metadata are streamed from the chunks
+    print("Reading chunk IDs and content hashes")
+    ids, chunk_numbers, hashes = [], [], []
+    for chunk_uuid, url, title, keywords, content, chunk_number in unique_chunks(load_chunks()):
+        ids.append(chunk_id(chunk_uuid))
+        chunk_numbers.append(chunk_number)
+        hashes.append(content_hash(content))
+    print(f"Found {len(ids)} chunks")
+    ids = np.array(ids, dtype=np.int64)
+    chunk_numbers = np.array(chunk_numbers, dtype=np.int64)
+
+    # Create embeddings, reusing those of unchanged chunks
+    embedding_store_filename = subfolder+'embeddings.db'
+    embeddings = embed_with_store(hashes, EmbeddingStore(embedding_store_filename), model_name, **embedding_options)
+
+    # Update the previous index in place when possible, otherwise build a new one. Shards are built from the saved embeddings below.
+    index_filename = subfolder+'faiss_index.bin'
+    index = None if args.full_rebuild or args.shards > 1 else load_updatable_index(index_filename, args.index_type, embeddings.shape[1], embedding_config)
+    if index is not None:
+        print("Updating previous FAISS index in place")
+        index = index_types.update_id_map_index(index, ids, embeddings)
+        index_config = index_types.load_index_config(subfolder+'index_config.json')
+    elif args.shards == 1:
+        print("Creating FAISS index")
+        index, index_config = create_faiss_index(embeddings, args.index_type, ids=ids, **index_params)
+
+    # Order metadata and embeddings like the vectors in the index, so a search result position is a metadata position
+    if isinstance(index, faiss.IndexIDMap2):
+        position_of_id = {chunk: position for position, chunk in enumerate(ids.tolist())}
+        order = [position_of_id[chunk] for chunk in index_types.id_map_order(index).tolist()]
+        chunk_numbers = chunk_numbers[order]
+        embeddings = embeddings[order]
+
+    # Save embeddings in metadata order, so the index can be rebuilt or retuned later with --from-embeddings
+    embeddings_filename = subfolder+'embeddings.emb'
+    print(f"Saving embeddings to {embeddings_filename}")
+    write_embedding_artifact(embeddings_filename, embeddings, model_name, args.embeddings_dtype)
+
+    if args.shards > 1:
+        print(f"Creating {args.shards} FAISS shards")
+        shards, index_config = index_types.build_shards_from_artifact(EmbeddingArtifact(embeddings_filename), args.index_type, args.shards, **index_params)
+    # The application embeds queries with the same backend and model, and --from-embeddings rebuilds with them
+    index_config['embedding'] = embedding_config
+    if args.shards > 1:
+        save_shards(shards, index_config)
+    else:
+        save_index(index, index_config)
+
+    # Save metadata as an offset-indexed binary store, which the Flask application memory-maps. Records are
+    # streamed from the chunks in index order, and the files below are built from the store one record at a time.
+    metadata_store_filename = subfolder+'metadata.bin'
+    print(f"Saving metadata store to {metadata_store_filename}")
+    write_metadata_store(ChunkMetadata(chunk_numbers), metadata_store_filename)
+    metadata = MetadataStore(metadata_store_filename)
+
+    # Save the same records as JSON, for tools and deployments without metadata.bin
     metadata_filename = subfolder+'metadata.json'
     print(f"Saving metadata to {metadata_filename}")
-    with open(metadata_filename, 'w') as f:
-        json.dump(metadata, f, indent=2)  # Added indent for better readability
+    write_metadata_json(metadata, metadata_filename)
+
+    # Save the page URL ID of every chunk, which the Flask application uses to return one chunk per page
+    chunk_urls_filename = subfolder+'chunk_urls.npy'
+    print(f"Saving chunk URLs to {chunk_urls_filename}")
+    np.save(chunk_urls_filename, url_ids(metadata))
+
+    # Build the BM25 index over the same metadata order, for hybrid search
+    lexical_index_filename = subfolder+'lexical_index.npz'
+    print(f"Saving lexical index to {lexical_index_filename}")
+    save_lexical_index(build_lexical_index(metadata), lexical_index_filename)
+
+    # Bitmaps of the chunks of every keyword, Learning Path and category, for filtered search
+    filter_bitmaps_filename = subfolder+'filter_bitmaps.npz'
+    print(f"Saving filter bitmaps to {filter_bitmaps_filename}")
+    save_filter_bitmaps(build_filter_bitmaps(metadata), filter_bitmaps_filename)
 
     print("FAISS index and metadata have been created and saved.")
-    print(f"Total documents processed: {len(contents)}")
-    print(f"FAISS index saved to: {os.path.abspath(index_filename)}")
+    print(f"Total documents processed: {len(metadata)}")
+    print(f"Embedding store saved to: {os.path.abspath(embedding_store_filename)}")
+    print(f"Embeddings saved to: {os.path.abspath(embeddings_filename)}")
     print(f"Metadata saved to: {os.path.abspath(metadata_filename)}")
+    print(f"Metadata store saved to: {os.path.abspath(metadata_store_filename)}")
+    print(f"Chunk URLs saved to: {os.path.abspath(chunk_urls_filename)}")
+    print(f"Lexical index saved to: {os.path.abspath(lexical_index_filename)}")
+    print(f"Filter bitmaps saved to: {os.path.abspath(filter_bitmaps_filename)}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
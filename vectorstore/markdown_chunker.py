@@ -0,0 +1,195 @@
+import re
+from typing import Callable, Iterator, List, NamedTuple
+
+# Chunks are sized in tokens of the embedding model
+from utils.tokens import count_embedding_tokens as count_tokens
+
+HEADING = re.compile(r'^(#{1,6})\s+\S')
+FENCE = re.compile(r'^\s*(`{3,}|~{3,})')
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+class Block(NamedTuple):
+    """A heading, paragraph or fenced code block, with its token count and its place in the heading tree."""
+    kind: str           # 'heading', 'paragraph' or 'code'
+    text: str
+    tokens: int
+    section: tuple      # Text of the enclosing headings, outermost first
+    heading: 'Block'    # Innermost enclosing heading block, or None
+
+
+def parse_blocks(content: str, count_tokens: Callable[[str], int] = count_tokens) -> Iterator[Block]:
+    """
+    Parse markdown into a stream of blocks in a single pass over its lines.
+
+    Lines inside a code fence are never read as headings, and a fence is one block from its opening to
+    its closing line (or to the end of the text if it is never closed).
+    """
+    section = []            # (level, heading block) of the enclosing headings
+    lines = []
+    kind = None
+    fence = None            # Opening fence characters while inside a code block
+
+    def block(kind, text):
+        heading = section[-1][1] if section else None
+        return Block(kind, text, count_tokens(text), tuple(h.text for _, h in section), heading)
+
+    for line in content.splitlines():
+        if fence is not None:
+            lines.append(line)
+            stripped = line.strip()
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                yield block('code', '\n'.join(lines))
+                lines, kind, fence = [], None, None
+            continue
+
+        opening = FENCE.match(line)
+        heading = HEADING.match(line)
+        if opening or heading or not line.strip():
+            if lines:
+                yield block(kind, '\n'.join(lines))
+                lines, kind = [], None
+        if opening:
+            fence = opening.group(1)
+            lines, kind = [line], 'code'
+        elif heading:
+            level = len(heading.group(1))
+            while section and section[-1][0] >= level:
+                section.pop()
+            heading_block = block('heading', line.strip())
+            section.append((level, heading_block))
+            yield heading_block
+        elif line.strip():
+            lines.append(line)
+            kind = 'paragraph'
+
+    if lines:
+        yield block(kind, '\n'.join(lines))
+
+
+def split_block(block: Block, max_tokens: int, count_tokens: Callable[[str], int] = count_tokens) -> List[Block]:
+    """
+    Split a block larger than max_tokens into consecutive blocks that fit.
+
+    Paragraphs are split between lines, and lines between sentences. Code blocks are split between
+    lines, and every part is wrapped in the original opening and closing fence so it stays valid markdown.
+    """
+    if block.kind == 'code':
+        lines = block.text.split('\n')
+        opening = lines[0]
+        if len(lines) > 1 and FENCE.match(lines[-1]):
+            closing, body = lines[-1], lines[1:-1]
+        else:
+            closing, body = FENCE.match(opening).group(1), lines[1:]
+        wrap = lambda part: '\n'.join([opening, *part, closing])
+        budget = max_tokens - count_tokens(opening) - count_tokens(closing)
+    else:
+        body = []
+        for line in block.text.split('\n'):
+            body.extend(SENTENCE_END.split(line) if count_tokens(line) > max_tokens else [line])
+        wrap = '\n'.join
+        budget = max_tokens
+
+    parts = []
+    part, part_tokens = [], 0
+    for piece in body:
+        tokens = count_tokens(piece)
+        if part and part_tokens + tokens > budget:
+            parts.append(part)
+            part, part_tokens = [], 0
+        part.append(piece)
+        part_tokens += tokens
+    if part:
+        parts.append(part)
+    return [block._replace(text=wrap(part), tokens=count_tokens(wrap(part))) for part in parts]
+
+
+def chunk_markdown(content: str, max_tokens: int = 512, min_tokens: int = 256, min_final_tokens: int = 128,
+                   overlap_tokens: int = 0, count_tokens: Callable[[str], int] = count_tokens) -> List[str]:
+    """
+    Split markdown into chunks of at most max_tokens, preferring to break at headings.
+
+    Blocks are packed into the current chunk as they are parsed. A heading starts a new chunk once the
+    current one holds min_tokens, and a block that does not fit starts a new chunk in any case. A chunk
+    that starts in the middle of a section repeats the section's heading, followed by up to
+    overlap_tokens of whole blocks from the end of the previous chunk. A chunk smaller than
+    min_final_tokens, such as a short section followed by one that does not fit with it, is merged
+    into the next chunk if they fit together, or else into the previous one. Every block's tokens are
+    counted once, so the cost is linear in the length of the text.
+
+    Args:
+    content (str): The markdown text, without front matter.
+    max_tokens (int): Token limit of a chunk. Only a single line or sentence longer than this is left over it.
+    min_tokens (int): Size from which a chunk is ended at the next heading.
+    min_final_tokens (int): Size below which a chunk is merged into the next or previous one.
+    overlap_tokens (int): Tokens of whole blocks repeated from the end of the previous chunk.
+    count_tokens (callable): Token counter of the embedding model.
+
+    Returns:
+    list: The text of every chunk.
+    """
+    chunks = []             # (blocks, tokens, number of leading blocks repeated from the previous chunk)
+    current, tokens, repeated = [], 0, 0
+
+    def blocks():
+        for block in parse_blocks(content, count_tokens):
+            if block.tokens > max_tokens:
+                yield from split_block(block, max_tokens, count_tokens)
+            else:
+                yield block
+
+    for block in blocks():
+        if block.kind == 'heading' and tokens >= min_tokens:
+            chunks.append((current, tokens, repeated))
+            current, tokens, repeated = [], 0, 0
+        elif current and tokens + block.tokens > max_tokens:
+            # Headings at the end of the full chunk belong with the block that follows them
+            trailing = len(current)
+            while trailing and current[trailing - 1].kind == 'heading':
+                trailing -= 1
+            # If they do not fit with it, they stay at the end of the full chunk
+            if sum(b.tokens for b in current[trailing:]) + block.tokens > max_tokens:
+                trailing = len(current)
+            carried = current[trailing:]
+            if trailing:
+                chunks.append((current[:trailing], tokens - sum(b.tokens for b in carried), repeated))
+
+            # Continue the section under its heading, with the end of the previous chunk as overlap
+            budget = max_tokens - block.tokens - sum(b.tokens for b in carried)
+            context = []
+            if not carried and block.heading is not None and block.heading.tokens <= budget:
+                context.append(block.heading)
+                budget -= block.heading.tokens
+            overlap = []
+            for previous in reversed(current[:trailing]):
+                if previous.kind == 'heading' or previous.tokens > min(budget, overlap_tokens - sum(b.tokens for b in overlap)):
+                    break
+                overlap.insert(0, previous)
+                budget -= previous.tokens
+            current = context + overlap + carried
+            tokens = sum(b.tokens for b in current)
+            repeated = len(context) + len(overlap)
+        current.append(block)
+        tokens += block.tokens
+
+    if current:
+        chunks.append((current, tokens, repeated))
+
+    def join(first, second):
+        # The blocks the second chunk repeats from the first are dropped
+        blocks, second_tokens, second_repeated = second
+        return first[0] + blocks[second_repeated:], first[1] + second_tokens - sum(b.tokens for b in blocks[:second_repeated]), first[2]
+
+    def merge_small(chunks, into_next):
+        merged = []
+        for chunk in chunks:
+            small = merged and (merged[-1] if into_next else chunk)[1] < min_final_tokens
+            if small and join(merged[-1], chunk)[1] <= max_tokens:
+                chunk = join(merged.pop(), chunk)
+            merged.append(chunk)
+        return merged
+
+    # Small chunks are merged into the next chunk, and those that do not fit with it into the previous one
+    chunks = merge_small(merge_small(chunks, into_next=True), into_next=False)
+
+    return ['\n\n'.join(block.text for block in chunk) for chunk, _, _ in chunks]
@@ -0,0 +1,75 @@
+import argparse
+import datetime
+import os
+import shutil
+import sys
+
+# Index helpers are shared with the Flask application, which lives one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import index_types
+from utils.index_manager import ARTIFACT_FILES, CURRENT_FILE
+
+# Directory the builder writes the vector store to
+subfolder = "chunks/"
+
+
+def version_files(directory: str):
+    """Return the files of the vector store in directory that make up one version."""
+    index_config = index_types.load_index_config(os.path.join(directory, 'index_config.json'))
+    index_files = [shard['file'] for shard in index_config['shards']] if 'shards' in index_config else ['faiss_index.bin']
+    return [name for name in ARTIFACT_FILES + index_files if os.path.exists(os.path.join(directory, name))]
+
+
+def publish_local(directory: str, root: str, version: str):
+    """Copy a version into root/version, then point root/CURRENT at it."""
+    target = os.path.join(root, version)
+    partial = target + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    for name in version_files(directory):
+        print(f"Copying {name} to {target}")
+        shutil.copy2(os.path.join(directory, name), os.path.join(partial, name))
+    os.rename(partial, target)
+
+    # Replace CURRENT atomically, so watchers never read a partial version name
+    current_filename = os.path.join(root, CURRENT_FILE)
+    with open(current_filename + '.tmp', 'w') as f:
+        f.write(version + '\n')
+    os.replace(current_filename + '.tmp', current_filename)
+
+
+def publish_s3(directory: str, bucket: str, prefix: str, version: str):
+    """Upload a version to s3://bucket/prefix/version/, then point s3://bucket/prefix/CURRENT at it."""
+    import boto3
+    s3 = boto3.client('s3')
+    for name in version_files(directory):
+        key = f"{prefix}{version}/{name}"
+        print(f"Uploading {name} to s3://{bucket}/{key}")
+        s3.upload_file(os.path.join(directory, name), bucket, key)
+    s3.put_object(Bucket=bucket, Key=prefix + CURRENT_FILE, Body=(version + '\n').encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish the vector store in ./chunks/ as a new version, which running Flask applications load and switch to.")
+    parser.add_argument("--root", help="Local directory of versions, the INDEX_SOURCE of the Flask application.")
+    parser.add_argument("--s3", action="store_true", help="Publish to s3://$BUCKET_NAME/<prefix> instead of a local directory.")
+    parser.add_argument("--prefix", default="vectorstore/", help="Key prefix of the versions in the S3 bucket, the INDEX_S3_PREFIX of the Flask application.")
+    parser.add_argument("--version", help="Name of the new version. Defaults to the current UTC time.")
+    args = parser.parse_args()
+
+    version = args.version or datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    if args.s3:
+        bucket = os.getenv("BUCKET_NAME")
+        if bucket is None:
+            print("BUCKET_NAME is not set. Please set and try again.")
+            sys.exit(1)
+        publish_s3(subfolder, bucket, args.prefix, version)
+    elif args.root:
+        publish_local(subfolder, args.root, version)
+    else:
+        parser.error("either --root or --s3 is required")
+    print(f"Published index version {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import sys
+
+# The chunker imports the token counters of the Flask application, which lives one directory up.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from markdown_chunker import chunk_markdown, parse_blocks
+
+
+def count_words(text: str) -> int:
+    """A tokenizer-independent token count, so sizes are exact in the tests."""
+    return len(text.split())
+
+
+def paragraph(name: str, words: int) -> str:
+    """A paragraph of sentences of at most 4 words, so it can be split to any limit from 4 tokens."""
+    return ' '.join(f"{name}{i}" + ('.' if i % 4 == 3 else '') for i in range(words))
+
+
+def chunk(content: str, **kwargs):
+    return chunk_markdown(content, count_tokens=count_words, **kwargs)
+
+
+def test_headings_inside_code_fences_are_code():
+    content = "# Title\n\nIntro text.\n\n```bash\n# not a heading\necho hi\n```\n\n## Next\n\nMore text."
+    blocks = list(parse_blocks(content, count_words))
+    assert [block.kind for block in blocks] == ['heading', 'paragraph', 'code', 'heading', 'paragraph']
+    assert blocks[2].text == "```bash\n# not a heading\necho hi\n```"
+    assert blocks[4].section == ('# Title', '## Next')
+
+
+def test_unclosed_fence_runs_to_the_end():
+    blocks = list(parse_blocks("Text.\n\n~~~\ncode\n\n# still code", count_words))
+    assert [block.kind for block in blocks] == ['paragraph', 'code']
+    assert blocks[1].text == "~~~\ncode\n\n# still code"
+
+
+def test_code_block_is_never_split_when_it_fits():
+    code = "```python\n" + '\n'.join(f"x{i} = {i}" for i in range(5)) + "\n```"
+    content = f"# Title\n\n{paragraph('a', 12)}\n\n{code}\n\n{paragraph('b', 12)}"
+    chunks = chunk(content, max_tokens=30, min_tokens=10, min_final_tokens=0)
+    assert len(chunks) > 1
+    assert sum(code in text for text in chunks) == 1
+    assert all(count_words(text) <= 30 for text in chunks)
+
+
+def test_oversized_code_block_is_split_into_fenced_parts():
+    code = "```python\n" + '\n'.join(f"x{i} = {i}" for i in range(30)) + "\n```"
+    chunks = chunk(f"# Title\n\n{code}", max_tokens=20, min_tokens=10, min_final_tokens=0)
+    code_chunks = [text[text.index("```python"):] for text in chunks if "```python" in text]
+    assert len(code_chunks) > 1
+    for text in code_chunks:
+        lines = text.split('\n')
+        assert lines[0] == "```python" and lines[-1] == "```"
+    assert all(count_words(text) <= 20 for text in chunks)
+    # Every line of the code is kept exactly once
+    body = [line for text in code_chunks for line in text.split('\n')[1:-1]]
+    assert body == [f"x{i} = {i}" for i in range(30)]
+
+
+def test_continuation_repeats_heading_and_overlaps_whole_paragraphs():
+    paragraphs = [paragraph(name, 6) for name in 'abcdefgh']
+    content = "## Section\n\n" + '\n\n'.join(paragraphs)
+    chunks = chunk(content, max_tokens=20, min_tokens=10, min_final_tokens=0, overlap_tokens=7)
+    assert len(chunks) > 1
+    for previous, text in zip(chunks, chunks[1:]):
+        blocks = text.split('\n\n')
+        assert blocks[0] == "## Section"
+        # The overlap is the last whole paragraph of the previous chunk
+        assert blocks[1] == previous.split('\n\n')[-1]
+        assert blocks[1] in paragraphs
+    assert all(count_words(text) <= 20 for text in chunks)
+
+
+def test_no_overlap_by_default():
+    paragraphs = [paragraph(name, 6) for name in 'abcdefgh']
+    chunks = chunk("## Section\n\n" + '\n\n'.join(paragraphs), max_tokens=20, min_tokens=10, min_final_tokens=0)
+    repeated = [p for p in paragraphs if sum(p in text for text in chunks) > 1]
+    assert repeated == []
+
+
+def test_small_chunk_between_large_sections_is_merged():
+    content = f"## A\n\n{paragraph('a', 40)}\n\n## B\n\nshort\n\n## C\n\n{paragraph('c', 40)}"
+    chunks = chunk(content, max_tokens=50, min_tokens=30, min_final_tokens=10)
+    assert all(count_words(text) >= 10 for text in chunks)
+    assert all(count_words(text) <= 50 for text in chunks)
+    assert sum("## B\n\nshort" in text for text in chunks) == 1
+
+
+def test_small_last_chunk_is_merged_into_the_previous_one():
+    content = f"## A\n\n{paragraph('a', 30)}\n\n## B\n\nthe end"
+    chunks = chunk(content, max_tokens=50, min_tokens=20, min_final_tokens=10)
+    assert chunks == [f"## A\n\n{paragraph('a', 30)}\n\n## B\n\nthe end"]
+
+
+def test_merging_drops_repeated_blocks():
+    paragraphs = [paragraph(name, 6) for name in 'abcd']
+    content = "## Section\n\n" + '\n\n'.join(paragraphs) + "\n\nend"
+    chunks = chunk(content, max_tokens=22, min_tokens=10, min_final_tokens=5, overlap_tokens=7)
+    text = '\n\n'.join(chunks)
+    # Whatever was merged, no paragraph appears twice within one chunk
+    for chunk_text in chunks:
+        blocks = chunk_text.split('\n\n')
+        assert len(blocks) == len(set(blocks))
+    assert all(p in text for p in paragraphs)
+
+
+def test_chunks_never_exceed_max_tokens():
+    sections = []
+    for i in range(6):
+        sections.append(f"## Section {i}")
+        sections.extend(paragraph(f"s{i}p{j}_", 3 + (i * 7 + j * 5) % 17) for j in range(5))
+        sections.append("```\n" + '\n'.join(f"line {k}" for k in range(3 + i * 4)) + "\n```")
+    content = "# Guide\n\n" + '\n\n'.join(sections)
+    for max_tokens in (16, 32, 64):
+        chunks = chunk(content, max_tokens=max_tokens, min_tokens=max_tokens // 2,
+                       min_final_tokens=max_tokens // 4, overlap_tokens=max_tokens // 4)
+        assert all(count_words(text) <= max_tokens for text in chunks)
+        # Every word survives chunking, also of the blocks that had to be split
+        assert set(content.split()) == set(' '.join(chunks).split())